@@ -0,0 +1,148 @@
+""" Columnar on-disk tables, e.g. for per-question QAGS diagnostics.
+
+A table in directory D is made of
+    - D/columns.json: the number of rows and the type of each column
+    - D/{name}.bin: the values of a numeric column, as a flat array of its dtype
+    - D/{name}.str and D/{name}.off: the UTF-8 encoded values of a string column,
+        concatenated, and their int64 byte offsets (n_rows + 1)
+
+Rows are appended a batch at a time, with a single write per column.
+Reading memory-maps the files, so a column can be filtered and a few rows
+looked up without loading the rest of the table.
+"""
+import os
+import json
+import mmap
+
+import numpy as np
+
+STR = "str"
+
+
+class ColumnStoreWriter(object):
+    """ Append batches of rows to a table in out_dir.
+
+    args:
+        - out_dir: directory to write the table to
+        - columns: dict mapping column names to 'str' or a numpy dtype name
+    """
+
+    def __init__(self, out_dir, columns):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.columns = dict(columns)
+        self.n_rows = 0
+        self.fhs = {}
+        self.n_bytes = {}
+        for name, dtype in self.columns.items():
+            if dtype == STR:
+                self.fhs[name] = (open(f"{out_dir}/{name}.str", "wb"), open(f"{out_dir}/{name}.off", "wb"))
+                np.array([0], dtype=np.int64).tofile(self.fhs[name][1])
+                self.n_bytes[name] = 0
+            else:
+                self.fhs[name] = open(f"{out_dir}/{name}.bin", "wb")
+
+    def write(self, **values):
+        """ Append a batch of rows, given as a sequence of values per column """
+        assert values.keys() == self.columns.keys(), f"Expected columns {sorted(self.columns)}"
+        n_rows = {len(col_values) for col_values in values.values()}
+        assert len(n_rows) == 1, "Got columns of different lengths!"
+        for name, col_values in values.items():
+            dtype = self.columns[name]
+            if dtype == STR:
+                data = [value.encode("utf-8") for value in col_values]
+                offsets = self.n_bytes[name] + np.cumsum([len(d) for d in data], dtype=np.int64)
+                self.fhs[name][0].write(b"".join(data))
+                offsets.tofile(self.fhs[name][1])
+                self.n_bytes[name] = int(offsets[-1]) if len(offsets) else self.n_bytes[name]
+            else:
+                np.asarray(col_values, dtype=dtype).tofile(self.fhs[name])
+        self.n_rows += n_rows.pop()
+
+    def close(self):
+        for fhs in self.fhs.values():
+            for fh in (fhs if isinstance(fhs, tuple) else [fhs]):
+                fh.close()
+        # written last, so a table is only readable once complete
+        with open(f"{self.out_dir}/columns.json", "w") as fh:
+            json.dump({"n_rows": self.n_rows, "columns": self.columns}, fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StringColumn(object):
+    """ Memory-mapped strings, indexed by an int, a contiguous slice or an array of ints.
+
+    The UTF-8 encoded strings are concatenated in {prefix}.{suffix}, and their
+    int64 byte offsets (n_strings + 1) are in {prefix}.off.
+    """
+
+    def __init__(self, prefix, suffix=STR):
+        self.offsets = np.memmap(f"{prefix}.off", dtype=np.int64, mode="r")
+        self.fh = open(f"{prefix}.{suffix}", "rb")
+        # mmap can't map empty files
+        self.blob = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f"{prefix}.{suffix}") else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1, "Only contiguous slices are supported"
+            offsets = self.offsets[start: stop + 1].tolist()
+            data = self.blob[offsets[0]: offsets[-1]] if offsets else b""
+            base = offsets[0] if offsets else 0
+            return [data[s - base: e - base].decode("utf-8") for s, e in zip(offsets[:-1], offsets[1:])]
+        if isinstance(idx, (list, np.ndarray)):
+            return [self[int(i)] for i in idx]
+        if idx < 0:
+            idx += len(self)
+        return self.blob[self.offsets[idx]: self.offsets[idx + 1]].decode("utf-8")
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.fh.close()
+
+
+class ColumnStore(object):
+    """ Read-only view of a table written by ColumnStoreWriter.
+
+    store[name] gives a numeric column as a memory-mapped numpy array,
+    and a string column as a StringColumn.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        with open(f"{data_dir}/columns.json") as fh:
+            meta = json.load(fh)
+        self.n_rows = meta["n_rows"]
+        self.columns = meta["columns"]
+        self.cache = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            dtype = self.columns[name]
+            if dtype == STR:
+                self.cache[name] = StringColumn(f"{self.data_dir}/{name}")
+            elif self.n_rows:
+                self.cache[name] = np.memmap(f"{self.data_dir}/{name}.bin", dtype=dtype, mode="r")
+            else:
+                # numpy can't map empty files
+                self.cache[name] = np.zeros(0, dtype=dtype)
+            assert len(self.cache[name]) == self.n_rows, f"Corrupted column {name} in {self.data_dir}"
+        return self.cache[name]
+
+    def close(self):
+        for col in self.cache.values():
+            if isinstance(col, StringColumn):
+                col.close()
+        self.cache = {}
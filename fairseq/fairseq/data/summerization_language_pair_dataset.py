@@ -79,6 +79,8 @@ class SummerizationLanguagePairDataset(FairseqDataset):
         input_feeding (bool, optional): create a shifted version of the targets
             to be passed into the model for input feeding/teacher forcing.
             Default: ``True``
+        max_doc_len (int, optional): truncate source documents to this many
+            tokens. Default: ``400``
     """
 
     def __init__(
@@ -86,7 +88,7 @@ class SummerizationLanguagePairDataset(FairseqDataset):
         tgt=None, tgt_sizes=None, tgt_dict=None,
         left_pad_source=True, left_pad_target=False,
         max_source_positions=512, max_target_positions=512, with_target=True,
-        shuffle=True, input_feeding=True,
+        shuffle=True, input_feeding=True, max_doc_len=400,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -104,11 +106,12 @@ class SummerizationLanguagePairDataset(FairseqDataset):
         self.with_target = with_target
         self.shuffle = shuffle
         self.input_feeding = input_feeding
+        self.max_doc_len = max_doc_len
 
     def __getitem__(self, index):
         src = self.src[index]
-        if len(src) > 400:
-            src = src[:400]
+        if len(src) > self.max_doc_len:
+            src = src[:self.max_doc_len]
         doc = torch.LongTensor([self.src_dict.cls()] + src.tolist() + [self.src_dict.sep()])
         segment_doc = doc.new(len(doc)).fill_(0)
         target_doc = doc.new(len(doc)).fill_(self.src_dict.pad())
@@ -196,11 +199,16 @@ class SummerizationLanguagePairDataset(FairseqDataset):
     def num_tokens(self, index):
         """Return the number of tokens in a sample. This value is used to
         enforce ``--max-tokens`` during batching."""
+        if not self.with_target:
+            # only the truncated document and its [CLS] and [SEP] are fed in
+            return min(self.src_sizes[index], self.max_doc_len) + 2
         return max(self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
 
     def size(self, index):
         """Return an example's size as a float or tuple. This value is used when
         filtering a dataset with ``--max-positions``."""
+        if not self.with_target:
+            return (min(self.src_sizes[index], self.max_doc_len) + 2, 0)
         return (self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
 
     def ordered_indices(self):
@@ -573,6 +573,25 @@ class ShuffleTransformerDecoder(FairseqIncrementalDecoder):
                     self_attn_mask=dec_mask,  self_attn_padding_mask=padding_mask,
                 )
                 assert not torch.isnan(x_dec).any()
+        x_dec = self.output_layer(x_dec)
+
+        assert not torch.isnan(x_dec).any()
+        assert x_dec.size() == (bsz, num_words, x_dec.size(2))
+        # Cut off dummy initial token
+        x_dec = x_dec.narrow(1, 1, x_dec.size(1) - 1)
+        if apply_mask:
+            target = target[:,1:]
+        assert x_dec.size() == (bsz, num_words-1, x_dec.size(2))
+        if target is not None:
+            assert target.size()== (bsz, num_words-1)
+#        if self.sentence_projection_layer:
+#            sentence_rep = self.sentence_projection_layer(sentence_rep)
+
+        return x_dec, {'attn': attn, 'target':target} #, 'inner_states': inner_states}
+
+    def output_layer(self, x_dec):
+        """Project decoder states of shape `(tgt_len, batch, embed_dim)` to
+        outputs of shape `(batch, tgt_len, vocab)`."""
         if self.normalize:
             x_dec = self.layer_norm(x_dec)
 
@@ -589,20 +608,163 @@ class ShuffleTransformerDecoder(FairseqIncrementalDecoder):
                     x_dec = F.linear(x_dec, self.embed_tokens.weight)
                 else:
                     x_dec = F.linear(x_dec, self.embed_out)
+        return x_dec
 
-        assert not torch.isnan(x_dec).any()
-        assert x_dec.size() == (bsz, num_words, x_dec.size(2))
-        # Cut off dummy initial token
-        x_dec = x_dec.narrow(1, 1, x_dec.size(1) - 1)
-        if apply_mask:
-            target = target[:,1:]
-        assert x_dec.size() == (bsz, num_words-1, x_dec.size(2))
-        if target is not None:
-            assert target.size()== (bsz, num_words-1)
-#        if self.sentence_projection_layer:
-#            sentence_rep = self.sentence_projection_layer(sentence_rep)
+    def key_value_layer(self, level):
+        """Layer whose projections give the keys and values at *level*.
 
-        return x_dec, {'attn': attn, 'target':target} #, 'inner_states': inner_states}
+        Level 0 is the input to the first encoder layer and level i + 1 the
+        output of encoder layer i. Without a stacked decoder, encoder layer i
+        attends to level i and decoder layer i to level i + 1; with one, every
+        layer projects its own input and the decoder attends to the last level.
+        """
+        if self.stacked_decoder:
+            return self.encoder_layers[min(level, len(self.encoder_layers) - 1)]
+        return self.encoder_layers[max(level - 1, 0)]
+
+    def forward_incremental(self, tokens, segment_labels, incremental_state):
+        """Predict the last position of *tokens*, reusing the keys and values
+        cached in *incremental_state* for the positions before it.
+
+        Assumes the masks of FTSummerization.generate_mask: every position
+        sees all document (segment 0) positions and the summary positions up to
+        itself, so the encoder states of earlier positions never change as
+        tokens are appended and only the new positions need to be encoded.
+
+        Positions only count non-padding tokens, so rows of a batch may pad
+        their document before the summary starts. The first call encodes the
+        document at once and must only be padded at the end.
+
+        Args:
+            tokens (LongTensor): document and summary so far, ending in a
+                placeholder for the token to predict, of shape `(batch, len)`
+            segment_labels (LongTensor): segments of *tokens*
+            incremental_state (dict): cache, filled on the first call
+
+        Returns:
+            tuple:
+                - the output for the last position of shape `(batch, 1, vocab)`
+                - a dict with ``'attn'`` set to ``None``
+        """
+        tokens = torch.cat([tokens.new(tokens.size(0), 1).fill_(2), tokens], dim=1)
+        segment_labels = torch.cat([segment_labels.new(segment_labels.size(0), 1).fill_(0), segment_labels], dim=1)
+        bsz, num_words = tokens.size()
+        assert num_words <= self.max_positions, 'incremental decoding needs at most {} positions'.format(self.max_positions)
+
+        num_levels = len(self.encoder_layers) + 1
+        cache = utils.get_incremental_state(self, incremental_state, 'cache')
+        if cache is None:
+            cache = {
+                'keys': [None] * num_levels,
+                'values': [None] * num_levels,
+                'padding_mask': tokens[:, :0].eq(self.padding_idx),
+            }
+        start, end = cache['padding_mask'].size(1), num_words - 1
+        assert start < end, 'expected new tokens since the last step'
+
+        # index of each token among the non-padding tokens of its row
+        padding = tokens.eq(self.padding_idx)
+        slots = torch.cumsum(1 - padding.long(), dim=1) - 1
+        positions = (
+            F.embedding(
+                (slots + self.padding_idx + 1).masked_fill(padding, self.padding_idx),
+                self.embed_positions.weight, self.padding_idx,
+            )
+            if self.embed_positions is not None
+            else None
+        )
+        segment_embeddings = (
+            self.embed_segment(segment_labels.long())
+            if self.embed_segment is not None
+            else None
+        )
+
+        # encode positions start to end - 1 and cache their keys and values
+        x_enc = self.embed_tokens(tokens[:, start:end])
+        if positions is not None:
+            x_enc = x_enc + positions[:, start:end]
+        if segment_embeddings is not None:
+            x_enc = x_enc + segment_embeddings[:, start:end]
+        if self.project_in_dim is not None:
+            x_enc = self.project_in_dim(x_enc)
+        x_enc = F.dropout(x_enc, p=self.dropout, training=self.training)
+        x_enc = x_enc.transpose(0, 1)
+
+        padding_mask = torch.cat([cache['padding_mask'], padding[:, start:end]], dim=1)
+        if end - start > 1:
+            key_idxs = torch.arange(end, device=tokens.device)
+            query_idxs = torch.arange(start, end, device=tokens.device)
+            hidden = segment_labels[:, :end].ne(0).unsqueeze(1) & (key_idxs.view(1, 1, -1) > query_idxs.view(1, -1, 1))
+            enc_mask = x_enc.new(bsz, end - start, end).fill_(0).masked_fill_(hidden, float('-inf'))
+        else:
+            # a single new position sees every earlier one
+            enc_mask = None
+        if self.sinusoidal_relative_positions is not None:
+            # single positions look up their relative positions per row
+            key_slots = slots[:, :end].unsqueeze(1)
+            if end - start > 1:
+                enc_relative_positions = self.sinusoidal_relative_positions[start:end, :end]
+            else:
+                enc_relative_positions = self.sinusoidal_relative_positions[slots[:, start:end].unsqueeze(2), key_slots]
+            dec_relative_positions = self.sinusoidal_relative_positions[slots[:, end:].unsqueeze(2), key_slots]
+        else:
+            enc_relative_positions = dec_relative_positions = None
+
+        keys, values = [], []
+        for level in range(num_levels):
+            layer = self.key_value_layer(level)
+            x_enc_normed = layer.maybe_layer_norm(layer.self_attn_layer_norm, x_enc, before=True)
+            if level < num_levels - 1:
+                queries_enc, new_keys, new_values = layer.self_attn.in_proj_qkv(x_enc_normed)
+            else:
+                new_keys, new_values = layer.self_attn.in_proj_kv(x_enc_normed)
+            if cache['keys'][level] is not None:
+                new_keys = torch.cat([cache['keys'][level], new_keys], dim=0)
+                new_values = torch.cat([cache['values'][level], new_values], dim=0)
+            keys.append(new_keys)
+            values.append(new_values)
+            if level < num_levels - 1:
+                x_enc, _ = self.encoder_layers[level](
+                    new_keys, new_values, queries_enc, x_enc, enc_relative_positions,
+                    self_attn_mask=enc_mask, self_attn_padding_mask=padding_mask,
+                )
+        cache = {'keys': keys, 'values': values, 'padding_mask': padding_mask}
+        utils.set_incremental_state(self, incremental_state, 'cache', cache)
+
+        # predict the last position from the cached keys and values
+        if self.noise:
+            x_dec = self.embed_tokens(tokens.new(bsz, 1).fill_(self.prediction_word))
+        else:
+            x_dec = self.prediction_word_embedding.expand(bsz, 1, x_enc.size(2))
+        if positions is not None:
+            x_dec = x_dec + positions[:, end:]
+        if segment_embeddings is not None:
+            x_dec = x_dec + segment_embeddings[:, end:]
+        x_dec = F.dropout(x_dec, p=self.dropout, training=self.training)
+        x_dec = x_dec.transpose(0, 1)
+
+        for i, dec_layer in enumerate(self.decoder_layers):
+            level = num_levels - 1 if self.stacked_decoder else i + 1
+            queries_dec = dec_layer.self_attn.in_proj_q(
+                dec_layer.maybe_layer_norm(dec_layer.self_attn_layer_norm, x_dec, before=True))
+            x_dec, _ = dec_layer(
+                keys[level], values[level], queries_dec, x_dec, dec_relative_positions,
+                self_attn_padding_mask=padding_mask,
+            )
+
+        return self.output_layer(x_dec), {'attn': None}
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        """Reorder the cached keys and values according to *new_order*."""
+        cache = utils.get_incremental_state(self, incremental_state, 'cache')
+        if cache is None:
+            return
+        cache = {
+            'keys': [keys.index_select(1, new_order) for keys in cache['keys']],
+            'values': [values.index_select(1, new_order) for values in cache['values']],
+            'padding_mask': cache['padding_mask'].index_select(0, new_order),
+        }
+        utils.set_incremental_state(self, incremental_state, 'cache', cache)
 
     def max_positions(self):
         """Maximum output length supported by the decoder."""
@@ -930,21 +1092,23 @@ class MultiheadAttention(nn.Module):
         """Input shape: Time x Batch x Channel
 
         Self-attention can be implemented by passing in the same arguments for
-        query, key and value. Timesteps can be masked by supplying a T x T mask in the
-        `attn_mask` argument. Padding elements can be excluded from
+        query, key and value. The query can be shorter than the key when only
+        the last timesteps are computed, e.g. during incremental decoding.
+        Timesteps can be masked by supplying a T x S mask in the
+        `attn_mask` argument. `relative_position_keys` are either shared across
+        the batch (T x S x head_dim) or given per element (B x T x S x head_dim). Padding elements can be excluded from
         the key by passing a binary ByteTensor (`key_padding_mask`) with shape:
         batch x src_len, where padding elements are indicated by 1s.
         """
 
-        tgt_len, bsz, embed_dim = key.size()
+        tgt_len, bsz, embed_dim = query.size()
         assert embed_dim == self.embed_dim
-        assert list(query.size()) == [tgt_len, bsz, embed_dim]
+        assert list(key.size()[1:]) == [bsz, embed_dim]
         assert key.size() == value.size()
         assert not torch.isnan(key).any()
         assert not torch.isnan(value).any()
         assert not torch.isnan(query).any()
         query *= self.scaling
-        query = query.expand_as(key)
         assert not torch.isnan(query).any()
 
         if self.bias_k is not None:
@@ -990,7 +1154,14 @@ class MultiheadAttention(nn.Module):
             ).type_as(attn_weights)  # FP16 support: cast to float and back
             attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
 
-        if relative_position_keys is not None:
+        if relative_position_keys is not None and relative_position_keys.dim() == 4:
+            # separate relative positions for each batch element
+            # batch * heads * from * dim, batch * from * to * dim --> batch * heads * from * to
+            relative_position_weights = torch.einsum('bhfd,bftd->bhft', [
+                query.view(bsz, self.num_heads, tgt_len, self.head_dim).float(),
+                relative_position_keys.float()]).reshape(bsz * self.num_heads, tgt_len, src_len).type_as(attn_weights)
+            attn_weights += relative_position_weights
+        elif relative_position_keys is not None:
             # batch * from * dim, from * to * dim --> batch * from * to
             relative_position_weights = torch.einsum('bfd,ftd->bft', [query.float(), relative_position_keys.float()]).type_as(attn_weights)
             assert relative_position_weights.size() == (bsz * self.num_heads, tgt_len, src_len)
@@ -1006,7 +1177,12 @@ class MultiheadAttention(nn.Module):
         attn = torch.bmm(attn_weights, value)
         assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
 
-        if relative_position_keys is not None:
+        if relative_position_keys is not None and relative_position_keys.dim() == 4:
+            relative_position_vals = torch.einsum('bhft,bftd->bhfd', [
+                attn_weights.view(bsz, self.num_heads, tgt_len, src_len).float(),
+                relative_position_keys.float()]).reshape(bsz * self.num_heads, tgt_len, self.head_dim).type_as(attn_weights)
+            attn = attn + relative_position_vals
+        elif relative_position_keys is not None:
             relative_position_vals = torch.einsum('bft,ftd->bfd', [attn_weights.float(),
                                                                    relative_position_keys.float()]).type_as(attn_weights)
             attn = attn + relative_position_vals
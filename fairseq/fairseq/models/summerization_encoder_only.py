@@ -51,11 +51,18 @@ class FTSummerization(BaseFairseqModel):
         super().__init__()
         self.pretrain_model = pretrain_model
 
-    def forward(self, source, segment):
+    def forward(self, source, segment, incremental_state=None):
+        if incremental_state is not None:
+            # only the last position, attending to cached keys and values
+            x, _ = self.pretrain_model.decoder.forward_incremental(source, segment, incremental_state)
+            return x
         enc_mask, dec_mask = self.generate_mask(segment)
         x, _ = self.pretrain_model(source, segment, apply_mask=False, mask=(enc_mask, dec_mask))
         return x
 
+    def reorder_incremental_state(self, incremental_state, new_order):
+        self.pretrain_model.decoder.reorder_incremental_state(incremental_state, new_order)
+
     def max_decoder_positions(self):
         return self.pretrain_model.decoder.max_positions
 
@@ -309,6 +309,13 @@ def add_generation_args(parser):
                              'where x is the source length'))
     group.add_argument('--min-len', default=1, type=float, metavar='N',
                        help=('minimum generation length'))
+    group.add_argument('--strict-min-len', action='store_true',
+                       help='prevent EOS and stop symbols before --min-len instead '
+                            'of dropping the hypotheses that end too early')
+    group.add_argument('--stop-symbols', nargs='+', default=None, metavar='SYM',
+                       help='dictionary symbols that end a hypothesis like EOS')
+    group.add_argument('--no-repeat-hypos', action='store_true',
+                       help='don\'t output the same hypothesis twice for an input')
     group.add_argument('--no-early-stop', action='store_true',
                        help=('continue searching even after finalizing k=beam '
                              'hypotheses; this is more correct, but increases '
@@ -317,6 +324,9 @@ def add_generation_args(parser):
                        help='compare unnormalized hypothesis scores')
     group.add_argument('--no-beamable-mm', action='store_true',
                        help='don\'t use BeamableMM in attention layers')
+    group.add_argument('--no-incremental-decoding', action='store_true',
+                       help='recompute every position at each step instead of '
+                            'caching keys and values of earlier positions')
     group.add_argument('--lenpen', default=1, type=float,
                        help='length penalty: <1.0 favors shorter, >1.0 favors longer sentences')
     group.add_argument('--unkpen', default=0, type=float,
@@ -19,7 +19,8 @@ class SequenceGenerator(object):
         self, models, tgt_dict, beam_size=1, minlen=1, maxlen=None, stop_early=True,
         normalize_scores=True, len_penalty=1, unk_penalty=0, retain_dropout=False,
         sampling=False, sampling_topk=-1, sampling_temperature=1,
-        diverse_beam_groups=-1, diverse_beam_strength=0.5,
+        diverse_beam_groups=-1, diverse_beam_strength=0.5, incremental=True,
+        stop_symbols=None, no_repeat_hypos=False, strict_minlen=False,
     ):
         """Generates translations of a given source sentence.
         Args:
@@ -29,6 +30,16 @@ class SequenceGenerator(object):
                 hypotheses, even though longer hypotheses might have better
                 normalized scores.
             normalize_scores: Normalize scores by the length of the output.
+            incremental: Cache the keys and values of earlier positions for
+                models that support it, so each step only encodes the newest
+                token.
+            stop_symbols: Indices of symbols that end a hypothesis like EOS,
+                e.g. a question mark. The symbol is kept as the last token.
+            no_repeat_hypos: Don't finalize a hypothesis that repeats one
+                already finalized for the same input, counting hypotheses
+                that only differ in their final EOS or stop symbol as repeats.
+            strict_minlen: Prevent EOS and stop symbols before minlen instead
+                of dropping the hypotheses that end too early.
         """
         self.models = models
         self.pad = tgt_dict.pad()
@@ -45,6 +56,10 @@ class SequenceGenerator(object):
         self.len_penalty = len_penalty
         self.unk_penalty = unk_penalty
         self.retain_dropout = retain_dropout
+        self.incremental = incremental
+        self.stop_symbols = torch.LongTensor(stop_symbols or [])
+        self.no_repeat_hypos = no_repeat_hypos
+        self.strict_minlen = strict_minlen
 
         assert sampling_topk < 0 or sampling, '--sampling-topk requires --sampling'
 
@@ -130,15 +145,11 @@ class SequenceGenerator(object):
 
         encoder_outs = []
         incremental_states = {}
+        incremental = self.incremental and all(hasattr(m, 'reorder_incremental_state') for m in self.models)
         for model in self.models:
             if not self.retain_dropout:
                 model.eval()
-            if isinstance(model, FairseqIncrementalDecoder):
-            #if isinstance(model, FairseqIncrementalDecoder) or \
-            #    (hasattr(model, "pretrain_model") and isinstance(model.pretrain_model.decoder, FairseqIncrementalDecoder)):
-                incremental_states[model] = {}
-            else:
-                incremental_states[model] = None
+            incremental_states[model] = {} if incremental else None
 
         """    # compute the encoder output for each beam
             encoder_out = model(**encoder_input)
@@ -157,10 +168,16 @@ class SequenceGenerator(object):
         #tokens[:, 0] = self.eos
         attn, attn_buf = None, None
         nonpad_idxs = None
-        # list of completed sentences
-        finalized = [[] for i in range(bsz)]
-        finished = [False for i in range(bsz)]
-        worst_finalized = [{'idx': None, 'score': -math.inf} for i in range(bsz)]
+        # completed hypotheses, kept as batched tensors until the end
+        finalized_chunks = []
+        finalized_hashes = []
+        num_finalized = tokens.new(bsz).fill_(0)
+        finished = tokens.new(bsz).fill_(0)
+        # best beam_size finalized scores of each sentence, only needed without stop_early
+        best_finalized_scores = scores.new(bsz, beam_size).fill_(-math.inf)
+        # original index of each remaining sentence
+        sent_idxs = torch.arange(bsz).type_as(tokens)
+        orig_bsz = bsz
         num_remaining_sent = bsz
 
         # number of candidate hypos per step
@@ -178,26 +195,7 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
-        def is_finished(sent, step, unfinalized_scores=None):
-            """
-            Check whether we've finished generation for a given sentence, by
-            comparing the worst score among finalized hypotheses to the best
-            possible score among unfinalized hypotheses.
-            """
-            assert len(finalized[sent]) <= beam_size
-            if len(finalized[sent]) == beam_size:
-                if self.stop_early or step == maxlen or unfinalized_scores is None:
-                    return True
-                # stop if the best unfinalized score is worse than the worst
-                # finalized one
-                best_unfinalized_score = unfinalized_scores[sent].max()
-                if self.normalize_scores:
-                    best_unfinalized_score /= maxlen ** self.len_penalty
-                if worst_finalized[sent]['score'] >= best_unfinalized_score:
-                    return True
-            return False
-
-        def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None):
+        def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None, end_tokens=None):
             """
             Finalize the given hypotheses at this step, while keeping the total
             number of finalized hypotheses per sentence <= beam_size.
@@ -212,13 +210,18 @@ class SequenceGenerator(object):
                     scores for each hypothesis
                 unfinalized_scores: A vector containing scores for all
                     unfinalized hypotheses
+                end_tokens: A vector of the same size as bbsz_idx containing
+                    the last token of each hypothesis, EOS by default
+            Returns:
+                the indices, among the remaining sentences, of the sentences
+                that are now finished
             """
             assert bbsz_idx.numel() == eos_scores.numel()
 
             # clone relevant token and attention tensors
             tokens_clone = tokens.index_select(0, bbsz_idx)
             tokens_clone = tokens_clone[:, :step + 1]  # skip the first index, which is EOS
-            tokens_clone[:, step] = self.eos
+            tokens_clone[:, step] = self.eos if end_tokens is None else end_tokens
             attn_clone = attn.index_select(0, bbsz_idx)[:, :, :step+1] if attn is not None else None
 
             # compute scores per token position
@@ -228,69 +231,81 @@ class SequenceGenerator(object):
             pos_scores[:, 1:] = pos_scores[:, 1:] - pos_scores[:, :-1]
 
             # normalize sentence-level scores
+            eos_scores = eos_scores.clone()
             if self.normalize_scores:
                 eos_scores /= (step + 1) ** self.len_penalty
 
-            cum_unfin = []
-            prev = 0
-            for f in finished:
-                if f:
-                    prev += 1
-                else:
-                    cum_unfin.append(prev)
-
-            sents_seen = set()
-            for i, (idx, score) in enumerate(zip(bbsz_idx.tolist(), eos_scores.tolist())):
-                unfin_idx = idx // beam_size
-                sent = unfin_idx + cum_unfin[unfin_idx]
-
-                sents_seen.add((sent, unfin_idx))
-
-                def get_hypo():
-
-                    if attn_clone is not None:
-                        # remove padding tokens from attn scores
-                        hypo_attn = attn_clone[i][nonpad_idxs[sent]]
-                        _, alignment = hypo_attn.max(dim=0)
-                    else:
-                        hypo_attn = None
-                        alignment = None
-
-                    return {
-                        'tokens': tokens_clone[i],
-                        'score': score,
-                        'attention': hypo_attn,  # src_len x tgt_len
-                        'alignment': alignment,
-                        'positional_scores': pos_scores[i],
-                    }
-
-                if len(finalized[sent]) < beam_size:
-                    finalized[sent].append(get_hypo())
-                elif not self.stop_early and score > worst_finalized[sent]['score']:
-                    # replace worst hypo for this sentence with new/better one
-                    worst_idx = worst_finalized[sent]['idx']
-                    if worst_idx is not None:
-                        finalized[sent][worst_idx] = get_hypo()
-
-                    # find new worst finalized hypo for this sentence
-                    idx, s = min(enumerate(finalized[sent]), key=lambda r: r[1]['score'])
-                    worst_finalized[sent] = {
-                        'score': s['score'],
-                        'idx': idx,
-                    }
-
-            newly_finished = []
-            for sent, unfin_idx in sents_seen:
-                # check termination conditions for this sentence
-                if not finished[sent] and is_finished(sent, step, unfinalized_scores):
-                    finished[sent] = True
-                    newly_finished.append(unfin_idx)
+            unfin_idx = seen_idx = bbsz_idx // beam_size
+            if self.no_repeat_hypos:
+                # drop repeats of hypotheses finalized before or earlier in this call
+                hashes = self._hash_hypos(tokens_clone)
+                sent = sent_idxs.index_select(0, unfin_idx)
+                same_sent = sent.unsqueeze(1).eq(sent.unsqueeze(0))
+                same_hash = hashes.unsqueeze(1).eq(hashes.unsqueeze(0)).all(dim=-1)
+                earlier = torch.ones_like(same_sent).tril(-1)
+                is_repeat = (same_sent & same_hash & earlier).any(dim=1)
+                if len(finalized_hashes) > 0:
+                    prev_sents = torch.cat([sents for sents, _ in finalized_hashes])
+                    prev_hashes = torch.cat([hashes for _, hashes in finalized_hashes])
+                    same_sent = sent.unsqueeze(1).eq(prev_sents.unsqueeze(0))
+                    same_hash = hashes.unsqueeze(1).eq(prev_hashes.unsqueeze(0)).all(dim=-1)
+                    is_repeat = is_repeat | (same_sent & same_hash).any(dim=1)
+                keep = is_repeat.eq(0).nonzero().squeeze(-1)
+                unfin_idx, hashes, tokens_clone, pos_scores, eos_scores = (
+                    t.index_select(0, keep) for t in (unfin_idx, hashes, tokens_clone, pos_scores, eos_scores))
+                attn_clone = attn_clone.index_select(0, keep) if attn_clone is not None else None
+
+            # rank of each hypothesis among the ones of its sentence
+            sent_mask = unfin_idx.unsqueeze(1).eq(torch.arange(bsz).type_as(unfin_idx).unsqueeze(0)).long()
+            rank = (sent_mask.cumsum(dim=0) * sent_mask).sum(dim=1) - 1
+            sent = sent_idxs.index_select(0, unfin_idx)
+
+            if self.stop_early:
+                # keep the first hypotheses of each sentence until it has beam_size
+                keep = (num_finalized.index_select(0, sent) + rank).lt(beam_size).nonzero().squeeze(-1)
+                sent, tokens_clone, pos_scores, eos_scores = (
+                    t.index_select(0, keep) for t in (sent, tokens_clone, pos_scores, eos_scores))
+                attn_clone = attn_clone.index_select(0, keep) if attn_clone is not None else None
+                if self.no_repeat_hypos:
+                    hashes = hashes.index_select(0, keep)
+            elif unfin_idx.numel() > 0:
+                # keep the best beam_size scores of each sentence to compare against
+                new_scores = eos_scores.new(bsz, int(rank.max()) + 1).fill_(-math.inf)
+                new_scores[unfin_idx, rank] = eos_scores
+                best_scores = torch.cat([best_finalized_scores.index_select(0, sent_idxs), new_scores], dim=1)
+                best_finalized_scores[sent_idxs] = best_scores.topk(beam_size, dim=1)[0]
+            finalized_chunks.append((sent, tokens_clone, pos_scores, eos_scores, attn_clone))
+            if self.no_repeat_hypos:
+                finalized_hashes.append((sent, hashes))
+            num_finalized.index_add_(0, sent, torch.ones_like(sent))
+            num_finalized.clamp_(max=beam_size)
+
+            # check termination conditions for the sentences seen
+            seen = torch.unique(seen_idx)
+            seen_sents = sent_idxs.index_select(0, seen)
+            is_finished = finished.index_select(0, seen_sents).eq(0)
+            if step < maxlen:
+                # with repeats dropped, sentences can end with fewer hypotheses at maxlen
+                is_finished = is_finished & num_finalized.index_select(0, seen_sents).eq(beam_size)
+            if not (self.stop_early or step == maxlen or unfinalized_scores is None):
+                # stop if the best unfinalized score is worse than the worst
+                # finalized one
+                best_unfinalized_scores = unfinalized_scores.index_select(0, seen).max(dim=1)[0]
+                if self.normalize_scores:
+                    best_unfinalized_scores /= maxlen ** self.len_penalty
+                worst_finalized_scores = best_finalized_scores.index_select(0, seen_sents)[:, -1]
+                is_finished = is_finished & worst_finalized_scores.ge(best_unfinalized_scores)
+            newly_finished = seen[is_finished.nonzero().squeeze(-1)]
+            finished[sent_idxs.index_select(0, newly_finished)] = 1
             return newly_finished
 
+        def expand_to_beams(t):
+            return t.unsqueeze(1).expand(-1, beam_size, -1).contiguous().view(-1, t.size(-1))
+
         reorder_state = None
         batch_idxs = None
-        #src_tokens = src_tokens.squeeze(0).expand(beam_size, -1, -1).contiguous().view(bsz * beam_size,-1)
-        #segment = segment.squeeze(0).expand(beam_size, -1, -1).contiguous().view(bsz * beam_size,-1)
+        max_src_len = int(src_tokens.ne(self.pad).long().sum(1).max())
+        beam_src_tokens, beam_segment = expand_to_beams(src_tokens), expand_to_beams(segment)
         for step in range(maxlen + 1):  # one extra step for EOS marker
             # reorder decoder internal states based on the prev choice of beams
             if reorder_state is not None:
@@ -298,18 +313,51 @@ class SequenceGenerator(object):
                     # update beam indices to take into account removed sentences
                     corr = batch_idxs - torch.arange(batch_idxs.numel()).type_as(batch_idxs)
                     reorder_state.view(-1, beam_size).add_(corr.unsqueeze(-1) * beam_size)
+                for model in self.models:
+                    if incremental_states[model] is not None:
+                        model.reorder_incremental_state(incremental_states[model], reorder_state)
 
             # check for max position
-            if step + src_tokens.size(1) > 511:
-                model_input = torch.cat([src_tokens.expand(tokens.size(0), src_tokens.size(1))[:, :511-step], tokens[:, :step + 1]], dim=-1)
-                segment_input = torch.cat([segment.expand(tokens.size(0),segment.size(1))[:, :511-step], segment_2[:tokens.size(0), :step + 1]], dim=-1)
+            if incremental and step + max_src_len > 511:
+                # the source gets truncated, so cached positions are stale
+                incremental = False
+                incremental_states = {model: None for model in self.models}
+            last_idxs = None
+            if incremental and step == 0:
+                # all beams of a sentence start out the same, so encode its
+                # source once and copy the cached states to the other beams
+                model_input = torch.cat([src_tokens, tokens[::beam_size, :1]], dim=-1)
+                segment_input = torch.cat([segment, segment_2[::beam_size, :1]], dim=-1)
+            elif incremental:
+                model_input = torch.cat([beam_src_tokens, tokens[:, :step + 1]], dim=-1)
+                segment_input = torch.cat([beam_segment, segment_2[:tokens.size(0), :step + 1]], dim=-1)
             else:
-                model_input = torch.cat([src_tokens.expand(tokens.size(0), src_tokens.size(1)), tokens[:, :step + 1]], dim=-1)
-                segment_input = torch.cat([segment.expand(tokens.size(0),segment.size(1)), segment_2[:tokens.size(0), :step + 1]], dim=-1)
-            lprobs, avg_attn_scores = self._decode(model_input, segment_input, incremental_states)
+                model_input, segment_input, last_idxs = self._append_to_source(
+                    beam_src_tokens, beam_segment, tokens[:, :step + 1], segment_2[:tokens.size(0), :step + 1],
+                    max_src_len=511 - step,
+                )
+            lprobs, avg_attn_scores = self._decode(model_input, segment_input, incremental_states, last_idxs)
+            if incremental and step == 0:
+                new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1).to(src_tokens.device)
+                lprobs = lprobs.index_select(0, new_order)
+                for model in self.models:
+                    model.reorder_incremental_state(incremental_states[model], new_order)
 
             lprobs[:, self.pad] = -math.inf  # never select pad
             lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+            if self.strict_minlen and step < self.minlen:
+                # don't end hypotheses before minlen
+                lprobs[:, self.eos] = -math.inf
+                if self.stop_symbols.numel() > 0:
+                    lprobs[:, self.stop_symbols.to(lprobs.device)] = -math.inf
+            if self.stop_symbols.numel() > 0:
+                # only keep the most likely way to end each hypothesis, so that as with
+                # EOS alone, at most half of the 2 x beam_size candidates are ends
+                end_symbols = torch.cat([self.stop_symbols.new([self.eos]), self.stop_symbols]).to(lprobs.device)
+                end_lprobs = lprobs[:, end_symbols]
+                best_end = end_lprobs.max(dim=1, keepdim=True)[1]
+                lprobs[:, end_symbols] = -math.inf
+                lprobs.scatter_(1, end_symbols[best_end], end_lprobs.gather(1, best_end))
 
             # Record attention scores
             if avg_attn_scores is not None:
@@ -360,9 +408,9 @@ class SequenceGenerator(object):
             cand_bbsz_idx = cand_beams.add(bbsz_offsets)
 
             # finalize hypotheses that end in eos
-            eos_mask = cand_indices.eq(self.eos)
+            eos_mask = self._ends_hypo(cand_indices)
 
-            finalized_sents = set()
+            finalized_sents = []
             if step >= self.minlen:
                 # only consider eos when it's among the top beam_size indices
                 torch.masked_select(
@@ -376,8 +424,14 @@ class SequenceGenerator(object):
                         mask=eos_mask[:, :beam_size],
                         out=eos_scores,
                     )
+                    end_tokens = None
+                    if self.stop_symbols.numel() > 0:
+                        end_tokens = torch.masked_select(
+                            cand_indices[:, :beam_size],
+                            mask=eos_mask[:, :beam_size],
+                        )
                     finalized_sents = finalize_hypos(
-                        step, eos_bbsz_idx, eos_scores, cand_scores)
+                        step, eos_bbsz_idx, eos_scores, cand_scores, end_tokens)
                     num_remaining_sent -= len(finalized_sents)
 
             assert num_remaining_sent >= 0
@@ -390,7 +444,7 @@ class SequenceGenerator(object):
 
                 # construct batch_idxs which holds indices of batches to keep for the next pass
                 batch_mask = cand_indices.new_ones(bsz)
-                batch_mask[cand_indices.new(finalized_sents)] = 0
+                batch_mask[finalized_sents] = 0
                 batch_idxs = batch_mask.nonzero().squeeze(-1)
 
                 eos_mask = eos_mask[batch_idxs]
@@ -402,6 +456,10 @@ class SequenceGenerator(object):
                 cand_indices = cand_indices[batch_idxs]
                 if prefix_tokens is not None:
                     prefix_tokens = prefix_tokens[batch_idxs]
+                src_tokens = src_tokens[batch_idxs]
+                segment = segment[batch_idxs]
+                sent_idxs = sent_idxs[batch_idxs]
+                beam_src_tokens, beam_segment = expand_to_beams(src_tokens), expand_to_beams(segment)
 
                 scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
                 scores_buf.resize_as_(scores)
@@ -480,20 +538,80 @@ class SequenceGenerator(object):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
-        # sort by score descending
+        # gather the hypotheses of each sentence
+        finalized = [[] for i in range(orig_bsz)]
+        for sents, tokens_clone, pos_scores, eos_scores, attn_clone in finalized_chunks:
+            for i, (sent, score) in enumerate(zip(sents.tolist(), eos_scores.tolist())):
+                if attn_clone is not None:
+                    # remove padding tokens from attn scores
+                    hypo_attn = attn_clone[i][nonpad_idxs[sent]]
+                    _, alignment = hypo_attn.max(dim=0)
+                else:
+                    hypo_attn = None
+                    alignment = None
+
+                finalized[sent].append({
+                    'tokens': tokens_clone[i],
+                    'score': score,
+                    'attention': hypo_attn,  # src_len x tgt_len
+                    'alignment': alignment,
+                    'positional_scores': pos_scores[i],
+                })
+
+        # sort by score descending, keeping the earliest of equal hypotheses
         for sent in range(len(finalized)):
-            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
+            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)[:beam_size]
 
         return finalized
 
-    def _decode(self, tokens, segments, incremental_states):
+    def _ends_hypo(self, indices):
+        """Mask of the *indices* that end a hypothesis, i.e. EOS or a stop symbol"""
+        ends = indices.eq(self.eos)
+        for symbol in self.stop_symbols.tolist():
+            ends = ends | indices.eq(symbol)
+        return ends
+
+    def _hash_hypos(self, hypos):
+        """Fingerprint each row of *hypos* by its length and two polynomial
+        hashes, ignoring the final (EOS or stop) token."""
+        length = hypos.size(1)
+        hypos = hypos.clone()
+        hypos[:, -1] = self.eos
+        hashes = [hypos.new(hypos.size(0)).fill_(length)]
+        for base, modulus in [(31337, 2 ** 31 - 1), (1000003, 10 ** 9 + 7)]:
+            powers = [pow(base, i, modulus) for i in range(length)]
+            hashes.append((hypos * hypos.new(powers).unsqueeze(0)).sum(dim=1) % modulus)
+        return torch.stack(hashes, dim=1)
+
+    def _append_to_source(self, src_tokens, src_segment, tokens, segment, max_src_len):
+        """Append *tokens* right after the unpadded part of each (right-padded)
+        source row, truncated to *max_src_len*, so that padding only comes at
+        the end and each row sees the same positions as when decoded alone.
+
+        Returns the model inputs, their segments and the index of the last
+        token of each row.
+        """
+        src_lengths = src_tokens.ne(self.pad).long().sum(1).clamp(max=max_src_len)
+        src_len = int(src_lengths.max())
+        src_padding = torch.arange(src_len).to(src_tokens.device).unsqueeze(0) >= src_lengths.unsqueeze(1)
+        tgt_idxs = src_lengths.unsqueeze(1) + torch.arange(tokens.size(1)).to(src_tokens.device).unsqueeze(0)
+
+        model_input = tokens.new(tokens.size(0), src_len + tokens.size(1)).fill_(self.pad)
+        model_input[:, :src_len] = src_tokens[:, :src_len].masked_fill(src_padding, self.pad)
+        model_input.scatter_(1, tgt_idxs, tokens)
+        segment_input = segment.new(segment.size(0), src_len + segment.size(1)).fill_(self.pad)
+        segment_input[:, :src_len] = src_segment[:, :src_len].masked_fill(src_padding, self.pad)
+        segment_input.scatter_(1, tgt_idxs, segment)
+        return model_input, segment_input, tgt_idxs[:, -1]
+
+    def _decode(self, tokens, segments, incremental_states, last_idxs=None):
         if len(self.models) == 1:
-            return self._decode_one(tokens, self.models[0], segments, incremental_states, log_probs=True)
+            return self._decode_one(tokens, self.models[0], segments, incremental_states, last_idxs, log_probs=True)
 
         log_probs = []
         avg_attn = None
         for model in self.models:
-            probs, attn = self._decode_one(tokens, model, segments, incremental_states, log_probs=True)
+            probs, attn = self._decode_one(tokens, model, segments, incremental_states, last_idxs, log_probs=True)
             log_probs.append(probs)
             if attn is not None:
                 if avg_attn is None:
@@ -505,27 +623,16 @@ class SequenceGenerator(object):
             avg_attn.div_(len(self.models))
         return avg_probs, avg_attn
 
-    def _decode_one(self, tokens, model, segments, incremental_states, log_probs):
+    def _decode_one(self, tokens, model, segments, incremental_states, last_idxs, log_probs):
         with torch.no_grad():
             if incremental_states[model] is not None:
-                #if hasattr(model, "pretrain_model"):
-                #    module = model.pretrain_model.decoder
-                #else:
-                #    module = model.decoder
-                module = model.decoder
-                out = list(module(tokens, segments, incremental_state=incremental_states[model], apply_mask=False))
-                decoder_out = out[0][:, -1, :]
-                attn = out[1]
-                if type(attn) is dict:
-                    attn = attn['attn']
-                if attn is not None:
-                    if type(attn) is dict:
-                        attn = attn['attn']
-                    attn = attn[:, -1, :]
-
+                decoder_out = model(tokens, segments, incremental_state=incremental_states[model])
             else:
                 decoder_out = model(tokens, segments)
+            if last_idxs is not None:
+                decoder_out = decoder_out[torch.arange(decoder_out.size(0)).to(last_idxs.device), last_idxs]
+            else:
                 decoder_out = decoder_out[:, -1, :]
-                attn = None
+            attn = None
         probs = model.get_normalized_probs(decoder_out, log_probs=log_probs)
         return probs, attn
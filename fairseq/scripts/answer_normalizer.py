@@ -0,0 +1,32 @@
+"""
+Answer normalization shared by the QA metrics.
+
+Normalizing is memoized with a bounded LRU cache keyed on the raw answer,
+since the same answers get normalized by every metric that compares them.
+"""
+import re
+import string
+from functools import lru_cache
+
+ARTICLES_RE = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+PUNC_TABLE = str.maketrans('', '', string.punctuation)
+CACHE_SIZE = 2 ** 18
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize(s):
+  """Lower text and remove punctuation, articles and extra whitespace.
+
+  Returns the normalized text and the tuple of its tokens.
+  """
+  toks = tuple(ARTICLES_RE.sub(' ', s.lower().translate(PUNC_TABLE)).split())
+  return ' '.join(toks), toks
+
+
+def normalize_answer(s):
+  """Lower text and remove punctuation, articles and extra whitespace."""
+  return normalize(s)[0]
+
+
+def get_tokens(s):
+  return list(normalize(s)[1])
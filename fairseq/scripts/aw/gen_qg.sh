@@ -14,6 +14,7 @@ function generate() {
     max_len_const=1 # max len is computed as ax + b where x is src len
     max_len_scale=1 # max len is computed as ax + b where x is src len
     beam_width=5
+    max_tokens=4000 # inputs are batched by length up to this many source tokens
     n_hyps=10
     topk=10
     out_dir=${CKPTS}/fairseq/${date}
@@ -27,11 +28,11 @@ function generate() {
     fi
 
     if [ ${sampling} -eq 1 ]; then
-        python fairseq/summerization_generate.py ${data_path} --device-id ${gpu_id} --path ${model_path} --task summerization  --remove-bpe --gen-subset test --batch-size 1 --min-len ${min_len} --max-len-a ${max_len_scale} --max-len-b ${max_len_const} --max-target-positions 8000 --max-source-positions 8000 --beam ${beam_width} --sampling --nbest ${n_hyps} --sampling-topk ${topk} 2>&1 | tee ${out_file}
+        python fairseq/summerization_generate.py ${data_path} --device-id ${gpu_id} --path ${model_path} --task summerization  --remove-bpe --gen-subset test --max-tokens ${max_tokens} --min-len ${min_len} --max-len-a ${max_len_scale} --max-len-b ${max_len_const} --max-target-positions 8000 --max-source-positions 8000 --beam ${beam_width} --sampling --nbest ${n_hyps} --sampling-topk ${topk} 2>&1 | tee ${out_file}
     elif [ ${diverse} -eq 1 ]; then
-        python fairseq/summerization_generate.py ${data_path} --device-id ${gpu_id} --path ${model_path} --task summerization  --remove-bpe --gen-subset test --batch-size 1 --min-len ${min_len} --max-len-a ${max_len_scale} --max-len-b ${max_len_const} --max-target-positions 8000 --max-source-positions 8000 --beam ${beam_width} --diverse-beam-groups 5 --nbest ${n_hyps} 2>&1 | tee ${out_file}
+        python fairseq/summerization_generate.py ${data_path} --device-id ${gpu_id} --path ${model_path} --task summerization  --remove-bpe --gen-subset test --max-tokens ${max_tokens} --min-len ${min_len} --max-len-a ${max_len_scale} --max-len-b ${max_len_const} --max-target-positions 8000 --max-source-positions 8000 --beam ${beam_width} --diverse-beam-groups 5 --nbest ${n_hyps} 2>&1 | tee ${out_file}
     else
-        python fairseq/summerization_generate.py ${data_path} --device-id ${gpu_id} --path ${model_path} --task summerization  --remove-bpe --gen-subset test --batch-size 1 --min-len ${min_len} --max-len-a ${max_len_scale} --max-len-b ${max_len_const} --max-target-positions 8000 --max-source-positions 8000 --beam ${beam_width} --nbest ${n_hyps} 2>&1 | tee ${out_file}
+        python fairseq/summerization_generate.py ${data_path} --device-id ${gpu_id} --path ${model_path} --task summerization  --remove-bpe --gen-subset test --max-tokens ${max_tokens} --min-len ${min_len} --max-len-a ${max_len_scale} --max-len-b ${max_len_const} --max-target-positions 8000 --max-source-positions 8000 --beam ${beam_width} --nbest ${n_hyps} 2>&1 | tee ${out_file}
 
     fi
 }
@@ -14,25 +14,44 @@ import json
 import collections
 import math
 from os import path
-import subprocess
-import tempfile
 import torch
 import sys
 sys.path.append('/private/home/yinhanliu/fairseq-py-huggingface')
 sys.path.append('/private/home/yinhanliu/pytorch-pretrained-BERT')
 from pytorch_pretrained_bert.tokenization import BertTokenizer, whitespace_tokenize, BasicTokenizer
 from fairseq import options, progress_bar, tasks, utils
-
-def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+sys.path.append(path.dirname(path.realpath(__file__)))
+from official_squad_eval import SquadEvaluator
+
+def _get_best_spans(start_logits, end_logits, start_mask, end_mask, n_best_size, max_answer_length=30):
+    """Get the n-best valid spans of each row from a batch of start and end logits.
+
+    As in the original BERT post-processing, only spans made of one of the
+    n_best_size best start indexes and one of the n_best_size best end indexes
+    are considered, and spans cannot end before they start or be longer than
+    max_answer_length.
+
+    Returns (scores, start_indexes, end_indexes), each bsz x n_best_size, where
+    the scores are -inf once a row runs out of valid spans.
+    """
+    bsz, seq_len = start_logits.size()
+    start_logits, end_logits = start_logits.float(), end_logits.float()
+
+    def top_k_mask(logits):
+        best_indexes = logits.topk(min(n_best_size, seq_len), dim=1)[1]
+        return torch.zeros_like(logits).scatter_(1, best_indexes, 1).gt(0)
+
+    start_mask = start_mask & top_k_mask(start_logits)
+    end_mask = end_mask & top_k_mask(end_logits)
+    positions = torch.arange(seq_len, device=start_logits.device)
+    lengths = positions.unsqueeze(0) - positions.unsqueeze(1)  # end - start
+    span_mask = (start_mask.unsqueeze(2) & end_mask.unsqueeze(1)
+                 & lengths.ge(0).unsqueeze(0) & lengths.lt(max_answer_length).unsqueeze(0))
+
+    scores = start_logits.unsqueeze(2) + end_logits.unsqueeze(1)
+    scores = scores.masked_fill(span_mask.eq(0), -math.inf).view(bsz, -1)
+    best_scores, best_spans = scores.topk(min(n_best_size, seq_len * seq_len), dim=1)
+    return best_scores, best_spans // seq_len, best_spans % seq_len
 
 def get_final_text(pred_text, orig_text, verbose_logging=False):
     """Project the tokenized prediction back to the original text."""
@@ -124,29 +143,11 @@ def get_final_text(pred_text, orig_text, verbose_logging=False):
     output_text = orig_text[orig_start_position:(orig_end_position + 1)]
     return output_text
 
-def _compute_softmax(scores):
-    """Compute softmax probability over raw logits."""
-    if not scores:
-        return []
-
-    max_score = None
-    for score in scores:
-        if max_score is None or score > max_score:
-            max_score = score
-
-    exp_scores = []
-    total_sum = 0.0
-    for score in scores:
-        x = math.exp(score - max_score)
-        exp_scores.append(x)
-        total_sum += x
-
-    probs = []
-    for score in exp_scores:
-        probs.append(score / total_sum)
-    return probs
-
-def eval_dataset(task, model, dataset, data_file, args, use_cuda=True):
+def predict_dataset(task, model, dataset, args, use_cuda=True):
+    """Run the model over a SquadDataset and decode the best answer span for each example.
+
+    Returns an OrderedDict mapping SQuAD ids to predicted answer strings.
+    """
     itr = task.get_batch_iterator(
         dataset=dataset,
         max_tokens=args.max_tokens or 4096,
@@ -161,132 +162,73 @@ def eval_dataset(task, model, dataset, data_file, args, use_cuda=True):
     was_training = model.training
     model.eval()
 
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
-
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit", "token_to_orig_map"])
-
-    example_index_to_features = collections.defaultdict(list)
-    total = 0
+    # best span of each example over its features: (score, text, start, end, orig, idx_map, para_start)
+    best_spans = collections.OrderedDict()
     with torch.no_grad(), progress_bar.build_progress_bar(args, itr) as t:
         for batch in t:
             if use_cuda:
                 batch = utils.move_to_cuda(batch)
-            start_res, end_res, _  = model(**batch['net_input'])
-
-            for start_logits, end_logits, id, text, mask, orig, idx_map, token_is_max_context in zip(start_res, end_res, batch['squad_ids'],
-                                                              batch['net_input']['text'],
-                                                              batch['net_input']['paragraph_mask'],
-                                                              batch['actual_txt'],
-                                                              batch['idx_map'],
-                                                              batch['token_is_max_context']):
-                example_index_to_features[id].append((start_logits, end_logits, text, mask, orig, idx_map, token_is_max_context))
-                total += 1
-        for id in example_index_to_features:
-            prelim_predictions = []
-            for span_idx, unique_example in enumerate(example_index_to_features[id]):
-                start_logits, end_logits, text, mask, orig, idx_map, token_is_max_context = unique_example
-                start_indexes = _get_best_indexes(start_logits, args.n_best_size)
-                end_indexes = _get_best_indexes(end_logits, args.n_best_size)
-                token_to_orig_map = {}
-                mnz = mask.nonzero()
-                start_idx = mnz[0]
-                end_idx = mnz[-1]
-                for j in range(start_idx, end_idx+1):
-                    token_to_orig_map[j] = idx_map[j-start_idx]
-                for start_index in start_indexes:
-                    for end_index in end_indexes:
-                        # We could hypothetically create invalid predictions, e.g., predict
-                        # that the start of the span is in the question. We throw out all
-                        # invalid predictions.
-                        if start_index >= len(text) or start_index < start_idx or start_index > end_idx:
-                            continue
-                        if end_index >= len(text) or end_index < start_idx or end_index > end_idx:
-                            continue
-                        if end_index < start_index:
-                            continue
-                        if  not token_is_max_context[start_index]:
-                            continue
-                        length = end_index - start_index + 1
-                        if length > 30:
-                            continue
-
-                        prelim_predictions.append(
-                               _PrelimPrediction(
-                                  feature_index=id,
-                                  start_index=start_index,
-                                  end_index=end_index,
-                                  start_logit=start_logits[start_index],
-                                  end_logit=end_logits[end_index],
-                                  token_to_orig_map=token_to_orig_map))
-            prelim_predictions = sorted(prelim_predictions,key=lambda x: (x.start_logit + x.end_logit),reverse=True)
-            _NbestPrediction = collections.namedtuple("NbestPrediction", ["text", "start_logit", "end_logit"])
-            doc_tokens = orig.split()
-            seen_predictions = {}
-            nbest = []
-            for pred in prelim_predictions:
-                if len(nbest) >= args.n_best_size:
-                    break
-                if pred.start_index > 0:
-                    tok_tokens = [task.dictionary[ii]  for ii in text[pred.start_index:(pred.end_index + 1)]]
-                    tok_text = " ".join(tok_tokens)
-                    tok_text = tok_text.replace(" ##", "")
-                    tok_text = tok_text.replace("##", "")
-                    tok_text = " ".join(tok_text.strip().split())
-                    orig_doc_start = pred.token_to_orig_map[pred.start_index]
-                    orig_doc_end = pred.token_to_orig_map[pred.end_index]
-                    orig_tokens = doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-                    final_text = get_final_text(tok_text, " ".join(orig_tokens))
-                    if final_text in seen_predictions:
-                        continue
-                    seen_predictions[final_text] = True
-                else:
-                    final_text = ""
-                    seen_predictions[final_text] = True
-                nbest.append(_NbestPrediction(text=final_text,start_logit=pred.start_logit,end_logit=pred.end_logit))
-            if not nbest:
-                nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-            assert len(nbest) >= 1
-            total_scores = []
-            best_non_null_entry = None
-            for entry in nbest:
-                total_scores.append(entry.start_logit + entry.end_logit)
-                if not best_non_null_entry:
-                    if entry.text:
-                        best_non_null_entry = entry
-
-            probs = _compute_softmax(total_scores)
-
-            nbest_json = []
-            for (i, entry) in enumerate(nbest):
-                output = collections.OrderedDict()
-                output["text"] = entry.text
-                output["probability"] = probs[i]
-                output["start_logit"] = entry.start_logit
-                output["end_logit"] = entry.end_logit
-                nbest_json.append(output)
-
-            assert len(nbest_json) >= 1
-                
-            all_predictions[id] = nbest_json[0]["text"]
-
-    with tempfile.NamedTemporaryFile('w') as f:
-        json.dump(all_predictions, f)
-        f.flush()
-        try:
-            res = subprocess.check_output(
-               ["python", "official_squad_eval.py", data_file, f.name], #, '--na-prob-file', na_f.name],
-               cwd=path.dirname(path.realpath(__file__)))
-        except subprocess.CalledProcessError as e:
-            res = e.output
-        print(res.decode('utf-8'))
+            start_res, end_res, paragraph_mask = model(**batch['net_input'])
+            start_res, end_res = start_res.squeeze(-1), end_res.squeeze(-1)
+
+            # a span can only start at a token whose window gives it the most context
+            is_max_context = torch.zeros_like(start_res)
+            for i, token_is_max_context in enumerate(batch['token_is_max_context']):
+                n_tokens = min(len(token_is_max_context), is_max_context.size(1))
+                is_max_context[i, :n_tokens] = token_is_max_context[:n_tokens].type_as(is_max_context)
+            para_mask = paragraph_mask.ne(0)
+            scores, starts, ends = _get_best_spans(
+                start_res, end_res, para_mask & is_max_context.gt(0), para_mask, args.n_best_size)
+            scores, starts, ends = scores[:, 0].tolist(), starts[:, 0].tolist(), ends[:, 0].tolist()
+            para_starts = para_mask.long().argmax(dim=1).tolist()
+
+            for i, id in enumerate(batch['squad_ids']):
+                if id not in best_spans:
+                    best_spans[id] = None
+                if scores[i] == -math.inf:
+                    continue
+                if best_spans[id] is None or scores[i] > best_spans[id][0]:
+                    best_spans[id] = (scores[i], batch['net_input']['text'][i], starts[i], ends[i],
+                                      batch['actual_txt'][i], batch['idx_map'][i], para_starts[i])
+
+    all_predictions = collections.OrderedDict()
+    for id, best_span in best_spans.items():
+        if best_span is None:
+            all_predictions[id] = "empty"
+            continue
+        _, text, start_index, end_index, orig, idx_map, para_start = best_span
+        if start_index == 0:
+            all_predictions[id] = ""
+            continue
+        tok_tokens = [task.dictionary[ii] for ii in text[start_index:(end_index + 1)]]
+        tok_text = " ".join(tok_tokens)
+        tok_text = tok_text.replace(" ##", "")
+        tok_text = tok_text.replace("##", "")
+        tok_text = " ".join(tok_text.strip().split())
+        orig_doc_start = int(idx_map[start_index - para_start])
+        orig_doc_end = int(idx_map[end_index - para_start])
+        orig_tokens = orig.split()[orig_doc_start:(orig_doc_end + 1)]
+        all_predictions[id] = get_final_text(tok_text, " ".join(orig_tokens))
 
     if was_training:
         model.train()
 
+    return all_predictions
+
+
+def eval_dataset(task, model, dataset, data_file, args, use_cuda=True, evaluator=None):
+    """Predict answers for dataset and score them with the official SQuAD metrics.
+
+    Pass a SquadEvaluator to reuse the loaded data_file across calls.
+    """
+    all_predictions = predict_dataset(task, model, dataset, args, use_cuda)
+
+    if evaluator is None:
+        evaluator = SquadEvaluator.from_file(data_file)
+    res = evaluator.evaluate(all_predictions)
+    print(json.dumps(res, indent=2))
+    return res
+
 
 def main(parsed_args):
     assert parsed_args.path is not None, '--path required for evaluation!'
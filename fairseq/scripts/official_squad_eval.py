@@ -12,16 +12,17 @@ import collections
 import json
 import numpy as np
 import os
-import re
-import string
 import sys
 
+from answer_normalizer import normalize, normalize_answer, get_tokens
+
 OPTS = None
 
 def parse_args():
   parser = argparse.ArgumentParser('Official evaluation script for SQuAD version 2.0.')
   parser.add_argument('data_file', metavar='data.json', help='Input data JSON file.')
-  parser.add_argument('pred_file', metavar='pred.json', help='Model predictions.')
+  parser.add_argument('pred_file', metavar='pred.json', nargs='+',
+                      help='Model predictions. Several files are scored against the same data.')
   parser.add_argument('--out-file', '-o', metavar='eval.json',
                       help='Write accuracy metrics to file (default is stdout).')
   parser.add_argument('--na-prob-file', '-n', metavar='na_prob.json',
@@ -44,24 +45,6 @@ def make_qid_to_has_ans(dataset):
         qid_to_has_ans[qa['id']] = bool(qa['answers'])
   return qid_to_has_ans
 
-def normalize_answer(s):
-  """Lower text and remove punctuation, articles and extra whitespace."""
-  def remove_articles(text):
-    regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
-    return re.sub(regex, ' ', text)
-  def white_space_fix(text):
-    return ' '.join(text.split())
-  def remove_punc(text):
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in text if ch not in exclude)
-  def lower(text):
-    return text.lower()
-  return white_space_fix(remove_articles(remove_punc(lower(s))))
-
-def get_tokens(s):
-  if not s: return []
-  return normalize_answer(s).split()
-
 def compute_exact(a_gold, a_pred):
   return int(normalize_answer(a_gold) == normalize_answer(a_pred))
 
@@ -233,39 +216,158 @@ def find_all_best_thresh(main_eval, preds, exact_raw, f1_raw, na_probs, qid_to_h
   main_eval['best_f1'] = best_f1
   main_eval['best_f1_thresh'] = f1_thresh
 
+class SquadEvaluator(object):
+  """Score predictions in memory against a dataset that is loaded once.
+
+  The gold answers are normalized and their token counts are stored as flat
+  arrays up front, so scoring a dict of predictions only normalizes the
+  predictions and computes the exact match and F1 of every (question, gold
+  answer) pair at once. Several prediction sets can be scored against the
+  same data.
+  """
+
+  def __init__(self, dataset):
+    self.qid_to_has_ans = make_qid_to_has_ans(dataset)
+    self.has_ans_qids = [k for k, v in self.qid_to_has_ans.items() if v]
+    self.no_ans_qids = [k for k, v in self.qid_to_has_ans.items() if not v]
+    self.qids = []
+    # ids of the normalized gold answers and of their tokens
+    self.answer_ids, self.token_ids = {}, {}
+    # one entry per gold answer: its question, normalized answer and length
+    gold_qidxs, gold_answers, gold_lens = [], [], []
+    # one entry per distinct token of each gold answer: its gold answer, token and count
+    count_golds, count_toks, counts = [], [], []
+    for article in dataset:
+      for p in article['paragraphs']:
+        for qa in p['qas']:
+          answers = [normalize(a['text']) for a in qa['answers']]
+          answers = [(a, toks) for a, toks in answers if a]
+          if not answers:
+            # For unanswerable questions, only correct answer is empty string
+            answers = [('', ())]
+          for a, toks in answers:
+            for tok, count in collections.Counter(toks).items():
+              count_golds.append(len(gold_answers))
+              count_toks.append(self.token_ids.setdefault(tok, len(self.token_ids)))
+              counts.append(count)
+            gold_qidxs.append(len(self.qids))
+            gold_answers.append(self.answer_ids.setdefault(a, len(self.answer_ids)))
+            gold_lens.append(len(toks))
+          self.qids.append(qa['id'])
+    self.gold_qidxs = np.array(gold_qidxs, dtype=np.int64)
+    self.gold_answers = np.array(gold_answers, dtype=np.int64)
+    self.gold_lens = np.array(gold_lens, dtype=np.int64)
+    # gold answers are grouped by question, so these start each question's group
+    self.gold_starts = np.searchsorted(self.gold_qidxs, np.arange(len(self.qids)))
+    self.count_golds = np.array(count_golds, dtype=np.int64)
+    self.count_keys = self.gold_qidxs[self.count_golds] * len(self.token_ids) + np.array(count_toks, dtype=np.int64)
+    self.counts = np.array(counts, dtype=np.int64)
+
+  @classmethod
+  def from_file(cls, data_file):
+    with open(data_file) as f:
+      return cls(json.load(f)['data'])
+
+  def get_raw_scores(self, preds):
+    """Same as get_raw_scores(dataset, preds), using the cached gold answers"""
+    n_toks = len(self.token_ids)
+    # the normalized answer, length and gold token counts of each prediction;
+    # tokens that no gold answer has only count towards the length
+    has_pred = np.zeros(len(self.qids), dtype=bool)
+    pred_answers = np.full(len(self.qids), -1, dtype=np.int64)
+    pred_lens = np.zeros(len(self.qids), dtype=np.int64)
+    pred_keys, pred_counts = [], []
+    for i, qid in enumerate(self.qids):
+      if qid not in preds:
+        print('Missing prediction for %s' % qid)
+        continue
+      has_pred[i] = True
+      a_pred, pred_toks = normalize(preds[qid])
+      pred_answers[i] = self.answer_ids.get(a_pred, -1)
+      pred_lens[i] = len(pred_toks)
+      for tok, count in collections.Counter(pred_toks).items():
+        if tok in self.token_ids:
+          pred_keys.append(i * n_toks + self.token_ids[tok])
+          pred_counts.append(count)
+    pred_keys = np.array(pred_keys, dtype=np.int64)
+    pred_counts = np.array(pred_counts, dtype=np.int64)
+
+    # the number of tokens each gold answer shares with its prediction
+    order = np.argsort(pred_keys)
+    pred_keys, pred_counts = pred_keys[order], pred_counts[order]
+    idxs = np.minimum(np.searchsorted(pred_keys, self.count_keys), max(len(pred_keys) - 1, 0))
+    shared = np.zeros(len(self.counts), dtype=np.int64)
+    if len(pred_keys):
+      found = pred_keys[idxs] == self.count_keys
+      shared[found] = np.minimum(self.counts[found], pred_counts[idxs[found]])
+    num_same = np.bincount(self.count_golds, weights=shared, minlength=len(self.gold_lens))
+
+    exact = (self.gold_answers == pred_answers[self.gold_qidxs]).astype(np.float64)
+    gold_lens, pred_lens = self.gold_lens, pred_lens[self.gold_qidxs]
+    f1 = np.zeros(len(gold_lens))
+    # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+    no_ans = (gold_lens == 0) | (pred_lens == 0)
+    f1[no_ans] = (gold_lens[no_ans] == pred_lens[no_ans])
+    overlap = ~no_ans & (num_same > 0)
+    precision = num_same[overlap] / pred_lens[overlap]
+    recall = num_same[overlap] / gold_lens[overlap]
+    f1[overlap] = (2 * precision * recall) / (precision + recall)
+
+    # Take max over all gold answers
+    qids = [qid for qid, p in zip(self.qids, has_pred) if p]
+    if len(self.qids):
+      exact = np.maximum.reduceat(exact, self.gold_starts)[has_pred]
+      f1 = np.maximum.reduceat(f1, self.gold_starts)[has_pred]
+    exact_scores = collections.OrderedDict(zip(qids, exact.astype(int).tolist()))
+    f1_scores = collections.OrderedDict(zip(qids, f1.tolist()))
+    return exact_scores, f1_scores
+
+  def make_eval(self, preds, exact_raw, f1_raw, na_probs=None, na_prob_thresh=1.0):
+    """Aggregate raw scores into the metrics printed by the official script"""
+    if na_probs is None:
+      exact_thresh, f1_thresh = exact_raw, f1_raw
+    else:
+      exact_thresh = apply_no_ans_threshold(exact_raw, na_probs, self.qid_to_has_ans, na_prob_thresh)
+      f1_thresh = apply_no_ans_threshold(f1_raw, na_probs, self.qid_to_has_ans, na_prob_thresh)
+    out_eval = make_eval_dict(exact_thresh, f1_thresh)
+    if self.has_ans_qids:
+      has_ans_eval = make_eval_dict(exact_thresh, f1_thresh, qid_list=self.has_ans_qids)
+      merge_eval(out_eval, has_ans_eval, 'HasAns')
+    if self.no_ans_qids:
+      no_ans_eval = make_eval_dict(exact_thresh, f1_thresh, qid_list=self.no_ans_qids)
+      merge_eval(out_eval, no_ans_eval, 'NoAns')
+    if na_probs is not None:
+      find_all_best_thresh(out_eval, preds, exact_raw, f1_raw, na_probs, self.qid_to_has_ans)
+    return out_eval
+
+  def evaluate(self, preds, na_probs=None, na_prob_thresh=1.0):
+    """Score a dict mapping question ids to predicted answers"""
+    exact_raw, f1_raw = self.get_raw_scores(preds)
+    return self.make_eval(preds, exact_raw, f1_raw, na_probs, na_prob_thresh)
+
 def main():
-  with open(OPTS.data_file) as f:
-    dataset_json = json.load(f)
-    dataset = dataset_json['data']
-  with open(OPTS.pred_file) as f:
-    preds = json.load(f)
+  evaluator = SquadEvaluator.from_file(OPTS.data_file)
   if OPTS.na_prob_file:
     with open(OPTS.na_prob_file) as f:
       na_probs = json.load(f)
   else:
-    na_probs = {k: 0.0 for k in preds}
-  qid_to_has_ans = make_qid_to_has_ans(dataset)  # maps qid to True/False
-  has_ans_qids = [k for k, v in qid_to_has_ans.items() if v]
-  no_ans_qids = [k for k, v in qid_to_has_ans.items() if not v]
-  exact_raw, f1_raw = get_raw_scores(dataset, preds)
-  exact_thresh = apply_no_ans_threshold(exact_raw, na_probs, qid_to_has_ans,
-                                        OPTS.na_prob_thresh)
-  f1_thresh = apply_no_ans_threshold(f1_raw, na_probs, qid_to_has_ans,
-                                     OPTS.na_prob_thresh)
-  out_eval = make_eval_dict(exact_thresh, f1_thresh)
-  if has_ans_qids:
-    has_ans_eval = make_eval_dict(exact_thresh, f1_thresh, qid_list=has_ans_qids)
-    merge_eval(out_eval, has_ans_eval, 'HasAns')
-  if no_ans_qids:
-    no_ans_eval = make_eval_dict(exact_thresh, f1_thresh, qid_list=no_ans_qids)
-    merge_eval(out_eval, no_ans_eval, 'NoAns')
-  if OPTS.na_prob_file:
-    find_all_best_thresh(out_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans)
-  if OPTS.na_prob_file and OPTS.out_image_dir:
-    run_precision_recall_analysis(out_eval, exact_raw, f1_raw, na_probs,
-                                  qid_to_has_ans, OPTS.out_image_dir)
-    histogram_na_prob(na_probs, has_ans_qids, OPTS.out_image_dir, 'hasAns')
-    histogram_na_prob(na_probs, no_ans_qids, OPTS.out_image_dir, 'noAns')
+    na_probs = None
+  all_evals = collections.OrderedDict()
+  for pred_file in OPTS.pred_file:
+    with open(pred_file) as f:
+      preds = json.load(f)
+    exact_raw, f1_raw = evaluator.get_raw_scores(preds)
+    out_eval = evaluator.make_eval(preds, exact_raw, f1_raw, na_probs, OPTS.na_prob_thresh)
+    if OPTS.na_prob_file and OPTS.out_image_dir:
+      run_precision_recall_analysis(out_eval, exact_raw, f1_raw, na_probs,
+                                    evaluator.qid_to_has_ans, OPTS.out_image_dir)
+      histogram_na_prob(na_probs, evaluator.has_ans_qids, OPTS.out_image_dir, 'hasAns')
+      histogram_na_prob(na_probs, evaluator.no_ans_qids, OPTS.out_image_dir, 'noAns')
+    all_evals[pred_file] = out_eval
+  if len(all_evals) == 1:
+    out_eval = all_evals[OPTS.pred_file[0]]
+  else:
+    out_eval = all_evals
   if OPTS.out_file:
     with open(OPTS.out_file, 'w') as f:
       json.dump(out_eval, f)
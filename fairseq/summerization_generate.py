@@ -78,12 +78,18 @@ def main(args):
     if args.score_reference:
         translator = SequenceScorer(models, task.target_dictionary)
     else:
+        stop_symbols = None
+        if args.stop_symbols:
+            stop_symbols = [tgt_dict.index(sym) for sym in args.stop_symbols]
+            assert tgt_dict.unk() not in stop_symbols, 'stop symbols should be in the dictionary'
         translator = SequenceGenerator(
             models, task.target_dictionary, beam_size=args.beam, minlen=args.min_len,
             stop_early=(not args.no_early_stop), normalize_scores=(not args.unnormalized),
             len_penalty=args.lenpen, unk_penalty=args.unkpen,
             sampling=args.sampling, sampling_topk=args.sampling_topk, sampling_temperature=args.sampling_temperature,
             diverse_beam_groups=args.diverse_beam_groups, diverse_beam_strength=args.diverse_beam_strength,
+            incremental=(not args.no_incremental_decoding),
+            stop_symbols=stop_symbols, no_repeat_hypos=args.no_repeat_hypos, strict_minlen=args.strict_min_len,
         )
 
     if use_cuda:
@@ -0,0 +1,159 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import argparse
+import unittest
+
+import torch
+
+from scripts.eval_squad import _get_best_spans, predict_dataset
+
+
+def best_spans_loop(start_logits, end_logits, start_mask, end_mask, n_best_size, max_answer_length=30):
+    """The n-best spans of one row as found by the original BERT post-processing loop"""
+    start_indexes = sorted(range(len(start_logits)), key=lambda i: start_logits[i], reverse=True)[:n_best_size]
+    end_indexes = sorted(range(len(end_logits)), key=lambda i: end_logits[i], reverse=True)[:n_best_size]
+    spans = []
+    for start_index in start_indexes:
+        for end_index in end_indexes:
+            if not start_mask[start_index] or not end_mask[end_index]:
+                continue
+            if end_index < start_index:
+                continue
+            if end_index - start_index + 1 > max_answer_length:
+                continue
+            spans.append((start_logits[start_index] + end_logits[end_index], start_index, end_index))
+    return sorted(spans, reverse=True)[:n_best_size]
+
+
+class TestGetBestSpans(unittest.TestCase):
+
+    def test_matches_loop(self):
+        torch.manual_seed(0)
+        for n_best_size, max_answer_length in [(1, 30), (5, 30), (20, 30), (20, 4)]:
+            bsz, seq_len = 6, 60
+            start_logits, end_logits = torch.randn(bsz, seq_len), torch.randn(bsz, seq_len)
+            # a paragraph after the question, where some tokens have more context in another window
+            end_mask = torch.zeros(bsz, seq_len, dtype=torch.bool)
+            for i in range(bsz):
+                para_start = int(torch.randint(1, 10, ()))
+                para_end = int(torch.randint(para_start + 1, seq_len + 1, ()))
+                end_mask[i, para_start:para_end] = True
+            start_mask = end_mask & torch.rand(bsz, seq_len).lt(0.8)
+
+            scores, starts, ends = _get_best_spans(
+                start_logits, end_logits, start_mask, end_mask, n_best_size, max_answer_length)
+            self.assertEqual(scores.size(), (bsz, n_best_size))
+            for i in range(bsz):
+                expected = best_spans_loop(
+                    start_logits[i].tolist(), end_logits[i].tolist(),
+                    start_mask[i].tolist(), end_mask[i].tolist(), n_best_size, max_answer_length)
+                n_spans = len(expected)
+                self.assertEqual(starts[i, :n_spans].tolist(), [start for _, start, _ in expected])
+                self.assertEqual(ends[i, :n_spans].tolist(), [end for _, _, end in expected])
+                for score, (expected_score, _, _) in zip(scores[i, :n_spans].tolist(), expected):
+                    self.assertAlmostEqual(score, expected_score, places=5)
+                # rows that run out of valid spans are padded with -inf
+                self.assertTrue(scores[i, n_spans:].eq(-float('inf')).all())
+
+
+class SpanModel(object):
+    """Stands in for a SQuAD model, returning the logits stored in each batch"""
+
+    training = False
+
+    def eval(self):
+        pass
+
+    def max_positions(self):
+        return None
+
+    def __call__(self, text, paragraph_mask, start_logits, end_logits):
+        return start_logits.unsqueeze(-1), end_logits.unsqueeze(-1), paragraph_mask
+
+
+class BatchesTask(object):
+
+    def __init__(self, dictionary, batches):
+        self.dictionary = dictionary
+        self.batches = batches
+
+    def get_batch_iterator(self, **kwargs):
+        return argparse.Namespace(next_epoch_itr=lambda shuffle: self.batches)
+
+
+class TestPredictDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.dictionary = ['[CLS]', '[SEP]', 'who', 'where', 'steve', 'smith', 'lives', 'in', 'paris', 'today', '.']
+        self.args = argparse.Namespace(
+            max_tokens=None, max_sentences=None, seed=1, distributed_world_size=1, distributed_rank=0,
+            n_best_size=20, log_format='none', no_progress_bar=True,
+        )
+
+    def make_window(self, question, words, first_word, max_context, spans):
+        """A window over the paragraph: [CLS] question [SEP] words [SEP], starting at
+        word first_word of the paragraph, with logits favoring the given (start word,
+        end word, logit) spans"""
+        tokens = ['[CLS]', question, '[SEP]'] + words + ['[SEP]']
+        start_logits, end_logits = torch.full((len(tokens),), -10.), torch.full((len(tokens),), -10.)
+        for start, end, logit in spans:
+            start_logits[3 + start - first_word] = end_logits[3 + end - first_word] = logit
+        return {
+            'text': torch.LongTensor([self.dictionary.index(token) for token in tokens]),
+            'paragraph_mask': torch.LongTensor([0, 0, 0] + [1] * len(words) + [0]),
+            'start_logits': start_logits,
+            'end_logits': end_logits,
+            'token_is_max_context': torch.LongTensor([0, 0, 0] + max_context + [0]),
+            'idx_map': torch.LongTensor(range(first_word, first_word + len(words))),
+        }
+
+    def make_batch(self, windows):
+        """Collate (squad id, paragraph, window) triples, right-padding the windows"""
+        seq_len = max(len(window['text']) for _, _, window in windows)
+
+        def merge(key):
+            out = torch.zeros(len(windows), seq_len, dtype=windows[0][2][key].dtype)
+            for i, (_, _, window) in enumerate(windows):
+                out[i, :len(window[key])] = window[key]
+            return out
+
+        return {
+            'net_input': {key: merge(key) for key in ['text', 'paragraph_mask', 'start_logits', 'end_logits']},
+            'squad_ids': [squad_id for squad_id, _, _ in windows],
+            'actual_txt': [paragraph for _, paragraph, _ in windows],
+            'idx_map': [window['idx_map'] for _, _, window in windows],
+            'token_is_max_context': [window['token_is_max_context'] for _, _, window in windows],
+        }
+
+    def test_multiple_windows(self):
+        paragraph = 'Steve Smith lives in Paris today .'
+        words = paragraph.lower().split()
+        # two overlapping windows over words 0-3 and 2-6, which give words 0-2
+        # and 3-6 the most context; both questions have candidate spans in both
+        where_0 = self.make_window('where', words[0:4], 0, [1, 1, 1, 0], [(0, 1, 1.)])
+        where_1 = self.make_window('where', words[2:7], 2, [0, 1, 1, 1, 1], [(4, 4, 3.)])
+        who_0 = self.make_window('who', words[0:4], 0, [1, 1, 1, 0], [(0, 1, 4.)])
+        who_1 = self.make_window('who', words[2:7], 2, [0, 1, 1, 1, 1], [(4, 5, 2.)])
+        batches = [
+            self.make_batch([('where', paragraph, where_0)]),
+            self.make_batch([('who', paragraph, who_1), ('where', paragraph, where_1), ('who', paragraph, who_0)]),
+        ]
+        predictions = predict_dataset(BatchesTask(self.dictionary, batches), SpanModel(), None, self.args, use_cuda=False)
+        self.assertEqual(list(predictions.items()), [('where', 'Paris'), ('who', 'Steve Smith')])
+
+    def test_no_valid_span(self):
+        paragraph = 'Steve Smith lives in Paris today .'
+        # the best tokens have more context in another window
+        window = self.make_window('who', paragraph.lower().split()[0:4], 0, [0, 0, 0, 0], [(0, 1, 4.)])
+        batches = [self.make_batch([('who', paragraph, window)])]
+        predictions = predict_dataset(BatchesTask(self.dictionary, batches), SpanModel(), None, self.args, use_cuda=False)
+        self.assertEqual(predictions['who'], 'empty')
+
+
+if __name__ == '__main__':
+    unittest.main()
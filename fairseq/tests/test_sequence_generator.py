@@ -6,11 +6,15 @@
 # can be found in the PATENTS file in the same directory.
 
 import argparse
+import itertools
 import unittest
 
+import numpy as np
 import torch
 
+from fairseq.data import data_utils, SummerizationLanguagePairDataset
 from fairseq.sequence_generator import SequenceGenerator
+from fairseq.summerization_sequence_generator import SequenceGenerator as SummerizationSequenceGenerator
 
 import tests.utils as test_utils
 
@@ -252,5 +256,346 @@ class TestDiverseBeamSearch(unittest.TestCase):
         self.assertEqual(t1.ne(t2).long().sum(), 0)
 
 
+
+class TestSummerizationIncrementalDecoding(unittest.TestCase):
+
+    def setUp(self):
+        self.tgt_dict = test_utils.summerization_dictionary(vocab_size=60)
+
+    def make_batch(self, src_lengths, seed=1):
+        """Random right-padded sources, all in segment 0"""
+        torch.manual_seed(seed)
+        pad = self.tgt_dict.pad()
+        src_tokens = torch.LongTensor(len(src_lengths), max(src_lengths)).fill_(pad)
+        segment = torch.LongTensor(len(src_lengths), max(src_lengths)).fill_(pad)
+        for i, src_len in enumerate(src_lengths):
+            src_tokens[i, :src_len] = torch.randint(self.tgt_dict.nspecial + 4, len(self.tgt_dict), (src_len,))
+            segment[i, :src_len] = 0
+        return {'source': src_tokens, 'segment': segment}
+
+    def assertSameHypos(self, model, encoder_input, **kwargs):
+        hypos = [
+            SummerizationSequenceGenerator([model], self.tgt_dict, incremental=incremental, **kwargs)
+            .generate(encoder_input)
+            for incremental in [False, True]
+        ]
+        for full_hypos, incremental_hypos in zip(*hypos):
+            self.assertEqual(len(full_hypos), len(incremental_hypos))
+            for full_hypo, incremental_hypo in zip(full_hypos, incremental_hypos):
+                self.assertTensorEqual(full_hypo['tokens'], incremental_hypo['tokens'])
+                self.assertAlmostEqual(full_hypo['positional_scores'], incremental_hypo['positional_scores'])
+                self.assertLess(abs(full_hypo['score'] - incremental_hypo['score']), 1e-4)
+
+    def test_incremental_decoding(self):
+        for stacked_decoder, asymmetric in [(False, False), (True, False), (True, True)]:
+            model = test_utils.toy_summerization_model(self.tgt_dict, stacked_decoder, asymmetric)
+            self.assertSameHypos(model, self.make_batch([30, 22, 9, 27]), beam_size=4, maxlen=15, minlen=2)
+
+    def test_incremental_decoding_past_max_positions(self):
+        # the sources get truncated once they reach 511 positions with the generated tokens,
+        # after which decoding falls back to encoding every position at each step
+        model = test_utils.toy_summerization_model(self.tgt_dict)
+        self.assertSameHypos(model, self.make_batch([500, 300]), beam_size=2, maxlen=20, minlen=2)
+
+    def test_reorder_incremental_state(self):
+        model = test_utils.toy_summerization_model(self.tgt_dict)
+        encoder_input = self.make_batch([12, 12, 12])
+        source, segment = encoder_input['source'], encoder_input['segment']
+        segment[:, 8:] = 1
+        new_order = torch.LongTensor([2, 0, 0, 1])
+        with torch.no_grad():
+            incremental_state = {}
+            model(source[:, :9], segment[:, :9], incremental_state=incremental_state)
+            model.reorder_incremental_state(incremental_state, new_order)
+            source, segment = source[new_order], segment[new_order]
+            for step in range(10, 13):
+                incremental_out = model(source[:, :step], segment[:, :step], incremental_state=incremental_state)
+                full_out = model(source[:, :step], segment[:, :step])
+                self.assertAlmostEqual(incremental_out[:, -1], full_out[:, -1])
+
+    def assertAlmostEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertLess((t1 - t2).abs().max(), 1e-4)
+
+    def assertTensorEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertEqual(t1.ne(t2).long().sum(), 0)
+
+
+
+class TestSummerizationBatchedDecoding(unittest.TestCase):
+
+    def setUp(self):
+        self.tgt_dict = test_utils.summerization_dictionary(vocab_size=60)
+        torch.manual_seed(1)
+        src_lengths = [30, 22, 5, 27, 14, 9]
+        self.src = [
+            torch.randint(self.tgt_dict.nspecial + 4, len(self.tgt_dict), (src_len,))
+            for src_len in src_lengths
+        ]
+        # generation datasets come with placeholder targets
+        self.dataset = SummerizationLanguagePairDataset(
+            self.src, np.array(src_lengths), self.tgt_dict,
+            [torch.LongTensor([self.tgt_dict.unk()])] * len(self.src), np.ones(len(self.src), dtype=np.int64),
+            self.tgt_dict, with_target=False, shuffle=False,
+        )
+
+    def generate(self, generator, indices):
+        """Hypotheses for each of *indices*, decoded as one batch"""
+        sample = self.dataset.collater([self.dataset[i] for i in indices])
+        hypos = generator.generate(sample['net_input'])
+        return dict(zip(sample['id'].tolist(), hypos))
+
+    def test_padded_batches(self):
+        # a length-bucketed --max-tokens batching with several batches of
+        # mixed lengths, which get right-padded to their longest source
+        batches = list(data_utils.batch_by_size(
+            self.dataset.ordered_indices(), self.dataset.num_tokens, max_tokens=70,
+        ))
+        self.assertEqual([len(batch) for batch in batches], [3, 2, 1])
+
+        model = test_utils.toy_summerization_model(self.tgt_dict)
+        for incremental in [False, True]:
+            generator = SummerizationSequenceGenerator(
+                [model], self.tgt_dict, beam_size=3, maxlen=12, minlen=2, incremental=incremental,
+            )
+            batched_hypos = {}
+            for batch in batches:
+                batched_hypos.update(self.generate(generator, batch))
+            for i in range(len(self.src)):
+                solo_hypos = self.generate(generator, [i])[i]
+                self.assertEqual(len(batched_hypos[i]), len(solo_hypos))
+                for batched_hypo, solo_hypo in zip(batched_hypos[i], solo_hypos):
+                    self.assertTensorEqual(batched_hypo['tokens'], solo_hypo['tokens'])
+                    self.assertAlmostEqual(batched_hypo['positional_scores'], solo_hypo['positional_scores'])
+                    self.assertLess(abs(batched_hypo['score'] - solo_hypo['score']), 1e-4)
+
+    def assertAlmostEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertLess((t1 - t2).abs().max(), 1e-4)
+
+    def assertTensorEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertEqual(t1.ne(t2).long().sum(), 0)
+
+
+class TestSummerizationBeamFinalization(unittest.TestCase):
+
+    def setUp(self):
+        self.tgt_dict = test_utils.summerization_dictionary(vocab_size=3)
+        eos, w1, w2, w3 = self.tgt_dict.sep(), 4, 5, 6
+        self.eos, self.w1, self.w2, self.w3 = eos, w1, w2, w3
+        probs = {
+            # sentence 1: w1 <eos> and w3 <eos> end at step 1 and w2 w3 <eos> at step 2,
+            # which fills the beam; without stop_early, w1 w1 <eos> beats w3 <eos>
+            (w1, ()): {w1: 0.5, w2: 0.3, w3: 0.2},
+            (w1, (w1,)): {eos: 0.5, w1: 0.3, w2: 0.2},
+            (w1, (w2,)): {eos: 0.4, w3: 0.6},
+            (w1, (w3,)): {eos: 0.9, w1: 0.1},
+            # sentence 2: two hypotheses end at step 2 and the beam fills up at step 3,
+            # after sentence 1 is done
+            (w2, ()): {w1: 0.6, w2: 0.4},
+            (w2, (w1,)): {w1: 0.55, w2: 0.45},
+            (w2, (w2,)): {eos: 0.45, w1: 0.55},
+            (w2, (w1, w1)): {eos: 0.7, w2: 0.3},
+            (w2, (w1, w2)): {eos: 0.2, w1: 0.8},
+        }
+        self.model = test_utils.TestSummerizationModel(self.tgt_dict, probs)
+        src_tokens = torch.LongTensor([[w1, w3, w3], [w2, w3, w3]])
+        self.encoder_input = {'source': src_tokens, 'segment': torch.zeros_like(src_tokens)}
+
+    def test_stop_early(self):
+        generator = SummerizationSequenceGenerator([self.model], self.tgt_dict, beam_size=3, incremental=False)
+        hypos = generator.generate(self.encoder_input)
+        eos, w1, w2, w3 = self.eos, self.w1, self.w2, self.w3
+        # sentence 1
+        self.assertHypoTokens(hypos[0][0], [w2, w3, eos])
+        self.assertHypoScore(hypos[0][0], [0.3, 0.6, 1.0])
+        self.assertHypoTokens(hypos[0][1], [w1, eos])
+        self.assertHypoScore(hypos[0][1], [0.5, 0.5])
+        self.assertHypoTokens(hypos[0][2], [w3, eos])
+        self.assertHypoScore(hypos[0][2], [0.2, 0.9])
+        # sentence 2
+        self.assertHypoTokens(hypos[1][0], [w1, w2, w1, eos])
+        self.assertHypoScore(hypos[1][0], [0.6, 0.45, 0.8, 1.0])
+        self.assertHypoTokens(hypos[1][1], [w1, w1, eos])
+        self.assertHypoScore(hypos[1][1], [0.6, 0.55, 0.7])
+        self.assertHypoTokens(hypos[1][2], [w2, w1, eos])
+        self.assertHypoScore(hypos[1][2], [0.4, 0.55, 1.0])
+
+    def test_no_stop_early(self):
+        generator = SummerizationSequenceGenerator(
+            [self.model], self.tgt_dict, beam_size=3, stop_early=False, incremental=False,
+        )
+        hypos = generator.generate(self.encoder_input)
+        eos, w1, w2, w3 = self.eos, self.w1, self.w2, self.w3
+        # sentence 1
+        self.assertHypoTokens(hypos[0][0], [w2, w3, eos])
+        self.assertHypoScore(hypos[0][0], [0.3, 0.6, 1.0])
+        self.assertHypoTokens(hypos[0][1], [w1, w1, eos])
+        self.assertHypoScore(hypos[0][1], [0.5, 0.3, 1.0])
+        self.assertHypoTokens(hypos[0][2], [w1, eos])
+        self.assertHypoScore(hypos[0][2], [0.5, 0.5])
+        # sentence 2
+        self.assertHypoTokens(hypos[1][0], [w1, w2, w1, eos])
+        self.assertHypoScore(hypos[1][0], [0.6, 0.45, 0.8, 1.0])
+        self.assertHypoTokens(hypos[1][1], [w1, w1, eos])
+        self.assertHypoScore(hypos[1][1], [0.6, 0.55, 0.7])
+        self.assertHypoTokens(hypos[1][2], [w2, w1, eos])
+        self.assertHypoScore(hypos[1][2], [0.4, 0.55, 1.0])
+
+    def test_maxlen(self):
+        # sentence 2 is cut short at maxlen, picking the hypotheses most likely to end there
+        for stop_early in [True, False]:
+            generator = SummerizationSequenceGenerator(
+                [self.model], self.tgt_dict, beam_size=3, maxlen=2, stop_early=stop_early, incremental=False,
+            )
+            hypos = generator.generate(self.encoder_input)
+            eos, w1, w2, w3 = self.eos, self.w1, self.w2, self.w3
+            self.assertHypoTokens(hypos[0][0], [w2, w3, eos])
+            self.assertHypoScore(hypos[0][0], [0.3, 0.6, 1.0])
+            self.assertHypoTokens(hypos[1][0], [w1, w1, eos])
+            self.assertHypoScore(hypos[1][0], [0.6, 0.55, 0.7])
+            self.assertHypoTokens(hypos[1][1], [w2, w1, eos])
+            self.assertHypoScore(hypos[1][1], [0.4, 0.55, 1.0])
+            self.assertHypoTokens(hypos[1][2], [w1, w2, eos])
+            self.assertHypoScore(hypos[1][2], [0.6, 0.45, 0.2])
+
+    def assertHypoTokens(self, hypo, tokens):
+        self.assertTensorEqual(hypo['tokens'], torch.LongTensor(tokens))
+
+    def assertHypoScore(self, hypo, pos_probs, normalized=True, lenpen=1.):
+        pos_scores = torch.FloatTensor(pos_probs).log()
+        self.assertAlmostEqual(hypo['positional_scores'], pos_scores)
+        self.assertEqual(pos_scores.numel(), hypo['tokens'].numel())
+        score = pos_scores.sum()
+        if normalized:
+            score /= pos_scores.numel()**lenpen
+        self.assertLess(abs(score - hypo['score']), 1e-6)
+
+    def assertAlmostEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertLess((t1 - t2).abs().max(), 1e-4)
+
+    def assertTensorEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertEqual(t1.ne(t2).long().sum(), 0)
+
+
+
+class TestSummerizationConstrainedSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.tgt_dict = test_utils.summerization_dictionary(vocab_size=4)
+        self.eos, self.w1, self.w2, self.w3, self.q = self.tgt_dict.sep(), 4, 5, 6, 7
+
+    def generate(self, probs, src_tokens, **kwargs):
+        model = test_utils.TestSummerizationModel(self.tgt_dict, probs)
+        src_tokens = torch.LongTensor(src_tokens)
+        encoder_input = {'source': src_tokens, 'segment': torch.zeros_like(src_tokens)}
+        generator = SummerizationSequenceGenerator([model], self.tgt_dict, incremental=False, **kwargs)
+        return generator.generate(encoder_input)
+
+    def test_stop_symbols(self):
+        eos, w1, w2, w3, q = self.eos, self.w1, self.w2, self.w3, self.q
+        probs = {
+            # w1 q and w1 w2 q end at the stop symbol q, without going on to w3
+            (w1, ()): {w1: 0.7, w2: 0.3},
+            (w1, (w1,)): {w2: 0.6, q: 0.4},
+            (w1, (w2,)): {w2: 0.6, eos: 0.4},
+            (w1, (w1, w2)): {q: 0.9, eos: 0.1},
+            (w1, (w1, q)): {w3: 1.0},
+            (w1, (w1, w2, q)): {w3: 1.0},
+        }
+        hypos = self.generate(probs, [[w1, w3]], beam_size=2, stop_symbols=[q])
+        self.assertEqual(len(hypos[0]), 2)
+        self.assertHypoTokens(hypos[0][0], [w1, w2, q])
+        self.assertHypoScore(hypos[0][0], [0.7, 0.6, 0.9])
+        self.assertHypoTokens(hypos[0][1], [w1, q])
+        self.assertHypoScore(hypos[0][1], [0.7, 0.4])
+
+        # q is an ordinary token otherwise
+        hypos = self.generate(probs, [[w1, w3]], beam_size=2)
+        self.assertHypoTokens(hypos[0][0], [w1, w2, q, w3, eos])
+        self.assertHypoScore(hypos[0][0], [0.7, 0.6, 0.9, 1.0, 1.0])
+
+    def test_no_repeat_hypos(self):
+        eos, w1, w2, w3, q = self.eos, self.w1, self.w2, self.w3, self.q
+        probs = {
+            (w1, ()): {w1: 0.8, w2: 0.2},
+            (w1, (w1,)): {q: 0.45, eos: 0.35, w3: 0.2},
+            (w1, (w2,)): {w3: 0.6, w1: 0.4},
+            (w1, (w1, w3)): {q: 0.7, eos: 0.3},
+            (w1, (w2, w3)): {q: 0.6, eos: 0.4},
+        }
+        # without a diversity penalty, both groups search the same beams
+        src_tokens = [[w1, w2], [w1, w3]]
+        kwargs = dict(beam_size=2, diverse_beam_groups=2, diverse_beam_strength=0., stop_symbols=[q])
+        for stop_early in [True, False]:
+            hypos = self.generate(probs, src_tokens, stop_early=stop_early, **kwargs)
+            for sent_hypos in hypos:
+                self.assertHypoTokens(sent_hypos[0], [w1, q])
+                self.assertHypoTokens(sent_hypos[1], [w1, q])
+
+            hypos = self.generate(probs, src_tokens, stop_early=stop_early, no_repeat_hypos=True, **kwargs)
+            for sent_hypos in hypos:
+                self.assertEqual(len(sent_hypos), 2)
+                self.assertHypoTokens(sent_hypos[0], [w1, q])
+                self.assertHypoScore(sent_hypos[0], [0.8, 0.45])
+                self.assertHypoTokens(sent_hypos[1], [w1, w3, q])
+                self.assertHypoScore(sent_hypos[1], [0.8, 0.2, 0.7])
+
+    def test_hash_hypos(self):
+        eos, w1, w2, q = self.eos, self.w1, self.w2, self.q
+        model = test_utils.TestSummerizationModel(self.tgt_dict, {})
+        generator = SummerizationSequenceGenerator([model], self.tgt_dict, stop_symbols=[q], no_repeat_hypos=True)
+        hashes = generator._hash_hypos(torch.LongTensor([[w1, q], [w1, eos], [w2, q], [q, w1]])).tolist()
+        # only the final token is ignored
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertNotEqual(hashes[0], hashes[2])
+        self.assertNotEqual(hashes[0], hashes[3])
+
+    def test_strict_minlen(self):
+        eos, w1, w2, w3, q = self.eos, self.w1, self.w2, self.w3, self.q
+        # every hypothesis would rather end right away
+        probs = {
+            (w1, prefix): {eos: 0.45, q: 0.35, w1: 0.15, w2: 0.05}
+            for length in range(6) for prefix in itertools.product([w1, w2], repeat=length)
+        }
+        for minlen in [1, 2, 3]:
+            hypos = self.generate(probs, [[w1, w3]], beam_size=3, minlen=minlen, maxlen=6,
+                                  stop_symbols=[q], strict_minlen=True)
+            self.assertEqual(len(hypos[0]), 3)
+            for hypo in hypos[0]:
+                tokens = hypo['tokens'].tolist()
+                self.assertIn(tokens[-1], [eos, q])
+                self.assertGreaterEqual(len(tokens) - 1, minlen)
+                self.assertNotIn(eos, tokens[:-1])
+                self.assertNotIn(q, tokens[:-1])
+            # the best hypotheses end as soon as they're allowed to
+            self.assertHypoTokens(hypos[0][0], [w1] * minlen + [eos])
+            self.assertHypoScore(hypos[0][0], [0.15] * minlen + [0.45])
+
+    def assertHypoTokens(self, hypo, tokens):
+        self.assertTensorEqual(hypo['tokens'], torch.LongTensor(tokens))
+
+    def assertHypoScore(self, hypo, pos_probs, normalized=True, lenpen=1.):
+        pos_scores = torch.FloatTensor(pos_probs).log()
+        self.assertAlmostEqual(hypo['positional_scores'], pos_scores)
+        self.assertEqual(pos_scores.numel(), hypo['tokens'].numel())
+        score = pos_scores.sum()
+        if normalized:
+            score /= pos_scores.numel()**lenpen
+        self.assertLess(abs(score - hypo['score']), 1e-6)
+
+    def assertAlmostEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertLess((t1 - t2).abs().max(), 1e-4)
+
+    def assertTensorEqual(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertEqual(t1.ne(t2).long().sum(), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
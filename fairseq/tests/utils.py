@@ -232,3 +232,79 @@ class TestIncrementalDecoder(FairseqIncrementalDecoder):
 
     def max_positions(self):
         return self.args.max_decoder_positions
+
+
+def summerization_dictionary(vocab_size):
+    """BERT style dictionary as used by the summerization models, followed
+    by *vocab_size* dummy tokens. [SEP] doubles as EOS."""
+    from fairseq.tasks.squad_task import BertDictionary
+    d = BertDictionary()
+    for symbol in ['[PAD]', '[UNK]', '[CLS]', '[SEP]']:
+        d.add_symbol(symbol)
+    for i in range(vocab_size):
+        d.add_symbol('token_' + str(i))
+    return d
+
+
+def toy_summerization_model(dictionary, stacked_decoder=False, asymmetric=False, seed=0):
+    """Small randomly initialized FTSummerization model around a
+    ShuffleTransformerDecoder, which supports incremental decoding"""
+    from fairseq.models.block_transformer_autoregressive import (
+        BlockTransformerAutoregressive, ShuffleTransformerDecoder, base_lm_architecture,
+    )
+    from fairseq.models.summerization_encoder_only import FTSummerization
+
+    torch.manual_seed(seed)
+    args = argparse.Namespace(
+        embed_dim=32, ffn_embed_dim=64, encoder_layers=3, decoder_layers=3, attention_heads=4,
+        dropout=0., attention_dropout=0., relu_dropout=0., share_input_output_embed=True,
+        max_positions=512, num_segment=2, no_token_positional_embeddings=False,
+        stacked_decoder=stacked_decoder, asymmetric=asymmetric, save_masks=False, remove_head=False,
+    )
+    base_lm_architecture(args)
+    embed_tokens = torch.nn.Embedding(len(dictionary), args.embed_dim, dictionary.pad())
+    decoder = ShuffleTransformerDecoder(args, dictionary, embed_tokens, final_norm=True)
+    # large weights, so that hypotheses don't all look alike
+    for p in decoder.parameters():
+        p.data.normal_(0, 0.3)
+    return FTSummerization(args, BlockTransformerAutoregressive(decoder)).eval()
+
+
+class TestSummerizationModel(torch.nn.Module):
+    """Summerization model whose next token probabilities are looked up from
+    the first source token and the tokens generated so far.
+
+    Args:
+        dictionary: decoding dictionary
+        probs: dict mapping (first source token, tuple of generated tokens)
+            to a dict of next token probabilities; EOS follows any prefix
+            that isn't in *probs*
+    """
+
+    def __init__(self, dictionary, probs, max_positions=100):
+        super().__init__()
+        self.dictionary = dictionary
+        self.probs = probs
+        self.max_positions = max_positions
+
+    def forward(self, source, segment):
+        bsz, length = source.size()
+        out = torch.FloatTensor(bsz, length, len(self.dictionary)).fill_(1. / len(self.dictionary))
+        for i in range(bsz):
+            # the generated tokens have segment 1, each position predicting
+            # the token that goes there from the ones before it
+            tgt_idxs = segment[i].eq(1).nonzero().view(-1).tolist()
+            generated = source[i, tgt_idxs].tolist()
+            for j, idx in enumerate(tgt_idxs):
+                next_probs = self.probs.get((int(source[i, 0]), tuple(generated[:j])), {self.dictionary.sep(): 1.})
+                out[i, idx] = 0.
+                for token, prob in next_probs.items():
+                    out[i, idx, token] = prob
+        return out
+
+    def get_normalized_probs(self, net_output, log_probs):
+        # the model returns probabilities directly
+        return net_output.log() if log_probs else net_output
+
+    def max_decoder_positions(self):
+        return self.max_positions
@@ -0,0 +1,237 @@
+""" Compute QAGS scores for a large corpus in sharded worker processes.
+
+The corpus is split into n_shards contiguous shards, which workers score with a
+QagsScorer each (answer extraction, QG, question filtering, QA and answer comparison),
+one worker process per GPU or n_workers CPU-only workers, handed a shard at a time.
+If a worker dies, e.g. killed for running out of memory, it is restarted on the same
+device and resumes its shard, up to max_restarts times per shard.
+
+Each shard appends its scores to out_dir/shards/scores.{shard}.txt a chunk at a time,
+recording each chunk in a progress manifest (see stage_manifest.py) along with the shard layout,
+hashes of the input files and the models and flags of the scorer. Rerunning the same command
+skips finished shards and restarts unfinished ones from their last recorded chunk, while shards
+scored with other inputs, flags or shards are redone from scratch. Randomness is seeded per example from its position
+in the corpus, as in qags.py, so scores don't depend on the number of workers or on restarts.
+Once all shards are done, their scores are merged in order into out_dir/qags_scores.txt.
+"""
+import os
+import sys
+import queue
+import argparse
+import itertools
+import collections
+import multiprocessing as mp
+
+from utils import write_txt
+from stage_manifest import StageManifest
+
+
+def count_lines(data_file):
+    with open(data_file, encoding="utf-8") as fh:
+        return sum(1 for _ in fh)
+
+
+def skip_lines(fh, n_lines):
+    """ Move past the next n_lines lines of a txt file without keeping them """
+    for _ in itertools.islice(fh, n_lines):
+        pass
+
+
+def read_lines(fh, n_lines):
+    """ Read the next n_lines lines of a txt file, stripped as by load_txt """
+    return [r.strip() for r in itertools.islice(fh, n_lines)]
+
+
+def get_shard_range(n_exs, n_shards, shard):
+    """ Get the [start, end) example range of a shard """
+    return shard * n_exs // n_shards, (shard + 1) * n_exs // n_shards
+
+
+def get_shard_file(out_dir, shard):
+    return os.path.join(out_dir, "shards", f"scores.{shard}.txt")
+
+
+def get_manifest_file(out_dir, shard):
+    return os.path.join(out_dir, "shards", f"scores.{shard}.manifest")
+
+
+def open_shard(args, shard):
+    """ Open the progress manifest of a shard, and drop the scores in its shard file that
+    the manifest doesn't record, e.g. those of a partially written chunk, or all of them
+    if they were computed from other inputs, with another scorer or in another shard layout
+
+    returns:
+        - manifest: StageManifest of the shard
+        - n_done: number of examples of the shard already scored
+    """
+    shard_start, _ = get_shard_range(args.n_exs, args.n_shards, shard)
+    shard_file = get_shard_file(args.out_dir, shard)
+    input_files = {"src_txt_file": args.src_txt_file, "gen_txt_file": args.gen_txt_file}
+    params = {"n_exs": args.n_exs, "n_shards": args.n_shards, "shard": shard, "scorer": args.scorer_id}
+    manifest = StageManifest(get_manifest_file(args.out_dir, shard), "score-shard", input_files, params)
+    n_bytes = os.path.getsize(shard_file) if os.path.exists(shard_file) else 0
+    end, n_kept = shard_start, 0
+    record = manifest.get(end)
+    while record is not None and record["n_bytes"] <= n_bytes:
+        end, n_kept = record["end"], record["n_bytes"]
+        record = manifest.get(end)
+    with open(shard_file, "ab") as fh:
+        fh.truncate(n_kept)
+    return manifest, end - shard_start
+
+
+def init_worker(args, device):
+    """ Pin a worker process to its device and load its QagsScorer """
+    global SCORER, ARGS
+    if device is None:
+        args.cpu = True
+    else:
+        # set before torch is imported by qags
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    from qags import build_scorer
+    SCORER = build_scorer(args)
+    ARGS = args
+
+
+def score_shard(shard):
+    """ Score the unscored examples of a shard, a chunk at a time """
+    args = ARGS
+    shard_start, shard_end = get_shard_range(args.n_exs, args.n_shards, shard)
+    manifest, n_done = open_shard(args, shard)
+    with manifest, open(args.src_txt_file, encoding="utf-8") as src_fh, \
+            open(args.gen_txt_file, encoding="utf-8") as gen_fh, \
+            open(get_shard_file(args.out_dir, shard), "a") as out_fh:
+        # skip to the first unscored example once, then read the shard sequentially
+        skip_lines(src_fh, shard_start + n_done)
+        skip_lines(gen_fh, shard_start + n_done)
+        for start in range(shard_start + n_done, shard_end, args.chunk_size):
+            end = min(start + args.chunk_size, shard_end)
+            scores = SCORER.score(read_lines(src_fh, end - start), read_lines(gen_fh, end - start),
+                                  seed=args.seed, start=start)
+            out_fh.write("".join(f"{score}\n" for score in scores))
+            out_fh.flush()
+            os.fsync(out_fh.fileno())
+            manifest.add(start, end, n_bytes=out_fh.tell())
+    return shard
+
+
+def run_worker(args, device, tasks, results):
+    """ Score the shards put in tasks until getting None, putting each finished shard in results """
+    init_worker(args, device)
+    for shard in iter(tasks.get, None):
+        score_shard(shard)
+        results.put(shard)
+
+
+def run_workers(args, devices, todo, max_restarts=2):
+    """ Score the shards in todo with a worker process per device """
+    # CUDA can't be used in forked processes
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    todo = collections.deque(todo)
+    n_restarts = collections.Counter()
+
+    def start_worker(device):
+        tasks = ctx.Queue()
+        process = ctx.Process(target=run_worker, args=(args, device, tasks, results), daemon=True)
+        process.start()
+        return {"device": device, "process": process, "tasks": tasks, "shard": None}
+
+    def assign(worker, shard):
+        # None tells the worker to exit
+        worker["shard"] = shard
+        worker["tasks"].put(shard)
+
+    workers = [start_worker(device) for device in devices[:len(todo)]]
+    try:
+        for worker in workers:
+            assign(worker, todo.popleft())
+        while any(worker["shard"] is not None for worker in workers):
+            try:
+                shard = results.get(timeout=1)
+            except queue.Empty:
+                shard = None
+            for worker in workers:
+                if worker["shard"] is None:
+                    continue
+                if worker["shard"] == shard:
+                    print(f"| finished shard {shard}")
+                    assign(worker, todo.popleft() if todo else None)
+                elif shard is None and not worker["process"].is_alive():
+                    # only checked once all reported shards are handled, so a worker
+                    # that exits right after finishing its shard isn't mistaken for a crash
+                    failed, exitcode = worker["shard"], worker["process"].exitcode
+                    n_restarts[failed] += 1
+                    if n_restarts[failed] > max_restarts:
+                        raise RuntimeError(f"Shard {failed} failed {n_restarts[failed]} times, "
+                                           f"last with exit code {exitcode}")
+                    print(f"| worker on device {worker['device']} died with exit code {exitcode} "
+                          f"while scoring shard {failed}, restarting it")
+                    worker.update(start_worker(worker["device"]))
+                    assign(worker, failed)
+    finally:
+        for worker in workers:
+            if worker["process"].is_alive() and worker["shard"] is not None:
+                worker["process"].terminate()
+            worker["process"].join()
+
+
+def merge_shards(out_dir, n_exs, n_shards):
+    """ Concatenate the scores of the shards, in order """
+    qags_scores = []
+    for shard in range(n_shards):
+        start, end = get_shard_range(n_exs, n_shards, shard)
+        with open(get_shard_file(out_dir, shard)) as fh:
+            scores = [float(r) for r in fh]
+        assert len(scores) == end - start, f"Shard {shard} has {len(scores)} scores for {end - start} examples!"
+        qags_scores += scores
+    return qags_scores
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Compute QAGS scores in sharded worker processes')
+    parser.add_argument('--src_txt_file', type=str, required=True,
+                        help="Txt file containing a src example per line, corresponding with gen_txt_file")
+    parser.add_argument('--gen_txt_file', type=str, required=True,
+                        help="Txt file containing a model-generated example per line, corresponding with src_txt_file")
+    parser.add_argument('--out_dir', type=str, required=True, help="Directory to write shard scores and qags_scores.txt to")
+    parser.add_argument('--n_shards', type=int, default=None, help="Number of shards, defaults to the number of workers")
+    parser.add_argument('--gpus', type=str, default=None,
+                        help="Comma-separated GPU ids to run a worker on each of, e.g. '0,1,2,3'")
+    parser.add_argument('--n_workers', type=int, default=1, help="Number of CPU-only workers, if no --gpus are given")
+    parser.add_argument('--chunk_size', type=int, default=100,
+                        help="Number of examples to score at a time, and to checkpoint after")
+    parser.add_argument('--max_restarts', type=int, default=2,
+                        help="Number of times to restart a worker that dies while scoring a shard before giving up")
+    from qags import add_scorer_args, get_scorer_id
+    add_scorer_args(parser)
+    args = parser.parse_args(arguments)
+
+    devices = args.gpus.split(',') if args.gpus else [None] * args.n_workers
+    n_shards = args.n_shards or len(devices)
+    n_exs = count_lines(args.src_txt_file)
+    n_gens = count_lines(args.gen_txt_file)
+    assert n_exs == n_gens, f"Found {n_exs} sources but {n_gens} generations!"
+    args.n_exs, args.n_shards = n_exs, n_shards
+    args.scorer_id = get_scorer_id(args)
+    os.makedirs(os.path.join(args.out_dir, "shards"), exist_ok=True)
+
+    todo = []
+    for shard in range(n_shards):
+        start, end = get_shard_range(n_exs, n_shards, shard)
+        manifest, n_done = open_shard(args, shard)
+        manifest.close()
+        if n_done < end - start:
+            todo.append(shard)
+    print(f"| scoring {n_exs} examples in {n_shards} shards, {n_shards - len(todo)} already done")
+    if todo:
+        run_workers(args, devices, todo, max_restarts=args.max_restarts)
+
+    qags_scores = merge_shards(args.out_dir, n_exs, n_shards)
+    out_file = os.path.join(args.out_dir, "qags_scores.txt")
+    write_txt(qags_scores, out_file)
+    print(f"Wrote {len(qags_scores)} scores to {out_file}")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,43 +1,40 @@
 """ Evaluate answer spans """
 import os
-import re
 import sys
 import json
-import string
 import random
 import argparse
+import itertools
+from multiprocessing import Pool
 import editdistance
 from tqdm import tqdm
 from collections import Counter
 
 import numpy as np
+
+FSEQ_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fairseq", "scripts")
+if FSEQ_SCRIPTS_DIR not in sys.path:
+    sys.path.append(FSEQ_SCRIPTS_DIR)
+from answer_normalizer import normalize, normalize_answer, get_tokens
 from utils import write_data, write_jsonl, write_txt, \
                   process, print_samples, format_squad, \
                   filter_line_fseq, parse_generation, \
-                  load_txt, load_json
-
-
-def normalize_answer(s):
-    """Lower text and remove punctuation, articles and extra whitespace."""
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
-
-    def white_space_fix(text):
-        return ' '.join(text.split())
-
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
-
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
-
-
-def get_tokens(s):
-    if not s: return []
-    return normalize_answer(s).split()
+                  load_txt, load_json, format_squad_article
+from qst_store import QuestionStore, SUFFIXES as QST_STORE_SUFFIXES
+from qags_cache import QagsCache, make_qa_model_id
+from stage_manifest import StageManifest
+from column_store import ColumnStoreWriter
+
+# per-question diagnostics, see write_diagnostics
+DIAGNOSTIC_COLUMNS = {
+                      "ex_id": "int64",
+                      "question": "str",
+                      "src_ans": "str",
+                      "gen_ans": "str",
+                      "qst_prb": "float32",
+                      "em": "float32",
+                      "f1": "float32",
+                     }
 
 
 def f1_score(a_gold, a_pred):
@@ -73,6 +70,92 @@ def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
     return max(scores_for_ground_truths)
 
 
+def tokenize_answers(anss):
+    """ Normalize answers and map them and their tokens to integer ids
+
+    returns:
+        - norm_anss: the distinct normalized answers
+        - norm_ids: for each answer, the index of its normalized answer in norm_anss
+        - tok_ids: the token ids of each of norm_anss, concatenated
+        - lens: the number of tokens of each of norm_anss
+        - vocab_size: the number of distinct tokens
+    """
+    norm2id, tok2id = {}, {}
+    norm_anss, all_toks = [], []
+    norm_ids = np.zeros(len(anss), dtype=np.int64)
+    for i, ans in enumerate(anss):
+        norm, toks = normalize(ans)
+        if norm not in norm2id:
+            norm2id[norm] = len(norm_anss)
+            norm_anss.append(norm)
+            all_toks.append([tok2id.setdefault(tok, len(tok2id)) for tok in toks])
+        norm_ids[i] = norm2id[norm]
+    lens = np.array([len(toks) for toks in all_toks], dtype=np.int64)
+    tok_ids = np.array([tok for toks in all_toks for tok in toks], dtype=np.int64)
+    return norm_anss, norm_ids, tok_ids, lens, len(tok2id)
+
+
+def batch_f1_scores(ids1, ids2, tok_ids, lens, vocab_size):
+    """ F1 between pairs of tokenized answers, given by their indices into lens.
+    Matches f1_score(a_gold, a_pred) where ids1 are a_gold and ids2 are a_pred. """
+    offsets = np.cumsum(lens) - lens
+    n_pairs = len(ids1)
+
+    def count_tokens(ids):
+        """ Unique (pair, token) keys and their counts """
+        ans_lens = lens[ids]
+        pair_idxs = np.repeat(np.arange(n_pairs), ans_lens)
+        tok_idxs = np.arange(ans_lens.sum()) - np.repeat(np.cumsum(ans_lens) - ans_lens, ans_lens)
+        toks = tok_ids[np.repeat(offsets[ids], ans_lens) + tok_idxs]
+        return np.unique(pair_idxs * vocab_size + toks, return_counts=True)
+
+    keys1, counts1 = count_tokens(ids1)
+    keys2, counts2 = count_tokens(ids2)
+    common, idxs1, idxs2 = np.intersect1d(keys1, keys2, assume_unique=True, return_indices=True)
+    num_same = np.bincount(common // max(vocab_size, 1),
+                           weights=np.minimum(counts1[idxs1], counts2[idxs2]),
+                           minlength=n_pairs)
+
+    n_gold, n_pred = lens[ids1], lens[ids2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = 1.0 * num_same / n_pred
+        recall = 1.0 * num_same / n_gold
+        f1 = (2 * precision * recall) / (precision + recall)
+    f1 = np.where(num_same > 0, f1, 0.)
+    # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+    no_ans = (n_gold == 0) | (n_pred == 0)
+    return np.where(no_ans, ((n_gold == 0) & (n_pred == 0)).astype(float), f1)
+
+
+def batch_scores(prds, tgts, metric_name="em"):
+    """ Score every prediction against its target answer at once,
+    as metric_max_over_ground_truths(metric, prd, [tgt]) would.
+
+    Distinct (prediction, target) pairs are only scored once.
+
+    returns:
+        - a numpy array with a score per pair
+    """
+    assert len(prds) == len(tgts), "Need a target per prediction!"
+    if metric_name not in ["em", "f1", "ed"]:
+        raise ValueError(f"Metric {metric_name} not found!")
+    n_exs = len(prds)
+    if n_exs == 0:
+        return np.zeros(0)
+
+    norm_anss, norm_ids, tok_ids, lens, vocab_size = tokenize_answers(list(prds) + list(tgts))
+    prd_ids, tgt_ids = norm_ids[:n_exs], norm_ids[n_exs:]
+    if metric_name == "em":
+        return (prd_ids == tgt_ids).astype(np.int64)
+
+    pairs, pair_idxs = np.unique(np.stack([prd_ids, tgt_ids], axis=1), axis=0, return_inverse=True)
+    if metric_name == "f1":
+        scores = batch_f1_scores(pairs[:, 0], pairs[:, 1], tok_ids, lens, vocab_size)
+    else:
+        scores = np.array([editdistance.eval(norm_anss[prd], norm_anss[tgt]) for prd, tgt in pairs])
+    return scores[pair_idxs.reshape(-1)]
+
+
 def load_data(data_file):
     """ """
     data = json.load(open(data_file, encoding="utf-8"))
@@ -83,10 +166,81 @@ def align_ans(srcs, trgs):
     """ """
     assert srcs.keys() == trgs.keys()
     src_ans = list(srcs.values())
-    trg_ans = list(trgs.values())
+    trg_ans = [trgs[qst_id] for qst_id in srcs]
     return src_ans, trg_ans
 
 
+def load_squad_qas(data_file):
+    """ Map the question ids of a SQuAD formatted file to their (context, question) pairs """
+    qas = {}
+    for article in load_data(data_file)["data"]:
+        for para in article["paragraphs"]:
+            for qa in para["qas"]:
+                qas[str(qa["id"])] = (para["context"], qa["question"])
+    return qas
+
+
+def drop_cached_qsts(data_file, out_file, cache, qa_model_id):
+    """ Write the SQuAD formatted data_file to out_file without the questions
+    whose answers for their context are in the cache, so that only the remaining
+    questions need to be answered (see get_qags_scores) """
+    data = load_data(data_file)
+    n_qsts, n_kept = 0, 0
+    for article in data["data"]:
+        for para in article["paragraphs"]:
+            prds = cache.get_many('qa', qa_model_id, [(para["context"], qa["question"]) for qa in para["qas"]])
+            n_qsts += len(prds)
+            para["qas"] = [qa for qa, prd in zip(para["qas"], prds) if prd is None]
+            n_kept += len(para["qas"])
+    with open(out_file, "w", encoding="utf-8") as out_fh:
+        json.dump(data, out_fh)
+    print(f"Wrote {n_kept} / {n_qsts} questions without cached answers to {out_file}")
+
+
+def fill_cached_ans(prds, data_file, cache, qa_model_id):
+    """ Complete the predictions prds for the questions in the SQuAD formatted data_file
+    with cached answers, and cache the answers in prds.
+
+    returns:
+        - dict mapping each question id in data_file to its predicted answer
+    """
+    qas = load_squad_qas(data_file)
+    new_ids = [qst_id for qst_id in qas if qst_id in prds]
+    cache.put_many('qa', qa_model_id, [qas[qst_id] for qst_id in new_ids], [prds[qst_id] for qst_id in new_ids])
+    old_ids = [qst_id for qst_id in qas if qst_id not in prds]
+    for qst_id, prd in zip(old_ids, cache.get_many('qa', qa_model_id, [qas[qst_id] for qst_id in old_ids])):
+        assert prd is not None, f"Missing prediction for question {qst_id}!"
+        prds[qst_id] = prd
+    return {qst_id: prds[qst_id] for qst_id in qas}
+
+
+def load_squad_qst_exs(data_file):
+    """ Map the question ids of a SQuAD formatted file, with an article per example
+    as written by format-qa-data, to their (example index, question) pairs.
+
+    returns:
+        - qst_exs: dict mapping question ids to (example index, question)
+        - n_exs: number of examples, including those without questions
+    """
+    qst_exs = {}
+    articles = load_data(data_file)["data"]
+    for ex_idx, article in enumerate(articles):
+        for para in article["paragraphs"]:
+            for qa in para["qas"]:
+                qst_exs[str(qa["id"])] = (ex_idx, qa["question"])
+    return qst_exs, len(articles)
+
+
+def write_diagnostics(writer, ex_ids, qsts, src_anss, gen_anss, qst_prbs=None):
+    """ Append a row per question to a ColumnStoreWriter with DIAGNOSTIC_COLUMNS,
+    scoring each summary answer against the source answer with every metric.
+    Questions without probabilities get NaN. """
+    if qst_prbs is None:
+        qst_prbs = np.full(len(qsts), np.nan)
+    writer.write(ex_id=ex_ids, question=qsts, src_ans=src_anss, gen_ans=gen_anss, qst_prb=qst_prbs,
+                 em=batch_scores(gen_anss, src_anss, "em"), f1=batch_scores(gen_anss, src_anss, "f1"))
+
+
 def count_noans(src_anss, trg_anss):
     """ """
     n_src, n_trg = len(src_anss), len(trg_anss)
@@ -106,24 +260,52 @@ def count_noans(src_anss, trg_anss):
     return percent_src_noans, percent_trg_noans, both_unans
 
 
-def aggregate_examples(scores, n_qsts_per_doc=5):
-    """Jank way to aggregate questions across examples.
-    Right now (7/18/19), questions by examples are grouped together.
+def aggregate_examples(scores, n_qsts_per_doc=5, offsets=None):
+    """Average the scores of the questions of each example.
+    Questions are grouped by example, either n_qsts_per_doc at a time
+    or, given offsets, as scores[offsets[i]: offsets[i + 1]] for example i.
+    Examples without questions get NaN.
     """
-    assert len(scores) % n_qsts_per_doc == 0, "Number of questions invalid"
-    n_doc = int(len(scores) / n_qsts_per_doc)
-
-    agg_scores = []
-    for i in range(n_doc):
-        agg_score = sum(scores[i * n_qsts_per_doc : (i + 1) * n_qsts_per_doc]) / n_qsts_per_doc
-        agg_scores.append(agg_score)
-
-    return agg_scores
+    scores = np.asarray(scores, dtype=np.float64)
+    if offsets is None:
+        assert len(scores) % n_qsts_per_doc == 0, "Number of questions invalid"
+        offsets = np.arange(0, len(scores) + 1, n_qsts_per_doc)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    assert offsets[0] == 0 and offsets[-1] == len(scores), "Number of questions invalid"
+
+    counts = np.diff(offsets)
+    sums = np.zeros(len(counts))
+    has_qsts = counts > 0
+    if has_qsts.any():
+        # examples without questions don't split the segments of the others
+        sums[has_qsts] = np.add.reduceat(scores, offsets[:-1][has_qsts])
+    agg_scores = np.full(len(counts), np.nan)
+    np.divide(sums, counts, out=agg_scores, where=has_qsts)
+    return agg_scores.tolist()
+
+
+def get_offsets(n_qsts):
+    """ Offsets for aggregate_examples from the number of questions of each example """
+    return np.concatenate([[0], np.cumsum(n_qsts, dtype=np.int64)])
+
+
+def clean_question(qst):
+    """ Cut a question after its first '?'.
+    Returns None if there is no '?' or the question is too short """
+    try:
+        qst_idx = qst.index('?') # get idx of *first* '?'
+    except ValueError: # no '?' mark
+        return None
+    # filter out stuff after '?'
+    clean_qst = qst[:qst_idx + 1]
+    if len(clean_qst.split()) < 3:
+        return None
+    return clean_qst
 
 
 def filter_qsts(qsts, n_qsts,
                 prbs=None, reverse_prob=False,
-                exp_anss=None, act_anss=None):
+                exp_anss=None, act_anss=None, rng=random, pad=True):
     """ Filter out questions by a number of criteria
     - repetitions: exact repetitions
     - length: short sentences are excluded
@@ -139,6 +321,8 @@ def filter_qsts(qsts, n_qsts,
         - reverse_prob: if True, sort by reverse probability
         - exp_anss: expected answers, e.g. that we conditioned on (optional)
         - act_anss: actual answers, e.g. from a QA model (optional)
+        - rng: random number generator to pick extra questions with if there are too few
+        - pad: if False, keep fewer than n_qsts questions rather than picking extra ones
     """
 
     qsts_and_prbs = zip(qsts, prbs)
@@ -156,27 +340,25 @@ def filter_qsts(qsts, n_qsts,
     qsts_and_prbs = sorted(qsts_and_prbs, key=lambda x: x[1], reverse=not reverse_prob)
     clean_qsts = list()
     clean_prbs = list()
+    seen_qsts = set()
     for qst, prob in qsts_and_prbs:
-        try:
-            qst_idx = qst.index('?') # get idx of *first* '?'
-            # filter out stuff after '?'
-            clean_qst = qst[:qst_idx + 1]
-            clean_toks = clean_qst.split()
-            if clean_qst in clean_qsts or len(clean_toks) < 3:
-                continue
-            clean_qsts.append(clean_qst)
-            clean_prbs.append(prob)
-        except ValueError as e: # no '?' mark
+        clean_qst = clean_question(qst)
+        if clean_qst is None or clean_qst in seen_qsts:
             continue
+        seen_qsts.add(clean_qst)
+        clean_qsts.append(clean_qst)
+        clean_prbs.append(prob)
 
     n_clean_qsts = len(clean_qsts)
-    if n_clean_qsts < n_qsts:
+    if n_clean_qsts < n_qsts and pad:
         #print("Too few questions!")
-        supp_qsts = random.sample(qsts, n_qsts - n_clean_qsts)
-        clean_qsts += supp_qsts
+        supp_idxs = rng.sample(range(len(qsts)), n_qsts - n_clean_qsts)
+        clean_qsts += [qsts[i] for i in supp_idxs]
+        clean_prbs += [prbs[i] for i in supp_idxs]
 
     ret = {
            'qsts': clean_qsts[:n_qsts],
+           'prbs': clean_prbs[:n_qsts],
            'n_qsts_w_match_ans': n_qsts_w_match_ans,
            'n_qsts_w_ans': n_qsts_w_ans,
            'n_clean_qsts': n_clean_qsts,
@@ -184,6 +366,71 @@ def filter_qsts(qsts, n_qsts,
     return ret
 
 
+def example_rng(seed, ex_idx):
+    """ Random number generator for filtering the questions of an example.
+    Seeded per example so results don't depend on how examples are split across workers;
+    falls back to the global generator without a seed """
+    if seed is None:
+        return random
+    return random.Random(f"{seed}-{ex_idx}")
+
+
+def select_qsts(cand_qsts, cand_prbs, n_qsts, cand_anss=None, cand_prds=None, use_all_qsts=False, rng=random,
+                pad=True):
+    """ Pick the questions of a single example, see aggregate_questions_from_txt """
+    if not use_all_qsts:
+        ret = filter_qsts(cand_qsts, n_qsts,
+                          prbs=cand_prbs, reverse_prob=False,
+                          exp_anss=cand_anss, act_anss=cand_prds, rng=rng, pad=pad)
+    else:
+        ret = {
+               'qsts': cand_qsts,
+               'n_clean_qsts': len(cand_qsts),
+               'n_qsts_w_ans': None,
+               'n_qsts_w_match_ans': None,
+              }
+    clean_qsts = ret['qsts']
+    for qst in clean_qsts:
+        assert not isinstance(qst, list), "List instead of string detected!"
+    return clean_qsts
+
+
+def select_chunk_qsts(chunk):
+    """ Pick the questions of a contiguous chunk of examples, in a worker process """
+    start, all_cands, n_qsts, use_all_qsts, seed, pad = chunk
+    return [select_qsts(cand_qsts, cand_prbs, n_qsts,
+                        cand_anss=cand_anss, cand_prds=cand_prds, use_all_qsts=use_all_qsts,
+                        rng=example_rng(seed, start + i), pad=pad)
+            for i, (cand_qsts, cand_prbs, cand_anss, cand_prds) in enumerate(all_cands)]
+
+
+def get_qa_txt_files(src_txt_file, gen_txt_file, src_w_trg_txt_file=None, use_all_qsts=False):
+    """ Get the txt file of each field that format-qa-data writes a QA data file for """
+    if use_all_qsts:
+        # only answer the questions using the generations they were generated from
+        return {"gen": gen_txt_file}
+    txt_files = {"src": src_txt_file}
+    if src_w_trg_txt_file is not None:
+        txt_files["src_w_trg"] = src_w_trg_txt_file
+    txt_files["gen"] = gen_txt_file
+    return txt_files
+
+
+def open_format_manifest(out_dir, txt_files, gen_qst_file, gen_prob_file, gen_ans_file, gen_prd_file,
+                         gen_qst_store, params):
+    """ Open the manifest of format-qa-data (see stage_manifest.py), keyed by the files
+    the QA data is formatted from and by params, which include the use_*_anss options """
+    input_files = {f"{txt_fld}_txt_file": txt_file for txt_fld, txt_file in txt_files.items()}
+    if gen_qst_store is not None:
+        input_files.update({f"gen_qst_store.{suffix}": f"{gen_qst_store}.{suffix}" for suffix in QST_STORE_SUFFIXES})
+    else:
+        input_files.update({"gen_qst_file": gen_qst_file, "gen_prob_file": gen_prob_file})
+    use_act_anss, use_exp_anss = params["use_act_anss"], params["use_exp_anss"]
+    input_files["gen_ans_file"] = gen_ans_file if use_exp_anss or use_act_anss else None
+    input_files["gen_prd_file"] = gen_prd_file if use_act_anss else None
+    return StageManifest(f"{out_dir}/format-qa-data.manifest", "format-qa-data", input_files, params)
+
+
 def aggregate_questions_from_txt(out_dir,
                                  src_txt_file,
                                  gen_txt_file,
@@ -193,7 +440,8 @@ def aggregate_questions_from_txt(out_dir,
                                  gen_prd_file=None,
                                  src_w_trg_txt_file=None,
                                  use_all_qsts=False, use_act_anss=False, use_exp_anss=False,
-                                 n_gen_qsts=10, n_ans=10, n_qsts=20):
+                                 n_gen_qsts=10, n_ans=10, n_qsts=20, n_workers=1, seed=None,
+                                 gen_qst_store=None, variable_n_qsts=False):
     """ Extract questions generated from src, trg, and gen
     with the corresponding field from fseq logs (one log/txt) and write to jsonl.
     Each fseq log should have the txt field as 'source' (S)
@@ -206,6 +454,9 @@ def aggregate_questions_from_txt(out_dir,
         - gen_qst_file: txt file of questions generated conditioned on src/gen
         - gen_prob_file: txt file of {src/gen} question probabilities according to QG model
         - gen_prd_file (optional): txt file of answers predicted by QA model on src/gen_qst_file
+        - gen_qst_store (optional): prefix of a question store (see qst_store.py) with an example
+            per (text, answer) pair, to read questions and probabilities from instead of
+            gen_qst_file and gen_prob_file
 
         n_ans: the number of answer candidates per text
         n_gen_qsts: the number of questions generated per (text, answer) pair
@@ -213,12 +464,34 @@ def aggregate_questions_from_txt(out_dir,
         use_all_qsts: use all questions
         use_act_anss: filter out [NO_ANS] questions
         use_exp_anss: filter out questions where prediction doesn't match expected answer
+        n_workers: number of processes to filter questions with
+        seed: seed of the per-example random number generators used when filtering,
+            for results that don't depend on n_workers; required with n_workers > 1
+        variable_n_qsts: keep only the questions that pass the filters, up to n_qsts,
+            rather than padding examples with too few with random other questions
+
+    Once the QA data is written, it's recorded in {out_dir}/format-qa-data.manifest
+    (see stage_manifest.py), so rerunning with the same inputs and options does nothing.
     """
 
+    assert not (n_workers > 1 and seed is None), "Filtering questions in parallel requires a seed!"
     assert not (use_exp_anss and (gen_ans_file is None)), "Trying to use expected answers, but not provided any!"
     assert not (use_act_anss and (gen_ans_file is None)), "Trying to use predicted answers, but not provided expected answers!"
     assert not (use_act_anss and (gen_prd_file is None)), "Trying to use predicted answers, but not provided any!"
 
+    txt_files = get_qa_txt_files(src_txt_file, gen_txt_file, src_w_trg_txt_file, use_all_qsts)
+    out_files = [f"{out_dir}/{txt_fld}.json" for txt_fld in txt_files]
+    # the output doesn't depend on n_workers
+    params = {"stream": False, "use_all_qsts": use_all_qsts, "use_act_anss": use_act_anss, "use_exp_anss": use_exp_anss,
+              "n_gen_qsts": n_gen_qsts, "n_ans": n_ans, "n_qsts": n_qsts, "seed": seed,
+              "variable_n_qsts": variable_n_qsts}
+    manifest = open_format_manifest(out_dir, txt_files, gen_qst_file, gen_prob_file, gen_ans_file, gen_prd_file,
+                                    gen_qst_store, params)
+    if manifest.get(0) is not None and all(os.path.exists(f) for f in out_files):
+        print(f"QA data in {out_dir} is up to date with its inputs")
+        manifest.close()
+        return
+
     files = {
              "src": {"txt": src_txt_file},
              "gen": {"txt": gen_txt_file, "qst": gen_qst_file, "prb": gen_prob_file, "ans": gen_ans_file, "prd": gen_prd_file},
@@ -246,8 +519,13 @@ def aggregate_questions_from_txt(out_dir,
         # load questions, probabilities, (expected) answers only based on generation
         if txt_fld != "gen":
             continue
-        qsts = load_txt(field_files["qst"])
-        prbs = [float(f) for f in load_txt(field_files["prb"])] #if field_files["prb"] is not None else list()
+        if gen_qst_store is not None:
+            qsts = QuestionStore(gen_qst_store)
+            prbs = qsts.prbs
+            assert qsts.n_exs == n_exs * n_ans, f"Expected {n_ans} QG inputs per example but found {qsts.n_exs} for {n_exs} examples!"
+        else:
+            qsts = load_txt(field_files["qst"])
+            prbs = [float(f) for f in load_txt(field_files["prb"])] #if field_files["prb"] is not None else list()
         anss = load_txt(field_files["ans"]) if use_exp_anss else []
         # optionally load QA model predictions
         if use_act_anss:
@@ -266,26 +544,31 @@ def aggregate_questions_from_txt(out_dir,
 
         # Filter questions
         # Extract questions assuming there's a constant number per example and in order
-        for i in tqdm(range(n_exs), desc="Filtering questions"):
-            cand_qsts = qsts[(i * n_qsts_per_ex): ((i + 1) * n_qsts_per_ex)]
-            cand_prbs = prbs[(i * n_qsts_per_ex): ((i + 1) * n_qsts_per_ex)]
-            cand_anss = anss[(i * n_ans): ((i + 1) * n_ans)] if anss else None
-            cand_prds = prds[(i * n_qsts_per_ex): ((i + 1) * n_qsts_per_ex)] if prds else None
-            if not use_all_qsts:
-                ret = filter_qsts(cand_qsts, n_qsts,
-                                  prbs=cand_prbs, reverse_prob=False,
-                                  exp_anss=cand_anss, act_anss=cand_prds)
+        all_cands = []
+        for i in range(n_exs):
+            if gen_qst_store is not None:
+                q_start, q_end = qsts.example_range(i * n_ans, (i + 1) * n_ans)
+                cand_prbs = prbs[q_start: q_end].tolist()
             else:
-                ret = {
-                       'qsts': cand_qsts,
-                       'n_clean_qsts': len(cand_qsts),
-                       'n_qsts_w_ans': None,
-                       'n_qsts_w_match_ans': None,
-                      }
-            clean_qsts = ret['qsts']
-            for qst in clean_qsts:
-                assert not isinstance(qst, list), "List instead of string detected!"
-            all_clean_qsts.append(clean_qsts)
+                q_start, q_end = i * n_qsts_per_ex, (i + 1) * n_qsts_per_ex
+                cand_prbs = prbs[q_start: q_end]
+            cand_qsts = qsts[q_start: q_end]
+            cand_anss = anss[(i * n_ans): ((i + 1) * n_ans)] if anss else None
+            cand_prds = prds[q_start: q_end] if prds else None
+            all_cands.append((cand_qsts, cand_prbs, cand_anss, cand_prds))
+
+        if n_workers > 1:
+            # contiguous chunks, a few per worker to even out the load
+            chunk_size = max(1, -(-n_exs // (4 * n_workers)))
+            chunks = [(start, all_cands[start: start + chunk_size], n_qsts, use_all_qsts, seed, not variable_n_qsts)
+                      for start in range(0, n_exs, chunk_size)]
+            with Pool(n_workers) as pool:
+                for chunk_qsts in tqdm(pool.imap(select_chunk_qsts, chunks), total=len(chunks), desc="Filtering questions"):
+                    all_clean_qsts += chunk_qsts
+        else:
+            for i, cands in enumerate(tqdm(all_cands, desc="Filtering questions")):
+                all_clean_qsts += select_chunk_qsts((i, [cands], n_qsts, use_all_qsts, seed, not variable_n_qsts))
+        del all_cands
 
         # Construct data in SQuAD-like format, using both src (article) and gen (model generation) as context
         for txt_fld in all_txts:
@@ -297,7 +580,10 @@ def aggregate_questions_from_txt(out_dir,
             raw_data = {}
 
             for i in tqdm(range(n_exs), desc="Formatting data"):
-                if len(txts) == len(qsts):
+                if gen_qst_store is not None:
+                    # the store keeps track of the questions of each example
+                    txt = txts[i].split()
+                elif len(txts) == len(qsts):
                     txt = txts[i * n_ans].split()
                 elif len(txts) < len(qsts):
                     assert len(qsts) / len(txts) == n_qsts_per_ex, \
@@ -311,46 +597,217 @@ def aggregate_questions_from_txt(out_dir,
             data = format_squad(raw_data, context=txt_fld, ctx_split=True)
             out_file = f"{out_dir}/{txt_fld}.json"
             print(f"Writing to {out_file}")
-            json.dump(data, open(out_file, "w", encoding="utf-8"))
+            with open(out_file, "w", encoding="utf-8") as out_fh:
+                json.dump(data, out_fh)
+    manifest.add(0, n_exs, files=out_files)
+    manifest.close()
+
+
+class SquadWriter(object):
+    """ Write SQuAD articles one at a time to {out_dir}/{name}.json,
+    or to {out_dir}/{name}_{shard}.json files of shard_size articles each """
+
+    def __init__(self, out_dir, name, shard_size=None):
+        self.out_dir = out_dir
+        self.name = name
+        self.shard_size = shard_size
+        self.n_shards = 0
+        self.n_articles = 0
+        self.out_fh = None
+        self.out_file = None
+
+    def _open(self):
+        if self.shard_size is None:
+            self.out_file = f"{self.out_dir}/{self.name}.json"
+        else:
+            self.out_file = f"{self.out_dir}/{self.name}_{self.n_shards}.json"
+        print(f"Writing to {self.out_file}")
+        self.out_fh = open(self.out_file, "w", encoding="utf-8")
+        self.out_fh.write('{"data": [')
+        self.n_shards += 1
+
+    def skip(self, n_articles):
+        """ Skip the shard(s) of n_articles written by a previous run """
+        assert self.out_fh is None, "Can only skip whole shards!"
+        self.n_articles += n_articles
+        self.n_shards += -(-n_articles // self.shard_size) if self.shard_size is not None else 1
+
+    def write(self, article):
+        if self.out_fh is None:
+            self._open()
+        elif self.shard_size is not None and self.n_articles % self.shard_size == 0:
+            self.close()
+            self._open()
+        else:
+            self.out_fh.write(', ')
+        self.out_fh.write(json.dumps(article))
+        self.n_articles += 1
+
+    def close(self):
+        if self.out_fh is None and self.n_shards == 0:
+            self._open()
+        if self.out_fh is not None:
+            self.out_fh.write(']}')
+            self.out_fh.close()
+            self.out_fh = None
+
+
+def stream_questions_from_txt(out_dir,
+                              src_txt_file,
+                              gen_txt_file,
+                              gen_qst_file,
+                              gen_prob_file=None,
+                              gen_ans_file=None,
+                              gen_prd_file=None,
+                              src_w_trg_txt_file=None,
+                              use_all_qsts=False, use_act_anss=False, use_exp_anss=False,
+                              n_gen_qsts=10, n_ans=10, n_qsts=20, shard_size=None, seed=None,
+                              gen_qst_store=None, variable_n_qsts=False):
+    """ Streaming version of aggregate_questions_from_txt that writes the same files.
+
+    Reads the text, question, probability and answer files in lock-step,
+    one example at a time, and writes each example out as soon as its
+    questions are filtered, so memory doesn't grow with the number of examples.
+    Expects a line per example in each txt file.
+
+    QA model predictions (gen_prd_file) are keyed by question id rather than
+    in order, so they are still loaded in full.
+
+    args:
+        - shard_size (optional): write {txt_fld}_{shard}.json files of shard_size
+            examples each rather than a single {txt_fld}.json. Question ids keep
+            counting across shards.
+        - seed (optional): seed of the per-example random number generators
+            used when filtering, which gives the same questions as
+            aggregate_questions_from_txt with that seed
+        - see aggregate_questions_from_txt for the rest
+
+    Progress is recorded in {out_dir}/format-qa-data.manifest (see stage_manifest.py)
+    as shards are written, so rerunning with the same inputs and options
+    only writes the shards that weren't finished.
+    """
+    assert not (use_exp_anss and (gen_ans_file is None)), "Trying to use expected answers, but not provided any!"
+    assert not (use_act_anss and (gen_ans_file is None)), "Trying to use predicted answers, but not provided expected answers!"
+    assert not (use_act_anss and (gen_prd_file is None)), "Trying to use predicted answers, but not provided any!"
 
+    txt_files = get_qa_txt_files(src_txt_file, gen_txt_file, src_w_trg_txt_file, use_all_qsts)
+    n_qsts_per_ex = n_ans * n_gen_qsts
+
+    if use_act_anss:
+        raw_prds = json.load(open(gen_prd_file))
+        prds = [raw_prds[str(i)] for i in range(len(raw_prds))]
+        del raw_prds
+
+    def read_lines(fh, n_lines):
+        return [line.strip() for line in itertools.islice(fh, n_lines)]
+
+    txt_fhs = {txt_fld: open(txt_file, encoding="utf-8") for txt_fld, txt_file in txt_files.items()}
+    if gen_qst_store is not None:
+        store = QuestionStore(gen_qst_store)
+        qst_fh = prb_fh = None
+    else:
+        qst_fh = open(gen_qst_file, encoding="utf-8")
+        prb_fh = open(gen_prob_file, encoding="utf-8")
+    ans_fh = open(gen_ans_file, encoding="utf-8") if use_exp_anss else None
+    writers = {txt_fld: SquadWriter(out_dir, txt_fld, shard_size) for txt_fld in txt_files}
+    print(f"Streaming QA data, filtering {n_qsts_per_ex} questions per example to {n_qsts}")
+
+    params = {"stream": True, "use_all_qsts": use_all_qsts, "use_act_anss": use_act_anss, "use_exp_anss": use_exp_anss,
+              "n_gen_qsts": n_gen_qsts, "n_ans": n_ans, "n_qsts": n_qsts, "shard_size": shard_size, "seed": seed,
+              "variable_n_qsts": variable_n_qsts}
+    manifest = open_format_manifest(out_dir, txt_files, gen_qst_file, gen_prob_file, gen_ans_file, gen_prd_file,
+                                    gen_qst_store, params)
+
+    n_exs, qa_idx, shard_start = 0, 0, 0
+    with tqdm(desc="Formatting data") as pbar:
+        while True:
+            done = manifest.get(n_exs) if n_exs == shard_start else None
+            if done is not None and all(os.path.exists(f) for f in done["files"]):
+                # skip the examples of a shard written by a previous run
+                n_skip = done["end"] - n_exs
+                for fh in txt_fhs.values():
+                    read_lines(fh, n_skip)
+                if gen_qst_store is None:
+                    read_lines(qst_fh, n_skip * n_qsts_per_ex)
+                    read_lines(prb_fh, n_skip * n_qsts_per_ex)
+                if use_exp_anss:
+                    read_lines(ans_fh, n_skip * n_ans)
+                for writer in writers.values():
+                    writer.skip(n_skip)
+                n_exs, qa_idx, shard_start = done["end"], done["qa_idx"], done["end"]
+                pbar.update(n_skip)
+                continue
 
-def evaluate(tgts, prds, n_qsts_per_doc, metric_name="em"):
+            txts = {txt_fld: fh.readline() for txt_fld, fh in txt_fhs.items()}
+            if not any(txts.values()):
+                break
+            assert all(txts.values()), f"Different numbers of txts detected! Found more than {n_exs} for some fields."
+            if gen_qst_store is not None:
+                assert (n_exs + 1) * n_ans <= store.n_exs, f"Ran out of questions at example {n_exs}"
+                q_start, q_end = store.example_range(n_exs * n_ans, (n_exs + 1) * n_ans)
+                cand_qsts, cand_prbs = store[q_start: q_end], store.prbs[q_start: q_end].tolist()
+            else:
+                q_start, q_end = n_exs * n_qsts_per_ex, (n_exs + 1) * n_qsts_per_ex
+                cand_qsts = read_lines(qst_fh, n_qsts_per_ex)
+                cand_prbs = [float(f) for f in read_lines(prb_fh, n_qsts_per_ex)]
+                assert len(cand_qsts) == len(cand_prbs) == n_qsts_per_ex, \
+                        f"Expected constant number of questions ({n_qsts_per_ex}) per example! Ran out of questions at example {n_exs}"
+            cand_anss = read_lines(ans_fh, n_ans) if use_exp_anss else None
+            cand_prds = prds[q_start: q_end] if use_act_anss else None
+            clean_qsts = select_qsts(cand_qsts, cand_prbs, n_qsts,
+                                     cand_anss=cand_anss, cand_prds=cand_prds, use_all_qsts=use_all_qsts,
+                                     rng=example_rng(seed, n_exs), pad=not variable_n_qsts)
+
+            for txt_fld, txt in txts.items():
+                raw = {txt_fld: txt.strip().split(), "hypotheses": clean_qsts}
+                writers[txt_fld].write(format_squad_article(raw, context=txt_fld, ctx_split=True, qa_idx=qa_idx))
+            qa_idx += len(clean_qsts)
+            n_exs += 1
+            pbar.update()
+            if shard_size is not None and n_exs % shard_size == 0:
+                for writer in writers.values():
+                    writer.close()
+                manifest.add(shard_start, n_exs, qa_idx=qa_idx, files=[w.out_file for w in writers.values()])
+                shard_start = n_exs
+
+    if gen_qst_store is not None:
+        assert store.n_exs == n_exs * n_ans, f"Found more questions than expected for {n_exs} examples!"
+        store.close()
+    else:
+        assert not qst_fh.readline(), f"Found more questions than expected for {n_exs} examples!"
+    for fh in list(txt_fhs.values()) + [qst_fh, prb_fh, ans_fh]:
+        if fh is not None:
+            fh.close()
+    for writer in writers.values():
+        writer.close()
+    if n_exs > shard_start:
+        manifest.add(shard_start, n_exs, qa_idx=qa_idx, files=[w.out_file for w in writers.values()])
+    manifest.close()
+    print(f"Wrote QA data for {n_exs} examples")
+
+
+def evaluate(tgts, prds, n_qsts_per_doc, metric_name="em", offsets=None):
     """
 
     args:
         - tgt_anss: Target answers, usually predictions on full source, to be evaluated against
         - prd_anss: Answers to be evaluated
+        - offsets: if given, the questions of example i are [offsets[i], offsets[i + 1]),
+            rather than n_qsts_per_doc questions per example
 
     returns:
         - average score
     """
 
-    n_exs = len(tgts)
-    scores = []
-    if metric_name == "em":
-        metric = exact_match_score
-    elif metric_name == "f1":
-        metric = f1_score
-    elif metric_name == "ed":
-        metric = edit_distance_score
-    else:
-        raise ValueError(f"Metric {metric_name} not found!")
+    scores = batch_scores(prds, tgts, metric_name)
 
+    # tracking goold + bad EM examples
     good_exs, bad_exs = [], []
+    if metric_name == "em":
+        good_exs = np.flatnonzero(scores == 1).tolist()
+        bad_exs = np.flatnonzero(scores == 0).tolist()
 
-    for ex_id, (tgt, prd) in enumerate(zip(tgts, prds)):
-        score = metric_max_over_ground_truths(metric, prd, [tgt])
-        scores.append(score)
-
-        # tracking goold + bad EM examples
-        if metric_name == "em" and score == 1:
-            good_exs.append(ex_id)
-        elif metric_name == "em" and score == 0:
-            bad_exs.append(ex_id)
-        elif metric_name == "em":
-            raise ValueError("Weird EM value found")
-
-    scores = aggregate_examples(scores, n_qsts_per_doc)
+    scores = aggregate_examples(scores, n_qsts_per_doc, offsets=offsets)
 
     scores = np.array(scores)
     mean = scores.mean()
@@ -363,21 +820,47 @@ def evaluate(tgts, prds, n_qsts_per_doc, metric_name="em"):
 
 
 def get_qags_scores(src_ans_file, trg_ans_file,
-                    metric_name="em", n_qsts_per_doc=10):
+                    metric_name="em", n_qsts_per_doc=10,
+                    src_qa_file=None, cache=None, qa_model_id=None, diagnostics_dir=None,
+                    variable_n_qsts=False):
     """Load answer files and compute similarity scores
+
+    If given a cache, the source answers are completed with and added to the cached
+    answers of the QA model qa_model_id for the questions in the QA data file src_qa_file,
+    so src_ans_file only needs answers to the questions kept by drop_cached_qsts.
+
+    If given diagnostics_dir, a row per question with its example index (from src_qa_file),
+    text, answers and scores is written there (see write_diagnostics).
+
+    If variable_n_qsts, examples can have any number of questions rather than n_qsts_per_doc,
+    and are told apart using src_qa_file. Examples without questions get NaN.
     """
     srcs = load_data(src_ans_file)
     trgs = load_data(trg_ans_file)
+    if cache is not None:
+        srcs = fill_cached_ans(srcs, src_qa_file, cache, qa_model_id)
     src_ans, trg_ans = align_ans(srcs, trgs)
+    if diagnostics_dir is not None or variable_n_qsts:
+        assert src_qa_file is not None, "Need the QA data file to write diagnostics or to group questions by example!"
+        qst_exs, n_exs = load_squad_qst_exs(src_qa_file)
+    offsets = None
+    if variable_n_qsts:
+        ex_idxs = np.array([qst_exs[qst_id][0] for qst_id in srcs], dtype=np.int64)
+        assert (np.diff(ex_idxs) >= 0).all(), "Questions aren't grouped by example!"
+        offsets = get_offsets(np.bincount(ex_idxs, minlength=n_exs))
+    if diagnostics_dir is not None:
+        with ColumnStoreWriter(diagnostics_dir, DIAGNOSTIC_COLUMNS) as writer:
+            write_diagnostics(writer, [qst_exs[qst_id][0] for qst_id in srcs], [qst_exs[qst_id][1] for qst_id in srcs],
+                              src_ans, trg_ans)
     qags_scores, _,  _ = evaluate(tgts=src_ans, prds=trg_ans,
                                   n_qsts_per_doc=n_qsts_per_doc,
-                                  metric_name=metric_name)
+                                  metric_name=metric_name, offsets=offsets)
     return qags_scores
 
 
 def main(arguments):
     parser = argparse.ArgumentParser(description='Evaluate answer outputs from pytorch_pretrained_bert models')
-    parser.add_argument("-c", "--command", choices=["compute-qags", "format-qa-data"])
+    parser.add_argument("-c", "--command", choices=["compute-qags", "format-qa-data", "drop-cached-qsts"])
     parser.add_argument('--data_dir', type=str, default=None)
     parser.add_argument('--out_dir', type=str, default=None)
 
@@ -390,6 +873,8 @@ def main(arguments):
                         help="Txt file containing a gen-conditioned question per line, in the same order as {src/gen}_txt_file")
     parser.add_argument('--gen_prob_file', type=str, default=None,
                         help="Txt file containing probabilities of each question in gen_qst_file according to the QG model")
+    parser.add_argument('--gen_qst_store', type=str, default=None,
+                        help="Prefix of a question store written by qg_utils.py --qst_store, to use instead of gen_qst_file and gen_prob_file")
     parser.add_argument('--gen_ans_file', type=str, default=None,
                         help="Txt file containing expected answers of each question in gen_qst_file")
     parser.add_argument('--gen_prd_file', type=str, default=None,
@@ -402,31 +887,103 @@ def main(arguments):
     parser.add_argument('--use_all_qsts', action='store_true')
     parser.add_argument('--use_act_anss', action='store_true')
     parser.add_argument('--use_exp_anss', action='store_true')
+    parser.add_argument('--stream', action='store_true',
+                        help="Format the QA data one example at a time instead of loading all files into memory")
+    parser.add_argument('--shard_size', type=int, default=None,
+                        help="With --stream, write files of shard_size examples each")
+    parser.add_argument('--n_workers', type=int, default=1, help="Number of processes to filter questions with")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed for picking extra questions when an example has too few that pass the filters")
+    parser.add_argument('--variable_n_qsts', action='store_true',
+                        help="Keep only the questions that pass the filters, up to n_qsts_per_doc per example, "
+                             "instead of padding examples with too few; compute-qags then needs --src_qa_file")
 
     parser.add_argument('--source_ans_file', type=str)
     parser.add_argument('--target_ans_file', type=str)
     parser.add_argument('--ans_similarity_fn', choices=["em", "f1"], default="f1")
-    args = parser.parse_args()
+
+    # QA answer cache options
+    parser.add_argument('--src_qa_file', type=str, default=None,
+                        help="QA data file, from format-qa-data, that source_ans_file answers the questions of")
+    parser.add_argument('--qa_cache_file', type=str, default=None,
+                        help="SQLite file to cache the source answers in, keyed by context, question and QA model")
+    parser.add_argument('--qa_model_path', type=str, default=None,
+                        help="QA checkpoint that produced the answers, to key the cache with")
+    parser.add_argument('--qa_max_length', type=int, default=384,
+                        help="Max number of tokens per context window the QA model was run with, to key the cache with")
+    parser.add_argument('--qa_stride', type=int, default=128,
+                        help="Stride between context windows the QA model was run with, to key the cache with")
+    parser.add_argument('--qa_max_query_length', type=int, default=64,
+                        help="Max number of question tokens the QA model was run with, to key the cache with")
+    parser.add_argument('--diagnostics', action='store_true',
+                        help="Also write a row per question with its answers and scores to out_dir/diagnostics, "
+                             "using the questions of --src_qa_file")
+    args = parser.parse_args(arguments)
+
+    cache, qa_model_id = None, None
+    if args.qa_cache_file is not None:
+        assert args.src_qa_file is not None and args.qa_model_path is not None, \
+                "--qa_cache_file requires --src_qa_file and --qa_model_path"
+        cache = QagsCache(args.qa_cache_file)
+        qa_model_id = make_qa_model_id(args.qa_model_path, stride=args.qa_stride, max_length=args.qa_max_length,
+                                       max_query_length=args.qa_max_query_length)
 
 
     if args.command == "format-qa-data":
-        aggregate_questions_from_txt(args.out_dir,
-                                     args.src_txt_file,
-                                     args.gen_txt_file,
-                                     args.gen_qst_file,
-                                     args.src_w_trg_txt_file,
-                                     args.gen_prob_file,
-                                     args.gen_ans_file,
-                                     args.gen_prd_file,
-                                     n_ans=args.n_ans_per_doc, n_gen_qsts=args.n_gen_qsts, n_qsts=args.n_qsts_per_doc,
-                                     use_all_qsts=args.use_all_qsts, use_act_anss=args.use_act_anss, use_exp_anss=args.use_exp_anss,
-                                    )
+        format_kwargs = {}
+        if args.stream:
+            assert args.n_workers == 1, "--n_workers isn't supported with --stream"
+            format_fn = stream_questions_from_txt
+            format_kwargs["shard_size"] = args.shard_size
+        else:
+            assert args.shard_size is None, "--shard_size requires --stream"
+            format_fn = aggregate_questions_from_txt
+            format_kwargs["n_workers"] = args.n_workers
+        format_fn(args.out_dir,
+                  args.src_txt_file,
+                  args.gen_txt_file,
+                  args.gen_qst_file,
+                  gen_prob_file=args.gen_prob_file,
+                  gen_ans_file=args.gen_ans_file,
+                  gen_prd_file=args.gen_prd_file,
+                  src_w_trg_txt_file=args.src_w_trg_txt_file,
+                  n_ans=args.n_ans_per_doc, n_gen_qsts=args.n_gen_qsts, n_qsts=args.n_qsts_per_doc,
+                  use_all_qsts=args.use_all_qsts, use_act_anss=args.use_act_anss, use_exp_anss=args.use_exp_anss,
+                  seed=args.seed, gen_qst_store=args.gen_qst_store, variable_n_qsts=args.variable_n_qsts,
+                  **format_kwargs)
+
+    elif args.command == "drop-cached-qsts":
+        assert cache is not None, "drop-cached-qsts requires --qa_cache_file"
+        out_file = os.path.join(args.out_dir, os.path.basename(args.src_qa_file))
+        assert os.path.abspath(out_file) != os.path.abspath(args.src_qa_file), "--out_dir would overwrite --src_qa_file"
+        drop_cached_qsts(args.src_qa_file, out_file, cache, qa_model_id)
 
     elif args.command == "compute-qags":
-        qags_scores = get_qags_scores(args.src_ans_file, args.trg_ans_file, args.ans_similarity_fn)
-        with open(os.path.join(args.out_dir, "qags_scores.txt", "w")) as out_fh:
-            for score in qags_scores:
-                out_fh.write(f"{score}\n")
+        out_file = os.path.join(args.out_dir, "qags_scores.txt")
+        input_files = {"source_ans_file": args.source_ans_file, "target_ans_file": args.target_ans_file,
+                       "src_qa_file": args.src_qa_file if cache is not None else None}
+        diagnostics_dir = os.path.join(args.out_dir, "diagnostics") if args.diagnostics else None
+        out_files = [out_file] + ([os.path.join(diagnostics_dir, "columns.json")] if args.diagnostics else [])
+        if args.diagnostics or args.variable_n_qsts:
+            input_files["src_qa_file"] = args.src_qa_file
+        # cached source answers depend on the QA model
+        params = {"ans_similarity_fn": args.ans_similarity_fn, "n_qsts_per_doc": args.n_qsts_per_doc,
+                  "diagnostics": args.diagnostics, "variable_n_qsts": args.variable_n_qsts, "qa_model_id": qa_model_id}
+        with StageManifest(os.path.join(args.out_dir, "compute-qags.manifest"), "compute-qags",
+                           input_files, params) as manifest:
+            if manifest.get(0) is not None and all(os.path.exists(f) for f in out_files):
+                print(f"{out_file} is up to date with its inputs")
+                return
+            qags_scores = get_qags_scores(args.source_ans_file, args.target_ans_file, args.ans_similarity_fn,
+                                          n_qsts_per_doc=args.n_qsts_per_doc,
+                                          src_qa_file=args.src_qa_file, cache=cache, qa_model_id=qa_model_id,
+                                          diagnostics_dir=diagnostics_dir, variable_n_qsts=args.variable_n_qsts)
+            with open(out_file, "w") as out_fh:
+                for score in qags_scores:
+                    out_fh.write(f"{score}\n")
+            manifest.add(0, len(qags_scores), files=out_files)
+        if cache is not None:
+            print(cache.report())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,595 @@
+""" Compute QAGS scores in a single process.
+
+Loads the answer extractor, the question generation (QG) model, and the
+question answering (QA) model once, then maps (source, summary) pairs to
+QAGS scores without writing any intermediate files.
+"""
+import os
+import sys
+import json
+import shlex
+import queue
+import random
+import argparse
+import threading
+
+import torch
+from transformers import GPT2Tokenizer
+
+FSEQ_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fairseq")
+if FSEQ_DIR not in sys.path:
+    sys.path.append(FSEQ_DIR)
+from fairseq import options, tasks, tokenizer, utils as fseq_utils
+from fairseq.data import SummerizationLanguagePairDataset, SquadDataset
+from fairseq.summerization_sequence_generator import SequenceGenerator
+from scripts.eval_squad import predict_dataset
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+from qg_utils import ANS_TOK, get_spacy_nlp, get_spacy_model_id, extract_ans, sample_ans, decode_gen, get_question_mark_symbols
+from qa_utils import clean_question, filter_qsts, evaluate, example_rng, get_offsets, write_diagnostics, DIAGNOSTIC_COLUMNS
+from column_store import ColumnStoreWriter
+from qags_cache import QagsCache, checkpoint_id, make_qa_model_id
+from utils import load_txt, write_txt
+
+
+def is_whitespace(c):
+    return c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F
+
+
+def tokenize_context(context, bert_tokenizer):
+    """ Split a context into whitespace tokens and BERT word pieces,
+    keeping the word piece to whitespace token alignment.
+    Mirrors scripts/data/preprocess_squad.py.
+
+    returns:
+        - doc_tokens: whitespace tokens
+        - all_doc_tokens: word pieces
+        - tok_to_orig_index: index into doc_tokens for each word piece
+    """
+    doc_tokens = []
+    prev_is_whitespace = True
+    for c in context:
+        if is_whitespace(c):
+            prev_is_whitespace = True
+        else:
+            if prev_is_whitespace:
+                doc_tokens.append(c)
+            else:
+                doc_tokens[-1] += c
+            prev_is_whitespace = False
+
+    tok_to_orig_index = []
+    all_doc_tokens = []
+    for (i, token) in enumerate(doc_tokens):
+        for sub_token in bert_tokenizer.tokenize(token):
+            tok_to_orig_index.append(i)
+            all_doc_tokens.append(sub_token)
+    return doc_tokens, all_doc_tokens, tok_to_orig_index
+
+
+def run_pipelined(stages, items, max_queued=2):
+    """ Apply a sequence of functions to each item, with a thread per function.
+
+    Items go through the stages one after the other, so the stages of consecutive items overlap,
+    e.g. answers are extracted on CPU for an item while questions are generated on GPU for the previous one.
+    Queues between stages hold at most max_queued items, which bounds memory
+    and blocks the faster stages until the slower ones catch up.
+
+    returns:
+        - a generator over the outputs of the last stage, in the order of items
+    """
+    end = object()
+    queues = [queue.Queue(maxsize=max_queued) for _ in range(len(stages) + 1)]
+
+    def feed():
+        try:
+            for item in items:
+                queues[0].put((item, None))
+        except Exception as e:
+            queues[0].put((None, e))
+            return
+        queues[0].put((end, None))
+
+    def work(stage, in_queue, out_queue):
+        while True:
+            item, error = in_queue.get()
+            if item is not end and error is None:
+                try:
+                    item = stage(item)
+                except Exception as e:
+                    item, error = None, e
+            out_queue.put((item, error))
+            if item is end or error is not None:
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage, in_queue, out_queue in zip(stages, queues[:-1], queues[1:]):
+        threads.append(threading.Thread(target=work, args=(stage, in_queue, out_queue), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    while True:
+        item, error = queues[-1].get()
+        if error is not None:
+            raise error
+        if item is end:
+            break
+        yield item
+
+
+class QagsScorer(object):
+    """ Score summaries against their sources with QAGS.
+
+    args:
+        - qg_args: fairseq command line flags for the QG model,
+            as passed to fairseq/summerization_generate.py
+        - qa_args: fairseq command line flags for the QA model,
+            as passed to fairseq/scripts/eval_squad.py
+        - n_ans: number of answer candidates extracted per summary
+        - n_qsts: number of questions kept per summary
+        - metric_name: answer similarity metric, one of 'em', 'f1', 'ed'
+        - spacy_model: spaCy pipeline used to extract answer candidates
+        - qg_round_size: if set, generate questions from this many answer
+            candidates per summary at a time, and stop once a summary
+            has n_qsts distinct usable questions
+        - constrained_qg: end questions at their first '?', never repeat a
+            question for the same input and enforce --min-len during search
+        - cache: if set, a QagsCache to reuse the answer candidates of texts,
+            the questions generated for (text, answer) pairs and the answers
+            predicted for (context, question) pairs across calls and runs
+        - variable_n_qsts: keep only the questions that pass the filters, up to n_qsts,
+            rather than padding summaries with too few with random other candidates;
+            summaries without any question get a NaN score
+
+    Set diagnostics to a ColumnStoreWriter with qa_utils.DIAGNOSTIC_COLUMNS
+    to write a row per question scored, numbering examples in the order they are scored.
+    """
+
+    def __init__(self, qg_args, qa_args,
+                 n_ans=10, n_qsts=5, metric_name="f1",
+                 spacy_model="en_core_web_lg", cpu=False,
+                 qg_round_size=None, constrained_qg=False, cache=None, variable_n_qsts=False):
+        self.n_ans = n_ans
+        self.n_qsts = n_qsts
+        self.metric_name = metric_name
+        self.use_cuda = torch.cuda.is_available() and not cpu
+        self.qg_round_size = qg_round_size
+        self.constrained_qg = constrained_qg
+        self.cache = cache
+        self.variable_n_qsts = variable_n_qsts
+        self.diagnostics = None
+        self.n_diagnosed = 0
+
+        print("| loading answer extractor")
+        self.nlp = get_spacy_nlp(spacy_model)
+        self.ans_model_id = get_spacy_model_id(spacy_model)
+        self.gpt2_tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+        self.bert_tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self._load_qg(qg_args)
+        self._load_qa(qa_args)
+
+    def _load_qg(self, qg_args):
+        parser = options.get_generation_parser(default_task='summerization')
+        args = options.parse_args_and_arch(parser, qg_args)
+        if args.max_tokens is None and args.max_sentences is None:
+            # inputs are sorted by length, so batches carry little padding
+            args.max_tokens = 4000
+        if self.constrained_qg:
+            # filter_qsts cuts questions at the first '?' and drops repeats anyway
+            args.stop_symbols = get_question_mark_symbols(self.gpt2_tokenizer)
+            args.no_repeat_hypos = True
+            args.strict_min_len = True
+
+        task = tasks.setup_task(args)
+        print('| loading QG model(s) from {}'.format(args.path))
+        models, _ = fseq_utils.load_ensemble_for_inference(
+            args.path.split(':'), task, model_arg_overrides=eval(args.model_overrides))
+        for model in models:
+            model.make_generation_fast_(beamable_mm_beam_size=None if args.no_beamable_mm else args.beam)
+            if args.fp16:
+                model.half()
+
+        stop_symbols = None
+        if args.stop_symbols:
+            tgt_dict = task.target_dictionary
+            stop_symbols = [tgt_dict.index(sym) for sym in args.stop_symbols if sym in tgt_dict.indices]
+        generator = SequenceGenerator(
+            models, task.target_dictionary, beam_size=args.beam, minlen=args.min_len,
+            stop_early=(not args.no_early_stop), normalize_scores=(not args.unnormalized),
+            len_penalty=args.lenpen, unk_penalty=args.unkpen,
+            sampling=args.sampling, sampling_topk=args.sampling_topk, sampling_temperature=args.sampling_temperature,
+            diverse_beam_groups=args.diverse_beam_groups, diverse_beam_strength=args.diverse_beam_strength,
+            incremental=(not args.no_incremental_decoding),
+            stop_symbols=stop_symbols, no_repeat_hypos=args.no_repeat_hypos, strict_minlen=args.strict_min_len,
+        )
+        if self.use_cuda:
+            generator.cuda()
+
+        self.qg_args = args
+        self.qg_model_id = json.dumps({
+            'path': checkpoint_id(args.path), 'beam': args.beam, 'nbest': args.nbest,
+            'min_len': args.min_len, 'max_len_a': args.max_len_a, 'max_len_b': args.max_len_b,
+            'lenpen': args.lenpen, 'unkpen': args.unkpen, 'no_early_stop': args.no_early_stop,
+            'unnormalized': args.unnormalized, 'diverse_beam_groups': args.diverse_beam_groups,
+            'diverse_beam_strength': args.diverse_beam_strength, 'stop_symbols': args.stop_symbols,
+            'no_repeat_hypos': args.no_repeat_hypos, 'strict_min_len': args.strict_min_len,
+            # sources are truncated to max_source_positions
+            'max_source_positions': args.max_source_positions, 'max_target_positions': args.max_target_positions,
+            'fp16': args.fp16, 'remove_bpe': args.remove_bpe,
+        }, sort_keys=True)
+        self.qg_task = task
+        self.qg_models = models
+        self.qg_generator = generator
+
+    def _load_qa(self, qa_args):
+        parser = options.get_parser('Evaluate SQUAD', 'squad')
+        options.add_common_eval_args(parser)
+        options.add_dataset_args(parser)
+        parsed_args = options.parse_args_and_arch(parser, qa_args)
+
+        task = tasks.setup_task(parsed_args)
+        print('| loading QA model(s) from {}'.format(parsed_args.path))
+        models, args = fseq_utils.load_ensemble_for_inference(parsed_args.path.split(':'), task)
+        assert len(models) == 1
+        model = models[0]
+        if self.use_cuda:
+            model.cuda()
+        for arg in vars(parsed_args).keys():
+            if arg not in {'concat_sentences_mode'}:
+                setattr(args, arg, getattr(parsed_args, arg))
+        # the QA model sees every question, so never shard inference
+        args.distributed_world_size = 1
+        args.distributed_rank = 0
+
+        self.qa_args = args
+        self.qa_model_id = make_qa_model_id(parsed_args.path, stride=args.stride, max_length=args.max_length,
+                                            max_query_length=args.max_query_length)
+        self.qa_task = tasks.setup_task(args)
+        self.qa_model = model
+
+    def _cached(self, namespace, model_id, inputs, compute_fn):
+        """ Map inputs to outputs with compute_fn, only computing those not in the cache """
+        if self.cache is None:
+            return compute_fn(inputs)
+        outputs = self.cache.get_many(namespace, model_id, inputs)
+        todo = [i for i, output in enumerate(outputs) if output is None]
+        if todo:
+            new_outputs = compute_fn([inputs[i] for i in todo])
+            self.cache.put_many(namespace, model_id, [inputs[i] for i in todo], new_outputs)
+            for i, output in zip(todo, new_outputs):
+                outputs[i] = output
+        return outputs
+
+    def extract_answers(self, txts, rngs=None):
+        """ Extract n_ans answer candidates for each text,
+        sampling those of text i with rngs[i] (default: the global generator) """
+        all_anss = self._cached('ans', self.ans_model_id, txts,
+                                lambda txts: extract_ans(txts, nlp=self.nlp))
+        # fall back to the whole text if no candidates were found
+        rngs = rngs if rngs is not None else [random] * len(txts)
+        return [sample_ans(anss if anss else [txt], self.n_ans, rng=rng) for txt, anss, rng in zip(txts, all_anss, rngs)]
+
+    def generate_questions(self, txts, anss):
+        """ Generate questions for each (text, answer) pair.
+
+        Repeated pairs, e.g. when a text has fewer answer candidates than n_ans,
+        are only generated for once unless sampling.
+
+        returns:
+            - a list with, for each pair, a list of (question, score) tuples
+        """
+        # beam search is deterministic, so identical inputs get identical questions
+        inputs = [f"{txt} {ANS_TOK} {ans}" for txt, ans in zip(txts, anss)]
+        if self.qg_args.sampling:
+            return self._generate(inputs)
+        input2idx = {}
+        input_idxs = [input2idx.setdefault(inp, len(input2idx)) for inp in inputs]
+        all_qsts = self._cached('qg', self.qg_model_id, list(input2idx), self._generate)
+        return [[tuple(qst) for qst in all_qsts[idx]] for idx in input_idxs]
+
+    def _generate(self, inputs):
+        """ Generate questions for each QG input, see generate_questions """
+        args = self.qg_args
+        src_dict = self.qg_task.source_dictionary
+        tgt_dict = self.qg_task.target_dictionary
+
+        srcs = []
+        for inp in inputs:
+            bpe_ids = self.gpt2_tokenizer.encode(inp)
+            srcs.append(tokenizer.Tokenizer.tokenize(
+                ' '.join(map(str, bpe_ids)), src_dict, add_if_not_exist=False).long())
+        sizes = [src.numel() for src in srcs]
+        # the summerization dataset expects a target; it is ignored when with_target=False
+        dataset = SummerizationLanguagePairDataset(
+            srcs, sizes, src_dict, srcs, sizes, tgt_dict,
+            max_source_positions=args.max_source_positions,
+            max_target_positions=args.max_target_positions,
+            with_target=False,
+        )
+        itr = self.qg_task.get_batch_iterator(
+            dataset=dataset,
+            max_tokens=args.max_tokens,
+            max_sentences=args.max_sentences,
+            max_positions=fseq_utils.resolve_max_positions(
+                self.qg_task.max_positions(),
+                *[model.max_positions() for model in self.qg_models]
+            ),
+        ).next_epoch_itr(shuffle=False)
+
+        all_qsts = [None] * len(srcs)
+        translations = self.qg_generator.generate_batched_itr(
+            itr, maxlen_a=args.max_len_a, maxlen_b=args.max_len_b, cuda=self.use_cuda,
+        )
+        for sample_id, _, _, hypos in translations:
+            qsts = []
+            for hypo in hypos[:min(len(hypos), args.nbest)]:
+                hypo_str = tgt_dict.string(hypo['tokens'].int().cpu(), args.remove_bpe)
+                qsts.append((decode_gen(hypo_str, self.gpt2_tokenizer), hypo['score']))
+            all_qsts[sample_id] = qsts
+        return all_qsts
+
+    def generate_candidates(self, txts, all_anss):
+        """ Generate candidate questions for each text from its answer candidates.
+
+        Answers are used qg_round_size at a time; after each round, texts with
+        n_qsts distinct questions that pass filter_qsts get no more questions.
+
+        returns:
+            - a list with, for each text, a list of (question, score) tuples
+        """
+        round_size = self.qg_round_size or max([len(anss) for anss in all_anss] + [1])
+        all_cands = [[] for _ in txts]
+        all_clean_qsts = [set() for _ in txts]
+        todo = [i for i, anss in enumerate(all_anss) if anss]
+        start = 0
+        while todo:
+            ex_idxs = [i for i in todo for _ in all_anss[i][start: start + round_size]]
+            qg_anss = [ans for i in todo for ans in all_anss[i][start: start + round_size]]
+            all_gen_qsts = self.generate_questions([txts[i] for i in ex_idxs], qg_anss)
+            for i, gen_qsts in zip(ex_idxs, all_gen_qsts):
+                all_cands[i] += gen_qsts
+                clean_qsts = [clean_question(qst) for qst, _ in gen_qsts]
+                all_clean_qsts[i].update(qst for qst in clean_qsts if qst is not None)
+
+            start += round_size
+            todo = [i for i in todo if len(all_clean_qsts[i]) < self.n_qsts and start < len(all_anss[i])]
+        return all_cands
+
+    def answer_questions(self, ctxs, qsts):
+        """ Answer each question using the corresponding context """
+        return self._cached('qa', self.qa_model_id, list(zip(ctxs, qsts)), self._answer)
+
+    def _answer(self, pairs):
+        """ Answer each (context, question) pair, see answer_questions """
+        qa_dict = self.qa_task.dictionary
+
+        ctx2toks = {}
+        paras, para_sizes, actual_txts, idx_maps = [], [], [], []
+        questions, question_sizes = [], []
+        for ctx, qst in pairs:
+            if ctx not in ctx2toks:
+                doc_tokens, all_doc_tokens, tok_to_orig_index = tokenize_context(ctx, self.bert_tokenizer)
+                para = torch.LongTensor([qa_dict.index(t) for t in all_doc_tokens])
+                ctx2toks[ctx] = (para, ' '.join(doc_tokens), tok_to_orig_index)
+            para, actual_txt, idx_map = ctx2toks[ctx]
+            question = torch.LongTensor([qa_dict.index(t) for t in self.bert_tokenizer.tokenize(qst)])
+            paras.append(para)
+            para_sizes.append(para.numel())
+            actual_txts.append(actual_txt)
+            idx_maps.append(idx_map)
+            questions.append(question)
+            question_sizes.append(question.numel())
+
+        ids = [str(i) for i in range(len(pairs))]
+        labels = [[] for _ in pairs]
+        dataset = SquadDataset(
+            paras, questions, labels, ids, actual_txts, idx_maps,
+            para_sizes, question_sizes, qa_dict, self.qa_args.stride,
+            self.qa_args.max_length, self.qa_args.max_query_length,
+        )
+        prds = predict_dataset(self.qa_task, self.qa_model, dataset, self.qa_args, self.use_cuda)
+        return [prds.get(i, "") for i in ids]
+
+    def _answer_stage(self, batch):
+        # generate questions conditioned on answers extracted from the summaries
+        batch['anss'] = self.extract_answers(batch['gens'], rngs=batch['rngs'])
+        return batch
+
+    def _qg_stage(self, batch):
+        batch['cands'] = self.generate_candidates(batch['gens'], batch['anss'])
+        return batch
+
+    def _filter_stage(self, batch):
+        # keep the best n_qsts questions per summary
+        all_qsts, all_prbs = [], []
+        for cands, rng in zip(batch['cands'], batch['rngs']):
+            ret = filter_qsts([q for q, _ in cands], self.n_qsts, prbs=[p for _, p in cands], rng=rng,
+                              pad=not self.variable_n_qsts)
+            all_qsts.append(ret['qsts'])
+            all_prbs.append(ret['prbs'])
+        batch['qsts'] = all_qsts
+        batch['prbs'] = all_prbs
+        return batch
+
+    def _qa_stage(self, batch):
+        # answer the questions using both the source and the summary as context
+        all_qsts = batch['qsts']
+        qst_srcs = [src for src, qsts in zip(batch['srcs'], all_qsts) for _ in qsts]
+        qst_gens = [gen for gen, qsts in zip(batch['gens'], all_qsts) for _ in qsts]
+        flat_qsts = [qst for qsts in all_qsts for qst in qsts]
+        batch['src_anss'] = self.answer_questions(qst_srcs, flat_qsts)
+        batch['gen_anss'] = self.answer_questions(qst_gens, flat_qsts)
+        return batch
+
+    def _compare_stage(self, batch):
+        scores, _, _ = evaluate(tgts=batch['src_anss'], prds=batch['gen_anss'],
+                                n_qsts_per_doc=self.n_qsts,
+                                metric_name=self.metric_name,
+                                offsets=get_offsets([len(qsts) for qsts in batch['qsts']]))
+        assert len(scores) == len(batch['srcs'])
+        if self.diagnostics is not None:
+            ex_ids = [self.n_diagnosed + i for i, qsts in enumerate(batch['qsts']) for _ in qsts]
+            write_diagnostics(self.diagnostics, ex_ids, [qst for qsts in batch['qsts'] for qst in qsts],
+                              batch['src_anss'], batch['gen_anss'],
+                              qst_prbs=[prb for prbs in batch['prbs'] for prb in prbs])
+            self.n_diagnosed += len(batch['qsts'])
+        return scores
+
+    @property
+    def stages(self):
+        """ Steps of score, alternating between CPU and GPU work """
+        return [self._answer_stage, self._qg_stage, self._filter_stage, self._qa_stage, self._compare_stage]
+
+    def _make_batch(self, srcs, gens, seed, start, ex_ids=None):
+        assert len(srcs) == len(gens), "Need a summary per source!"
+        if ex_ids is None:
+            ex_ids = range(start, start + len(srcs))
+        assert len(ex_ids) == len(srcs), "Need an id per example!"
+        # seeded per example, so scores don't depend on how the corpus is split into chunks
+        rngs = [example_rng(seed, ex_id) for ex_id in ex_ids]
+        return {'srcs': srcs, 'gens': gens, 'rngs': rngs}
+
+    def score(self, srcs, gens, seed=None, start=0, ex_ids=None):
+        """ Compute QAGS scores for summaries gens of source documents srcs.
+
+        Example i is sampled from with random.Random(f"{seed}-{start + i}"),
+        where start is the position of the first example in the corpus,
+        or with random.Random(f"{seed}-{ex_ids[i]}") if given ids of the examples,
+        or with the global generator without a seed.
+
+        returns:
+            - a list with a QAGS score per (source, summary) pair
+        """
+        batch = self._make_batch(srcs, gens, seed, start, ex_ids=ex_ids)
+        for stage in self.stages[:-1]:
+            batch = stage(batch)
+        return self.stages[-1](batch)
+
+    def score_pipelined(self, chunks, seed=None, max_queued=2):
+        """ Score chunks of (srcs, gens) like score, overlapping the CPU and GPU
+        stages of consecutive chunks (see run_pipelined).
+
+        Examples are sampled from with their own generators as in score, numbered
+        across chunks, so scores don't depend on how the stages' threads are scheduled.
+
+        returns:
+            - a generator over the scores of each chunk, in order
+        """
+        def make_batches():
+            start = 0
+            for srcs, gens in chunks:
+                yield self._make_batch(srcs, gens, seed, start)
+                start += len(srcs)
+        return run_pipelined(self.stages, make_batches(), max_queued=max_queued)
+
+
+def add_scorer_args(parser):
+    """ Add the arguments needed to build a QagsScorer """
+    parser.add_argument('--qg_args', type=str, required=True,
+                        help="fairseq flags for the QG model, e.g. '${data_path} --path ${model_path} --beam 10 --nbest 10'")
+    parser.add_argument('--qa_args', type=str, required=True,
+                        help="fairseq flags for the QA model, e.g. '${data_path} --path ${model_path}'")
+    parser.add_argument('--n_ans_per_doc', type=int, default=10, help="Number of answer candidates per example")
+    parser.add_argument('--n_qsts_per_doc', type=int, default=5, help="Number of questions to use per example")
+    parser.add_argument('--variable_n_qsts', action='store_true',
+                        help="Only use the questions that pass the filters, up to n_qsts_per_doc, "
+                             "instead of padding examples with too few")
+    parser.add_argument('--ans_similarity_fn', choices=["em", "f1"], default="f1")
+    parser.add_argument('--spacy_model', type=str, default="en_core_web_lg")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--qg_round_size', type=int, default=None,
+                        help="Generate questions from this many answer candidates per example at a time, "
+                             "stopping once an example has enough usable questions")
+    parser.add_argument('--constrained_qg', action='store_true',
+                        help="Stop questions at '?', skip repeated questions and enforce the QG --min-len during search")
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help="SQLite file to cache answer candidates and generated questions in across runs")
+    parser.add_argument('--cache_max_mb', type=float, default=None,
+                        help="Evict the least recently used cache entries beyond this size")
+
+
+def get_fseq_path(fseq_args):
+    """ Get the --path of a string of fairseq flags """
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument('--path', type=str, default=None)
+    return parser.parse_known_args(shlex.split(fseq_args))[0].path
+
+
+def get_scorer_id(args):
+    """ Identify the models and options of the QagsScorer built by build_scorer(args),
+    without loading it, e.g. to check that outputs were computed by the same scorer """
+    return {
+            'qg_args': args.qg_args, 'qg_path': checkpoint_id(get_fseq_path(args.qg_args)),
+            'qa_args': args.qa_args, 'qa_path': checkpoint_id(get_fseq_path(args.qa_args)),
+            'n_ans_per_doc': args.n_ans_per_doc, 'n_qsts_per_doc': args.n_qsts_per_doc,
+            'variable_n_qsts': args.variable_n_qsts, 'ans_similarity_fn': args.ans_similarity_fn,
+            'spacy_model': args.spacy_model, 'seed': args.seed,
+            'qg_round_size': args.qg_round_size, 'constrained_qg': args.constrained_qg,
+           }
+
+
+def build_scorer(args):
+    """ Build a QagsScorer from arguments added by add_scorer_args """
+    random.seed(args.seed)
+    cache = None
+    if args.cache_file is not None:
+        max_size = int(args.cache_max_mb * 2 ** 20) if args.cache_max_mb is not None else None
+        cache = QagsCache(args.cache_file, max_size=max_size)
+    return QagsScorer(shlex.split(args.qg_args), shlex.split(args.qa_args),
+                      n_ans=args.n_ans_per_doc, n_qsts=args.n_qsts_per_doc,
+                      metric_name=args.ans_similarity_fn,
+                      spacy_model=args.spacy_model, cpu=args.cpu,
+                      qg_round_size=args.qg_round_size, constrained_qg=args.constrained_qg,
+                      cache=cache, variable_n_qsts=args.variable_n_qsts)
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Compute QAGS scores end-to-end in a single process')
+    parser.add_argument('--src_txt_file', type=str, required=True,
+                        help="Txt file containing a src example per line, corresponding with gen_txt_file")
+    parser.add_argument('--gen_txt_file', type=str, required=True,
+                        help="Txt file containing a model-generated example per line, corresponding with src_txt_file")
+    parser.add_argument('--out_dir', type=str, required=True, help="Directory to write qags_scores.txt to")
+    parser.add_argument('--chunk_size', type=int, default=100, help="Number of examples to score at a time")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="Overlap the CPU and GPU stages of consecutive chunks")
+    parser.add_argument('--max_queued_chunks', type=int, default=2,
+                        help="With --pipelined, max number of chunks waiting between two stages")
+    parser.add_argument('--diagnostics', action='store_true',
+                        help="Also write a row per question with its answers, scores and probability to out_dir/diagnostics")
+    add_scorer_args(parser)
+    args = parser.parse_args(arguments)
+
+    srcs = load_txt(args.src_txt_file)
+    gens = load_txt(args.gen_txt_file)
+    assert len(srcs) == len(gens), f"Found {len(srcs)} sources but {len(gens)} generations!"
+
+    scorer = build_scorer(args)
+    if args.diagnostics:
+        scorer.diagnostics = ColumnStoreWriter(os.path.join(args.out_dir, "diagnostics"), DIAGNOSTIC_COLUMNS)
+    qags_scores = []
+    starts = range(0, len(srcs), args.chunk_size)
+    if args.pipelined:
+        chunks = ((srcs[start: start + args.chunk_size], gens[start: start + args.chunk_size]) for start in starts)
+        for scores in scorer.score_pipelined(chunks, seed=args.seed, max_queued=args.max_queued_chunks):
+            qags_scores += scores
+    else:
+        for start in starts:
+            end = start + args.chunk_size
+            qags_scores += scorer.score(srcs[start:end], gens[start:end], seed=args.seed, start=start)
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    out_file = os.path.join(args.out_dir, "qags_scores.txt")
+    write_txt(qags_scores, out_file)
+    print(f"Wrote {len(qags_scores)} scores to {out_file}")
+    if scorer.diagnostics is not None:
+        scorer.diagnostics.close()
+        print(f"Wrote {scorer.diagnostics.n_rows} question diagnostics to {scorer.diagnostics.out_dir}")
+    if scorer.cache is not None:
+        print(scorer.cache.report())
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+""" Persistent, content-addressed cache of intermediate QAGS results.
+
+Entries are stored in a SQLite file, keyed by a hash of
+    - a namespace, e.g. 'ans' for answer candidates or 'qg' for generated questions
+    - a model id, e.g. the checkpoint and decoding options that produced the entry
+    - the input text the entry was computed from, or a tuple of texts
+so the same input processed by the same model is only computed once across runs.
+Values are JSON encoded.
+
+Once the cache holds more than max_size bytes of values,
+the least recently used entries are evicted.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import Counter
+
+
+def checkpoint_id(path):
+    """ Identify a checkpoint by its path, size and modification time,
+    so a checkpoint overwritten by a new version gets a new id """
+    paths = path.split(':')
+    return ':'.join(f'{os.path.abspath(p)}@{os.path.getsize(p)}-{int(os.path.getmtime(p))}' for p in paths)
+
+
+def make_qa_model_id(path, stride=128, max_length=384, max_query_length=64):
+    """ Identify a QA model by its checkpoint and the options used to split
+    contexts into windows, which change its predictions """
+    return json.dumps({
+                       'path': checkpoint_id(path),
+                       'stride': stride,
+                       'max_length': max_length,
+                       'max_query_length': max_query_length,
+                      }, sort_keys=True)
+
+
+def make_key(namespace, model_id, txt):
+    """ Hash an input text, or a tuple of texts such as a (context, question) pair,
+    for the model and namespace it is processed with """
+    if not isinstance(txt, str):
+        txt = json.dumps(list(txt))
+    data = '\0'.join([namespace, model_id, txt]).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class QagsCache(object):
+    """ Size-bounded key-value cache backed by a SQLite file.
+
+    Safe to share across threads; processes can each open the same file.
+
+    args:
+        - cache_file: path to the SQLite file, created if needed
+        - max_size: max number of bytes of values to keep, or None for no limit
+    """
+
+    def __init__(self, cache_file, max_size=None):
+        self.cache_file = cache_file
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, timeout=60, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                          "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.conn.commit()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.n_evicted = 0
+
+    def get_many(self, namespace, model_id, txts):
+        """ Look up the entries for txts, returning None for those not in the cache """
+        keys = [make_key(namespace, model_id, txt) for txt in txts]
+        found = {}
+        with self.lock:
+            # stay under SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start: start + 500]
+                rows = self.conn.execute(f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(batch))})",
+                                         batch).fetchall()
+                found.update(rows)
+            now = time.time()
+            self.conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+            self.hits[namespace] += sum(key in found for key in keys)
+            self.misses[namespace] += sum(key not in found for key in keys)
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, namespace, model_id, txts, values):
+        """ Add the entries for txts, then evict entries if the cache is too large """
+        assert len(txts) == len(values), "Need a value per text!"
+        now = time.time()
+        rows = []
+        for txt, value in zip(txts, values):
+            data = json.dumps(value)
+            rows.append((make_key(namespace, model_id, txt), data, len(data), now))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+            if self.max_size is not None:
+                self._evict()
+
+    def get(self, namespace, model_id, txt):
+        return self.get_many(namespace, model_id, [txt])[0]
+
+    def put(self, namespace, model_id, txt, value):
+        self.put_many(namespace, model_id, [txt], [value])
+
+    def _evict(self):
+        """ Drop the least recently used entries until the cache fits in max_size """
+        size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, entry_size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self.conn.commit()
+        self.n_evicted += len(evicted)
+
+    def stats(self):
+        """ Summarize the cache and its hit rate since it was opened """
+        with self.lock:
+            n_entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            stats = {
+                     'n_entries': n_entries,
+                     'size': size,
+                     'n_evicted': self.n_evicted,
+                    }
+            for namespace in sorted(set(self.hits) | set(self.misses)):
+                n_lookups = self.hits[namespace] + self.misses[namespace]
+                stats[namespace] = {
+                                    'hits': self.hits[namespace],
+                                    'misses': self.misses[namespace],
+                                    'hit_rate': self.hits[namespace] / n_lookups if n_lookups else 0.,
+                                   }
+        return stats
+
+    def report(self):
+        """ Format stats() for logging """
+        stats = self.stats()
+        lines = [f"| cache {self.cache_file}: {stats['n_entries']} entries, "
+                 f"{stats['size'] / 2 ** 20:.1f}MB, {stats['n_evicted']} evicted"]
+        for namespace, ns_stats in stats.items():
+            if isinstance(ns_stats, dict):
+                lines.append(f"|\t{namespace}: {ns_stats['hits']} hits, {ns_stats['misses']} misses "
+                             f"({100 * ns_stats['hit_rate']:.1f}% hit rate)")
+        return '\n'.join(lines)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,246 @@
+""" Serve QAGS scores over HTTP.
+
+Keeps the models of a QagsScorer warm and gathers concurrent requests
+into batches, waiting at most max_wait_ms for a batch to fill up.
+Each (source, summary) pair is sampled from with a generator seeded from
+the seed and a hash of the pair, so its score doesn't depend on the other
+requests it's batched with, nor on the requests that came before it.
+
+Endpoints:
+    - POST /score: {"srcs": [...], "gens": [...]} -> {"scores": [...]},
+      with null for summaries left without any question with variable_n_qsts
+    - GET /stats: request counts, batch sizes and latency percentiles
+    - GET /health
+"""
+import sys
+import json
+import time
+import hashlib
+import queue
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from qags import add_scorer_args, build_scorer
+
+
+def get_pair_id(src, gen):
+    """ Identify a (source, summary) pair by its contents """
+    return hashlib.sha1(json.dumps([src, gen]).encode('utf-8')).hexdigest()
+
+
+class ScoreRequest(object):
+    """ A pending request, completed by the batching thread """
+
+    def __init__(self, srcs, gens):
+        self.srcs = srcs
+        self.gens = gens
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+        self.start_time = time.time()
+
+
+class BatchingScorer(object):
+    """ Funnel concurrent requests to a single scorer in dynamic batches.
+
+    A batch is closed once it holds at least max_batch_size examples
+    or max_wait_ms have passed since its first request arrived.
+
+    args:
+        - scorer: object with a score(srcs, gens, seed, ex_ids) method, e.g. a QagsScorer
+        - max_batch_size: number of (source, summary) pairs per batch
+        - max_wait_ms: max time to wait for a batch to fill up
+        - n_latencies: number of recent requests to compute latency stats over
+        - seed: seed of the per-pair random number generators (see get_pair_id)
+    """
+
+    def __init__(self, scorer, max_batch_size=32, max_wait_ms=20, n_latencies=10000, seed=1):
+        self.scorer = scorer
+        self.seed = seed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=n_latencies)
+        self.batch_sizes = deque(maxlen=n_latencies)
+        self.n_requests = 0
+        self.n_exs = 0
+        self.n_errors = 0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def score(self, srcs, gens):
+        """ Block until the scores for srcs and gens are computed """
+        request = ScoreRequest(srcs, gens)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        n_exs = len(batch[0].srcs)
+        deadline = time.time() + self.max_wait
+        while n_exs < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_exs += len(request.srcs)
+        return batch
+
+    def _score(self, batch):
+        """ Score the requests of a batch together, setting their scores or error """
+        srcs = [src for request in batch for src in request.srcs]
+        gens = [gen for request in batch for gen in request.gens]
+        ex_ids = [get_pair_id(src, gen) for src, gen in zip(srcs, gens)]
+        try:
+            scores = self.scorer.score(srcs, gens, seed=self.seed, ex_ids=ex_ids) if srcs else []
+        except Exception as e:
+            if len(batch) > 1:
+                # don't fail the other requests of the batch because of one bad request
+                for request in batch:
+                    self._score([request])
+                return
+            batch[0].error = e
+            return
+        start = 0
+        for request in batch:
+            request.scores = scores[start: start + len(request.srcs)]
+            start += len(request.srcs)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self._score(batch)
+
+            end_time = time.time()
+            with self.lock:
+                self.batch_sizes.append(sum(len(request.srcs) for request in batch))
+                for request in batch:
+                    n_exs = len(request.srcs)
+                    if request.error is not None:
+                        self.n_errors += 1
+                    self.n_requests += 1
+                    self.n_exs += n_exs
+                    self.latencies.append(end_time - request.start_time)
+                    request.done.set()
+
+    def stats(self):
+        """ Summarize recent requests """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = np.array(self.batch_sizes)
+            stats = {
+                     'n_requests': self.n_requests,
+                     'n_examples': self.n_exs,
+                     'n_errors': self.n_errors,
+                     'n_pending': self.requests.qsize(),
+                    }
+        if len(latencies):
+            stats['mean_batch_size'] = float(batch_sizes.mean())
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            stats['latency_ms'] = {
+                                   'mean': float(latencies.mean()),
+                                   'p50': float(p50),
+                                   'p90': float(p90),
+                                   'p99': float(p99),
+                                  }
+        cache = getattr(self.scorer, 'cache', None)
+        if cache is not None:
+            stats['cache'] = cache.stats()
+        return stats
+
+
+def make_handler(batcher, verbose=False):
+    """ Build a request handler class bound to batcher """
+
+    class QagsHandler(BaseHTTPRequestHandler):
+
+        def _send(self, code, data):
+            # NaN isn't valid JSON, so fail loudly rather than send it
+            body = json.dumps(data, allow_nan=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, batcher.stats())
+            elif self.path == '/health':
+                self._send(200, {'status': 'ok'})
+            else:
+                self._send(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self._send(404, {'error': f'Unknown path {self.path}'})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(length).decode('utf-8'))
+                srcs, gens = data['srcs'], data['gens']
+                assert isinstance(srcs, list) and isinstance(gens, list), "'srcs' and 'gens' should be lists!"
+                assert len(srcs) == len(gens), f"Found {len(srcs)} sources but {len(gens)} generations!"
+                assert all(isinstance(txt, str) for txt in srcs + gens), "'srcs' and 'gens' should be lists of strings!"
+            except (ValueError, KeyError, TypeError, AssertionError) as e:
+                self._send(400, {'error': f'Bad request: {e}'})
+                return
+
+            try:
+                scores = batcher.score(srcs, gens)
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+                return
+            # with variable_n_qsts, summaries without any question get a NaN score
+            scores = [None if np.isnan(score) else float(score) for score in scores]
+            self._send(200, {'scores': scores})
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return QagsHandler
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Serve QAGS scores over HTTP')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max_batch_size', type=int, default=32,
+                        help="Max number of (source, summary) pairs to score at a time")
+    parser.add_argument('--max_wait_ms', type=float, default=20,
+                        help="Max time to wait for more requests before scoring a batch")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    add_scorer_args(parser)
+    args = parser.parse_args(arguments)
+
+    scorer = build_scorer(args)
+    batcher = BatchingScorer(scorer, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                             seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, verbose=args.verbose))
+    print(f"| serving QAGS scores on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
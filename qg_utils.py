@@ -4,22 +4,60 @@ import sys
 import json
 import random
 import argparse
+import itertools
+from array import array
+from multiprocessing import Pool
 from collections import defaultdict, Counter
 
+import numpy as np
 import spacy
 from transformers import GPT2Tokenizer
 
 from utils import write_data, write_jsonl, write_txt, \
                   process, print_samples, format_squad, \
-                  filter_line_fseq, parse_generation, \
+                  filter_line_fseq, parse_generation, iter_generations, \
                   load_txt, load_json
+from qst_store import QuestionStore, QuestionStoreWriter, SUFFIXES as STORE_SUFFIXES
+from stage_manifest import StageManifest
 
 
 ANS_TOK = "[ANS]"
 NO_ANS_TOK = "[NO_ANS]"
 
+# pipeline components needed for doc.ents and doc.noun_chunks
+ANS_PIPES = {"tok2vec", "transformer", "tagger", "attribute_ruler", "parser", "ner"}
+SPACY_NLPS = {}
 
-def extract_ans(txts):
+
+def get_spacy_nlp(model="en_core_web_lg"):
+    """ Load a spaCy pipeline, once per process """
+    if model not in SPACY_NLPS:
+        SPACY_NLPS[model] = spacy.load(model)
+    return SPACY_NLPS[model]
+
+
+def get_spacy_model_id(model="en_core_web_lg"):
+    """ Identify a spaCy pipeline by its name and version """
+    return f"{model}-{get_spacy_nlp(model).meta.get('version', '')}"
+
+
+def iter_ans(txts, nlp=None, n_process=1, batch_size=256):
+    """ Lazily extract answer candidates from an iterable of texts (see extract_ans),
+    running only the pipeline components in ANS_PIPES """
+    if nlp is None:
+        nlp = get_spacy_nlp("en_core_web_lg")
+    disable = [name for name in nlp.pipe_names if name not in ANS_PIPES]
+    for doc in nlp.pipe(txts, disable=disable, n_process=n_process, batch_size=batch_size):
+        ans = list()
+        for ent in doc.ents:
+            ans.append(ent.text)
+        for chunk in doc.noun_chunks:
+            ans.append(chunk.text)
+        ans = list(set(ans))
+        yield ans
+
+
+def extract_ans(txts, nlp=None, n_process=1, batch_size=256):
     """ extract entities from a sentence using spacy
 
     rules:
@@ -30,17 +68,19 @@ def extract_ans(txts):
             - nouns w/ dependencies that are proper nouns, roughly nouns modifying proper nouns
             - if the head of a noun chunk if a verb, the entire noun chunk ?
     """
-    nlp = get_spacy_nlp("en_core_web_lg")
-    all_ans = list()
-    for doc in nlp.pipe(txts, disable=[]):
-        ans = list()
-        for ent in doc.ents:
-            ans.append(ent.text)
-        for chunk in doc.noun_chunks:
-            ans.append(chunk.text)
-        ans = list(set(ans))
-        all_ans.append(ans)
-    return all_ans
+    return list(iter_ans(txts, nlp=nlp, n_process=n_process, batch_size=batch_size))
+
+
+def sample_ans(anss, n_ans_per_txt=10, rng=random):
+    """ Sample exactly n_ans_per_txt answer candidates,
+    repeating candidates if there are too few """
+    if len(anss) < n_ans_per_txt:
+        extra_anss = rng.choices(anss, k=n_ans_per_txt - len(anss))
+        anss = anss + extra_anss
+    if len(anss) > n_ans_per_txt:
+        anss = rng.sample(anss, n_ans_per_txt)
+    assert len(anss) == n_ans_per_txt
+    return anss
 
 
 def prepare_ans_conditional_data(data_file,
@@ -49,16 +89,35 @@ def prepare_ans_conditional_data(data_file,
                                  n_ans_per_txt=10,
                                  use_no_ans=False,
                                  use_only_no_ans=False,
+                                 n_process=1,
+                                 batch_size=256,
+                                 spacy_model="en_core_web_lg",
                                  ):
     """ Given a text file, extract possible answer candidates for each line.
 
-    Will generate n_ans_per_text instances for each line in txt
+    Will generate n_ans_per_text instances for each line in txt.
+    Lines are streamed through spaCy in batches of batch_size in n_process processes,
+    and written out as their answers are extracted.
+    Once done, this is recorded in {out_dir}/{out_prefix}.extract_ans.manifest
+    (see stage_manifest.py), so rerunning with the same data file, options and spaCy model does nothing.
     """
 
 
     txt_w_ans_file = f"{out_dir}/{out_prefix}_w_{n_ans_per_txt}ans.txt"
     txt_file = f"{out_dir}/{out_prefix}.txt"
     ans_file = f"{out_dir}/{out_prefix}_{n_ans_per_txt}ans.txt"
+    out_files = [txt_w_ans_file, txt_file, ans_file]
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    params = {"n_ans_per_txt": n_ans_per_txt, "use_no_ans": use_no_ans, "use_only_no_ans": use_only_no_ans,
+              "spacy_model": get_spacy_model_id(spacy_model)}
+    manifest = StageManifest(f"{out_dir}/{out_prefix}.extract_ans.manifest", "extract_ans",
+                             {"data_file": data_file}, params)
+    if manifest.get(0) is not None and all(os.path.exists(f) for f in out_files):
+        print(f"Answer candidates in {out_dir} are up to date with {data_file}")
+        manifest.close()
+        return
 
     print(f"Preparing answer conditional question generation data for {data_file}")
     if use_only_no_ans:
@@ -68,18 +127,17 @@ def prepare_ans_conditional_data(data_file,
     else:
         print("\twithout NO_ANS option!")
 
-    all_txts = load_txt(data_file)
-    print("Extracting entities...")
-    all_anss = extract_ans(all_txts)
-    print("\tDone!")
-    print(f"\tMin ans count: {min(len(a) for a in all_anss)}")
-    print(f"\tMax ans count: {max(len(a) for a in all_anss)}")
-
-    print("Writing...")
-    txts_w_ans = list()
-    all_txt = list()
-    all_ans = list()
-    for txt, anss in zip(all_txts, all_anss):
+    txt_w_ans_fh = open(txt_w_ans_file, 'w')
+    txt_fh = open(txt_file, 'w')
+    ans_fh = open(ans_file, 'w')
+
+    print("Extracting entities and writing...")
+    txts, nlp_txts = itertools.tee(r.strip() for r in open(data_file, encoding="utf-8"))
+    all_anss = iter_ans(nlp_txts, nlp=get_spacy_nlp(spacy_model), n_process=n_process, batch_size=batch_size)
+    n_txts_w_ans, min_n_anss, max_n_anss = 0, float('inf'), 0
+    for txt, anss in zip(txts, all_anss):
+        min_n_anss = min(min_n_anss, len(anss))
+        max_n_anss = max(max_n_anss, len(anss))
         if use_only_no_ans:
             anss = [NO_ANS_TOK] * n_ans_per_txt
         elif use_no_ans:
@@ -88,52 +146,163 @@ def prepare_ans_conditional_data(data_file,
             anss += [NO_ANS_TOK] * (n_ans_per_txt - len(anss))
             assert NO_ANS_TOK in anss, ipdb.set_trace()
         else:
-            if len(anss) < n_ans_per_txt:
-                extra_anss = random.choices(anss, k=n_ans_per_txt - len(anss))
-                anss += extra_anss
-            if len(anss) > n_ans_per_txt:
-                anss = random.sample(anss, n_ans_per_txt)
-            assert len(anss) == n_ans_per_txt, ipdb.set_trace()
+            anss = sample_ans(anss, n_ans_per_txt)
 
         for ans in anss:
-            txts_w_ans.append(f"{txt} {ANS_TOK} {ans}")
-            all_txt.append(txt)
-            all_ans.append(ans)
+            txt_w_ans_fh.write(f"{txt} {ANS_TOK} {ans}\n")
+            txt_fh.write(f'{txt}\n')
+            ans_fh.write(f'{ans}\n')
+        n_txts_w_ans += len(anss)
 
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    with open(txt_w_ans_file, 'w') as out_fh:
-        for txt in txts_w_ans:
-            out_fh.write(f'{txt}\n')
-    with open(txt_file, 'w') as out_fh:
-        for txt in all_txt:
-            out_fh.write(f'{txt}\n')
-    with open(ans_file, 'w') as out_fh:
-        for ans in all_ans:
-            out_fh.write(f'{ans}\n')
+    txt_w_ans_fh.close()
+    txt_fh.close()
+    ans_fh.close()
+    manifest.add(0, n_txts_w_ans // n_ans_per_txt, files=out_files)
+    manifest.close()
     print("\tDone!")
-    print(f"\tWrote {len(txts_w_ans)} sentences to {txt_w_ans_file}")
+    print(f"\tMin ans count: {min_n_anss}")
+    print(f"\tMax ans count: {max_n_anss}")
+    print(f"\tWrote {n_txts_w_ans} sentences to {txt_w_ans_file}")
+
+
+def decode_gen(raw, tokenizer):
+    """ Decode a generation made of space-separated GPT2 token ids """
+    tok_str = raw.replace('<s>', '').replace('<mask>', '').strip().split()
+    tok_ids = [int(t) for t in tok_str]
+    return tokenizer.decode(tok_ids)
+
+
+class GPT2Decoder(object):
+    """ Batched equivalent of decode_gen.
+
+    Decodes with a table from GPT2 token ids to their bytes,
+    so a generation is decoded with a single bytes.join.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.table = np.empty(len(tokenizer.encoder), dtype=object)
+        for tok, idx in tokenizer.encoder.items():
+            self.table[idx] = bytes(tokenizer.byte_decoder[c] for c in tok)
+        # tokenizer.decode spaces out special and added tokens, so leave those to it
+        self.special_ids = np.array(sorted(set(tokenizer.all_special_ids)), dtype=np.int64)
+        self.clean_up = getattr(tokenizer, 'clean_up_tokenization_spaces', True)
+
+    def decode_batch(self, raws):
+        """ Decode generations made of space-separated GPT2 token ids """
+        all_toks = [raw.replace('<s>', '').replace('<mask>', '').split() for raw in raws]
+        ends = np.cumsum([len(toks) for toks in all_toks])
+        ids = np.array([tok for toks in all_toks for tok in toks], dtype=np.int64)
+        is_added = ids >= len(self.table)
+        parts = self.table[np.where(is_added, 0, ids)]
+        is_special = np.isin(ids, self.special_ids) | is_added
+
+        gens = []
+        for start, end in zip(np.concatenate([[0], ends[:-1]]), ends):
+            if is_special[start: end].any():
+                gens.append(self.tokenizer.decode(ids[start: end].tolist()))
+                continue
+            gen = b''.join(parts[start: end]).decode('utf-8', errors=self.tokenizer.errors)
+            if self.clean_up:
+                gen = self.tokenizer.clean_up_tokenization(gen)
+            gens.append(gen)
+        return gens
 
 
-def extract_gen_from_fseq_log(data_file, out_dir):
-    """ """
+def init_gen_decoder(tokenizer):
+    """ Set up the GPT2Decoder of a worker process """
+    global GEN_DECODER
+    GEN_DECODER = GPT2Decoder(tokenizer)
+
+
+def decode_gen_chunk(examples):
+    """ Decode the generations of (ex_id, src, trg, [(raw, prob)]) examples
+    as (ex_id, gens, probs) with the GPT2Decoder set up by init_gen_decoder """
+    gens = iter(GEN_DECODER.decode_batch([raw for _, _, _, ex_gens in examples for raw, _ in ex_gens]))
+    return [(ex_id, list(itertools.islice(gens, len(ex_gens))), [prob for _, prob in ex_gens])
+            for ex_id, _, _, ex_gens in examples]
+
+
+def get_question_mark_symbols(tokenizer):
+    """ Get the GPT2 BPE ids, as QG dictionary symbols, of the tokens containing a '?' """
+    return [str(idx) for tok, idx in tokenizer.encoder.items() if '?' in tok]
+
+
+def extract_gen_from_fseq_log(data_file, out_dir, qst_store=False, n_workers=1, chunk_size=1000):
+    """ Extract the generations and their probabilities from a fairseq log
+    to gens.txt and probs.txt, and optionally to a question store at
+    out_dir/gens with the generations of each QG input as an example (see qst_store.py)
+
+    The log is streamed into a temporary question store, then copied out in example order,
+    so only the example ids and probabilities are kept in memory.
+    Generations are decoded chunk_size examples at a time, in n_workers processes.
+    Once done, this is recorded in out_dir/extract_gen.manifest (see stage_manifest.py),
+    so rerunning with the same log and options does nothing.
+    """
+
+    out_files = [f'{out_dir}/gens.txt', f'{out_dir}/probs.txt']
+    if qst_store:
+        out_files += [f'{out_dir}/gens.{suffix}' for suffix in STORE_SUFFIXES]
+    # generations are GPT2 BPE ids, decoded with the 'gpt2' tokenizer
+    params = {"qst_store": qst_store, "tokenizer": "gpt2"}
+    manifest = StageManifest(f'{out_dir}/extract_gen.manifest', "extract_gen", {"data_file": data_file}, params)
+    if manifest.get(0) is not None and all(os.path.exists(f) for f in out_files):
+        print(f'Generations in {out_dir} are up to date with {data_file}')
+        manifest.close()
+        return
 
     tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-    data = parse_generation(data_file)
+    examples = iter_generations(data_file, with_src_trg=False)
+    chunks = iter(lambda: list(itertools.islice(examples, chunk_size)), [])
+    if n_workers > 1:
+        pool = Pool(n_workers, initializer=init_gen_decoder, initargs=(tokenizer,))
+        decoded_chunks = pool.imap(decode_gen_chunk, chunks)
+    else:
+        pool = None
+        init_gen_decoder(tokenizer)
+        decoded_chunks = map(decode_gen_chunk, chunks)
+
+    # decode the generations in the order of the log
+    tmp_prefix = f'{out_dir}/gens.tmp'
+    ex_ids, probs = array('q'), array('d')
+    with QuestionStoreWriter(tmp_prefix) as tmp_store:
+        for decoded_chunk in decoded_chunks:
+            for ex_id, ex_gens, ex_probs in decoded_chunk:
+                tmp_store.add_example(ex_gens, ex_probs)
+                ex_ids.append(ex_id)
+                probs.extend(ex_probs)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
+    # write them out sorted by example, merging examples split up in the log
+    tmp_store = QuestionStore(tmp_prefix)
     n_gens = 0
     gen_fh = open(f'{out_dir}/gens.txt', 'w')
     prob_fh = open(f'{out_dir}/probs.txt', 'w')
-    ex_ids = sorted(list(data.keys()))
-    for ex_id in ex_ids:
-        ex_gens = data[ex_id]['gen']
-        for raw, prob in ex_gens:
-            tok_str = raw.replace('<s>', '').replace('<mask>', '').strip().split()
-            tok_ids = [int(t) for t in tok_str]
-            gen = tokenizer.decode(tok_ids)
+    store = QuestionStoreWriter(f'{out_dir}/gens') if qst_store else None
+    order = sorted(range(len(ex_ids)), key=lambda i: ex_ids[i])
+    for _, runs in itertools.groupby(order, key=lambda i: ex_ids[i]):
+        gens, gen_probs = [], []
+        for i in runs:
+            q_start, q_end = tmp_store.example_range(i, i + 1)
+            gens += tmp_store[q_start: q_end]
+            gen_probs += probs[q_start: q_end]
+        for gen, prob in zip(gens, gen_probs):
             gen_fh.write(f'{gen}\n')
             prob_fh.write(f'{prob}\n')
-            n_gens += 1
+        n_gens += len(gens)
+        if store is not None:
+            store.add_example(gens, gen_probs)
+    gen_fh.close()
+    prob_fh.close()
+    if store is not None:
+        store.close()
+    tmp_store.close()
+    for suffix in STORE_SUFFIXES:
+        os.remove(f'{tmp_prefix}.{suffix}')
+    manifest.add(0, len(ex_ids), files=out_files)
+    manifest.close()
 
     print(f'Wrote {n_gens} generations to {out_dir}')
 
@@ -147,14 +316,24 @@ def main(arguments):
 
     # answer extraction options
     parser.add_argument("--n_ans", type=int, default=10, help="Number of answer candidates per example")
+    parser.add_argument("--n_process", type=int, default=1, help="Number of processes to run spaCy with")
+    parser.add_argument("--batch_size", type=int, default=256, help="Number of texts spaCy processes at a time")
+    parser.add_argument("--spacy_model", type=str, default="en_core_web_lg", help="spaCy pipeline to extract answers with")
+
+    # generation extraction options
+    parser.add_argument("--qst_store", action="store_true",
+                        help="Also write the generations to a memory-mappable question store")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of processes to decode generations with")
 
     args = parser.parse_args(arguments)
 
     if args.command == "extract_ans":
         prepare_ans_conditional_data(args.data_file, args.out_dir, args.out_prefix,
-                                     n_ans_per_txt=args.n_ans)
+                                     n_ans_per_txt=args.n_ans, n_process=args.n_process,
+                                     batch_size=args.batch_size, spacy_model=args.spacy_model)
     elif args.command == "extract_gen":
-        extract_gen_from_fseq_log(args.data_file, args.out_dir)
+        extract_gen_from_fseq_log(args.data_file, args.out_dir, qst_store=args.qst_store,
+                                  n_workers=args.n_workers)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+""" Compact on-disk store of generated questions and their probabilities.
+
+A store at prefix P is made of
+    - P.qst: the UTF-8 encoded questions, concatenated
+    - P.off: int64 byte offsets of the questions in P.qst (n_qsts + 1)
+    - P.prb: float32 probabilities of the questions (n_qsts)
+    - P.ex: int64 index of the first question of each example (n_exs + 1),
+        where an example is, e.g., a (text, answer) pair questions were generated from
+
+Reading memory-maps the files, so slicing the questions of an example needs
+no parsing, and processes opening the same store share its pages.
+"""
+import numpy as np
+
+from column_store import StringColumn
+
+SUFFIXES = ["qst", "off", "prb", "ex"]
+
+
+class QuestionStoreWriter(object):
+    """ Append examples' questions and probabilities to a store at prefix """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.fhs = {suffix: open(f"{prefix}.{suffix}", "wb") for suffix in SUFFIXES}
+        self.n_bytes = 0
+        self.n_qsts = 0
+        np.array([0], dtype=np.int64).tofile(self.fhs["off"])
+        np.array([0], dtype=np.int64).tofile(self.fhs["ex"])
+
+    def add_example(self, qsts, prbs):
+        """ Add the questions of the next example """
+        assert len(qsts) == len(prbs), "Need a probability per question!"
+        offsets = []
+        for qst in qsts:
+            data = qst.encode("utf-8")
+            self.fhs["qst"].write(data)
+            self.n_bytes += len(data)
+            offsets.append(self.n_bytes)
+        np.array(offsets, dtype=np.int64).tofile(self.fhs["off"])
+        np.array(prbs, dtype=np.float32).tofile(self.fhs["prb"])
+        self.n_qsts += len(qsts)
+        np.array([self.n_qsts], dtype=np.int64).tofile(self.fhs["ex"])
+
+    def close(self):
+        for fh in self.fhs.values():
+            fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class QuestionStore(object):
+    """ Read-only view of a store written by QuestionStoreWriter.
+
+    Indexing and slicing give questions as strings;
+    prbs and ex_offsets are memory-mapped numpy arrays.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.qsts = StringColumn(prefix, "qst")
+        self.ex_offsets = np.memmap(f"{prefix}.ex", dtype=np.int64, mode="r")
+        n_qsts = len(self.qsts)
+        # numpy can't map empty files
+        self.prbs = np.memmap(f"{prefix}.prb", dtype=np.float32, mode="r") if n_qsts else np.zeros(0, dtype=np.float32)
+        assert len(self.prbs) == n_qsts == self.ex_offsets[-1], f"Corrupted question store at {prefix}"
+
+    @property
+    def n_exs(self):
+        return len(self.ex_offsets) - 1
+
+    def __len__(self):
+        return len(self.qsts)
+
+    def __getitem__(self, idx):
+        return self.qsts[idx]
+
+    def example_range(self, start, end):
+        """ Range of the indices of the questions of examples [start, end) """
+        return int(self.ex_offsets[start]), int(self.ex_offsets[end])
+
+    def get_examples(self, start, end):
+        """ Get the questions and probabilities of examples [start, end) """
+        q_start, q_end = self.example_range(start, end)
+        return self[q_start: q_end], self.prbs[q_start: q_end].tolist()
+
+    def close(self):
+        self.qsts.close()
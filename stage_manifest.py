@@ -0,0 +1,99 @@
+""" Append-only progress manifests, to make pipeline stages resumable.
+
+The manifest of a stage is a JSON lines file made of
+    - a header with the stage name, hashes of the stage's input files and its parameters
+    - a record per finished range of examples [start, end), with whatever the stage
+        needs to pick up after it, e.g. counters and the files the range was written to
+Records are flushed to disk as soon as their range is written out, so after a crash
+the manifest lists exactly the ranges that don't need to be redone.
+If a stage is rerun with different inputs or parameters, its manifest starts over.
+"""
+import os
+import json
+import hashlib
+
+
+FILE_HASHES = {}
+
+
+def file_hash(path, block_size=2 ** 24):
+    """ Hash the contents of a file, only reading it again once it's modified """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in FILE_HASHES:
+        sha = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(block_size), b""):
+                sha.update(block)
+        FILE_HASHES[key] = sha.hexdigest()
+    return FILE_HASHES[key]
+
+
+class StageManifest(object):
+    """ Progress manifest of a stage at path.
+
+    args:
+        - path: manifest file, created if needed
+        - stage: name of the stage
+        - input_files: dict mapping names to the stage's input files; None values are ignored
+        - params: JSON serializable dict of the parameters the outputs depend on
+    """
+
+    def __init__(self, path, stage, input_files, params=None):
+        self.path = path
+        header = {
+                  "stage": stage,
+                  "inputs": {name: file_hash(f) for name, f in sorted(input_files.items()) if f is not None},
+                  "params": params or {},
+                 }
+        # compare headers as they read back
+        self.header = json.loads(json.dumps(header))
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                lines = fh.read().split("\n")
+            try:
+                old_header = json.loads(lines[0])
+            except ValueError:
+                old_header = None
+            if old_header == self.header:
+                for line in lines[1:]:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record may have been cut short by a crash
+                        break
+                    self.records[record["start"]] = record
+            else:
+                print(f"| {stage}: inputs or parameters changed since {path} was written, starting over")
+
+        # rewrite the manifest without any partial record before appending to it
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            for record in [self.header] + list(self.records.values()):
+                fh.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, path)
+        self.fh = open(path, "a", encoding="utf-8")
+        if self.records:
+            print(f"| {stage}: resuming, {len(self.records)} ranges already done according to {path}")
+
+    def get(self, start):
+        """ Get the record of the finished range starting at example start, if any """
+        return self.records.get(start)
+
+    def add(self, start, end, **info):
+        """ Record that examples [start, end) are done """
+        record = {"start": start, "end": end, **info}
+        self.fh.write(json.dumps(record) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.records[start] = record
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
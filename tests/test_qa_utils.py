@@ -0,0 +1,83 @@
+import math
+import random
+import unittest
+
+import numpy as np
+
+from qa_utils import aggregate_examples, batch_f1_scores, batch_scores, edit_distance_score, \
+    exact_match_score, f1_score, get_offsets, metric_max_over_ground_truths, tokenize_answers
+
+METRICS = {"em": exact_match_score, "f1": f1_score, "ed": edit_distance_score}
+
+
+def random_answers(rng, n_anss):
+    """ Short answers that often share tokens, including ones that normalize to nothing """
+    words = ["the", "a", "Cat", "cat,", "dog", "sat", "on", "mat", "(mat)", "!", "NO ANSWER"]
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(0, 4))) for _ in range(n_anss)]
+
+
+class TestBatchScores(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.prds = random_answers(rng, 300) + ["", "", "the", "Cat", "cat"]
+        self.tgts = random_answers(rng, 300) + ["", "a !", "", "cat", "the cat cat"]
+
+    def test_batch_scores(self):
+        for metric_name, metric in METRICS.items():
+            scores = batch_scores(self.prds, self.tgts, metric_name)
+            self.assertEqual(len(scores), len(self.prds))
+            for score, prd, tgt in zip(scores.tolist(), self.prds, self.tgts):
+                self.assertAlmostEqual(score, metric_max_over_ground_truths(metric, prd, [tgt]),
+                                       msg=f"{metric_name}({prd!r}, {tgt!r})")
+
+    def test_batch_f1_scores(self):
+        _, norm_ids, tok_ids, lens, vocab_size = tokenize_answers(self.tgts + self.prds)
+        n_exs = len(self.tgts)
+        scores = batch_f1_scores(norm_ids[:n_exs], norm_ids[n_exs:], tok_ids, lens, vocab_size)
+        for score, tgt, prd in zip(scores.tolist(), self.tgts, self.prds):
+            self.assertAlmostEqual(score, f1_score(tgt, prd), msg=f"f1({tgt!r}, {prd!r})")
+
+    def test_empty_answers(self):
+        # answers that normalize to nothing only match each other
+        prds, tgts = ["", "the", "", "cat"], ["a", "", "cat", ""]
+        self.assertEqual(batch_scores(prds, tgts, "em").tolist(), [1, 1, 0, 0])
+        self.assertEqual(batch_scores(prds, tgts, "f1").tolist(), [1., 1., 0., 0.])
+        self.assertEqual(batch_scores(prds, tgts, "ed").tolist(), [0, 0, 3, 3])
+
+    def test_no_answers(self):
+        for metric_name in METRICS:
+            self.assertEqual(len(batch_scores([], [], metric_name)), 0)
+        with self.assertRaises(ValueError):
+            batch_scores(self.prds, self.tgts, "bleu")
+
+
+class TestAggregateExamples(unittest.TestCase):
+
+    def test_fixed_questions_per_example(self):
+        scores = np.random.RandomState(0).rand(20).tolist()
+        for n_qsts_per_doc in [1, 4, 5, 20]:
+            expected = [sum(scores[i: i + n_qsts_per_doc]) / n_qsts_per_doc
+                        for i in range(0, len(scores), n_qsts_per_doc)]
+            np.testing.assert_allclose(aggregate_examples(scores, n_qsts_per_doc), expected)
+
+    def test_variable_questions_per_example(self):
+        rng = random.Random(0)
+        # examples without questions come first, last and next to each other
+        n_qsts = [0, 3, 1, 0, 0, 5, 2, 0]
+        scores = [rng.random() for _ in range(sum(n_qsts))]
+        agg_scores = aggregate_examples(scores, offsets=get_offsets(n_qsts))
+        self.assertEqual(len(agg_scores), len(n_qsts))
+        start = 0
+        for agg_score, n in zip(agg_scores, n_qsts):
+            if n == 0:
+                self.assertTrue(math.isnan(agg_score))
+            else:
+                self.assertAlmostEqual(agg_score, sum(scores[start: start + n]) / n)
+            start += n
+
+    def test_no_questions(self):
+        agg_scores = aggregate_examples([], offsets=get_offsets([0, 0]))
+        self.assertEqual(len(agg_scores), 2)
+        self.assertTrue(all(math.isnan(score) for score in agg_scores))
+        self.assertEqual(aggregate_examples([], offsets=get_offsets([])), [])
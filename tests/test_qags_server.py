@@ -0,0 +1,61 @@
+import threading
+import unittest
+
+from qags import QagsScorer
+from qags_server import BatchingScorer
+
+
+class SamplingScorer(QagsScorer):
+    """ QagsScorer without models, scoring each pair with a draw from the
+    random number generator its answers and questions would be sampled with """
+
+    def __init__(self):
+        pass
+
+    @property
+    def stages(self):
+        return [lambda batch: [rng.random() for rng in batch['rngs']]]
+
+
+class TestBatchingScorer(unittest.TestCase):
+
+    def setUp(self):
+        self.srcs = [f"source {i}" for i in range(6)]
+        self.gens = [f"summary {i % 3}" for i in range(6)]
+
+    def test_scores_dont_depend_on_batch(self):
+        alone = BatchingScorer(SamplingScorer(), max_batch_size=1, max_wait_ms=0)
+        expected = [alone.score([src], [gen])[0] for src, gen in zip(self.srcs, self.gens)]
+
+        # the same pairs in another order, split across requests that end up in a single batch
+        batched = BatchingScorer(SamplingScorer(), max_batch_size=len(self.srcs), max_wait_ms=5000)
+        order = [5, 2, 0, 4, 1, 3]
+        requests = [order[:1], order[1:3], order[3:]]
+        scores = {}
+
+        def request(idxs):
+            for idx, score in zip(idxs, batched.score([self.srcs[i] for i in idxs], [self.gens[i] for i in idxs])):
+                scores[idx] = score
+
+        threads = [threading.Thread(target=request, args=(idxs,)) for idxs in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(batched.batch_sizes), [len(self.srcs)])
+        self.assertEqual([scores[i] for i in range(len(self.srcs))], expected)
+
+        # and again, reversed, now that other requests came before
+        scores = batched.score(self.srcs[::-1], self.gens[::-1])
+        self.assertEqual(scores[::-1], expected)
+
+    def test_seed(self):
+        scores = [BatchingScorer(SamplingScorer(), seed=seed).score(self.srcs, self.gens) for seed in [1, 1, 2]]
+        self.assertEqual(scores[0], scores[1])
+        self.assertNotEqual(scores[0], scores[2])
+        # each pair gets its own generator
+        self.assertEqual(len(set(scores[0])), len(self.srcs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from column_store import ColumnStore, ColumnStoreWriter
+from qst_store import QuestionStore, QuestionStoreWriter
+
+
+class TestStringReads(unittest.TestCase):
+    """ Both stores read their strings with the same StringColumn """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.exs = [["Who?", "", "Wie heißt du?"], [], ["What is it?"]]
+        self.qsts = [qst for qsts in self.exs for qst in qsts]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertReads(self, strings):
+        self.assertEqual(len(strings), len(self.qsts))
+        self.assertEqual([strings[i] for i in range(len(strings))], self.qsts)
+        self.assertEqual(strings[-1], self.qsts[-1])
+        self.assertEqual(strings[1:4], self.qsts[1:4])
+        self.assertEqual(strings[2:2], [])
+        self.assertEqual(strings[np.array([3, 0])], [self.qsts[3], self.qsts[0]])
+
+    def test_question_store(self):
+        prefix = f"{self.tmp_dir.name}/gens"
+        with QuestionStoreWriter(prefix) as writer:
+            for qsts in self.exs:
+                writer.add_example(qsts, [0.5] * len(qsts))
+        store = QuestionStore(prefix)
+        self.assertReads(store)
+        self.assertEqual(store.get_examples(1, 3), (["What is it?"], [0.5]))
+        store.close()
+
+    def test_column_store(self):
+        with ColumnStoreWriter(self.tmp_dir.name, {"qst": "str"}) as writer:
+            for qsts in self.exs:
+                writer.write(qst=qsts)
+        store = ColumnStore(self.tmp_dir.name)
+        self.assertReads(store["qst"])
+        store.close()
+
+    def test_empty(self):
+        QuestionStoreWriter(f"{self.tmp_dir.name}/gens").close()
+        store = QuestionStore(f"{self.tmp_dir.name}/gens")
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store[0:0], [])
+        store.close()
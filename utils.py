@@ -87,6 +87,54 @@ def print_samples(data, n_samples=5):
         for hyp in sample["gen"]:
             print(f"\tHyp: {hyp[0]}")
 
+def iter_generations(data_file, block_size=2 ** 24, with_src_trg=True):
+    """ Stream the examples of a fairseq generation log.
+
+    Reads the log in blocks of block_size bytes and dispatches on the first
+    byte of each line rather than matching a regex.
+    The lines of an example are expected to be contiguous, as printed by
+    (summerization_)generate.py; an example that is split up is yielded once per run.
+    Without with_src_trg, the (long) source and target lines are not decoded.
+
+    yields:
+        - (example index, source, target, list of (generation, score)),
+            with None for a missing source or target
+    """
+    with open(data_file, 'rb') as data_fh:
+        example = None
+        rest = b''
+        while True:
+            block = data_fh.read(block_size)
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop() if block else b''
+            for line in lines:
+                line_t = line[:1]
+                if line_t not in (b'S', b'T', b'H') or line[1:2] != b'-':
+                    continue
+                if line_t != b'H' and not with_src_trg:
+                    continue
+                tab = line.find(b'\t')
+                ex_idx = line[2:tab]
+                if tab < 0 or not ex_idx.isdigit():
+                    continue
+                ex_idx = int(ex_idx)
+                if example is None or example[0] != ex_idx:
+                    if example is not None:
+                        yield tuple(example)
+                    example = [ex_idx, None, None, []]
+
+                fields = line[tab + 1:].decode('utf-8').split('\t')
+                if line_t == b'H':
+                    assert len(fields) == 2
+                    example[3].append((process(fields[1]), float(fields[0])))
+                else:
+                    assert len(fields) == 1
+                    example[1 if line_t == b'S' else 2] = process(fields[0])
+            if not block:
+                break
+        if example is not None:
+            yield tuple(example)
+
 def parse_generation(data_file):
     """ Parse data_file (fairseq log) for the actual generations.
 
@@ -94,34 +142,17 @@ def parse_generation(data_file):
         - data: dict mapping example indices to dictionary with keys
             'src', 'trg', and 'gen', where the latter is a list
     """
-    with open(data_file, encoding='utf-8') as data_fh:
-        all_lines = data_fh.readlines()
-
     data = defaultdict(lambda: defaultdict(dict))
-    for line in all_lines:
-        if filter_line_fseq(line):
-            continue
-
-        line = line.split('\t')
-        line_t, ex_idx = line[0].split('-')
-        ex_idx = int(ex_idx)
-        if "gen" not in data[ex_idx]:
-            data[ex_idx]["gen"] = []
-        data[ex_idx]["id"] = ex_idx
-
-        assert line_t in ['S', 'T', 'H', 'P']
-        if line_t in ['S', 'T']:
-            assert len(line) == 2
-            text = process(line[1])# .strip()
-            key = 'src' if line_t == 'S' else 'trg'
-            data[ex_idx][key] = text
-        elif line_t == 'H':
-            assert len(line) == 3
-            score = float(line[1])
-            text = process(line[2]) #.strip()
-            data[ex_idx]["gen"].append((text, score))
-        else: # probabilities
-            continue
+    for ex_idx, src, trg, gens in iter_generations(data_file):
+        datum = data[ex_idx]
+        if "gen" not in datum:
+            datum["gen"] = []
+        datum["id"] = ex_idx
+        if src is not None:
+            datum["src"] = src
+        if trg is not None:
+            datum["trg"] = trg
+        datum["gen"] += gens
 
     return data
 
@@ -140,6 +171,37 @@ def swap_fields(data, swap_d):
         new_data[datum_idx] = new_datum
     return new_data
 
+def format_squad_article(raw, context="src", ctx_split=False, qa_idx=0):
+    """ Format a single example into a SQuAD article,
+    numbering its questions from qa_idx.
+
+    args:
+        - raw: dict of 'src', 'trg', 'gen' and the questions as 'hypotheses'
+        - context: name of the text field in raw to use as the 'source document'
+
+    returns:
+        - article: SQuAD formatted article
+    """
+    datum = {}
+    if ctx_split:
+        datum["context"] = " ".join(raw[context])
+        dummy_title = " ".join(raw[context][:5])
+    else:
+        datum["context"] = raw[context]
+        dummy_title = " ".join(raw[context].split()[:5])
+
+    qas = list()
+    for idx, raw_qa in enumerate(raw["hypotheses"]):
+        qa = {"question": raw_qa,
+              "answers": [],
+              "id": qa_idx + idx
+             }
+        qas.append(qa)
+    datum["qas"] = qas
+    return {"paragraphs": [datum],
+            "title": dummy_title,
+           }
+
 def format_squad(raw_data, context="src", ctx_split=False):
     """ Format data into SQuAD format.
 
@@ -155,26 +217,8 @@ def format_squad(raw_data, context="src", ctx_split=False):
     qa_idx = 0
     data = list()
     for datum_idx, raw in tqdm(raw_data.items(), desc="Formatting SQUAD"):
-        datum = {}
-        if ctx_split:
-            datum["context"] = " ".join(raw[context])
-            dummy_title = " ".join(raw[context][:5])
-        else:
-            datum["context"] = raw[context]
-            dummy_title = " ".join(raw[context].split()[:5])
-
-        qas = list()
-        for idx, raw_qa in enumerate(raw["hypotheses"]):
-            qa = {"question": raw_qa,
-                  "answers": [],
-                  "id": qa_idx
-                 }
-            qa_idx += 1
-            qas.append(qa)
-        datum["qas"] = qas
-        data.append({"paragraphs": [datum],
-                     "title": dummy_title,
-                    })
+        data.append(format_squad_article(raw, context, ctx_split, qa_idx))
+        qa_idx += len(raw["hypotheses"])
 
     return {"data": data}
 